@@ -0,0 +1,53 @@
+#!/bin/bash
+
+import sys
+import os
+import argparse
+import datetime as dt
+import gnomeptb as ptb
+import gnomeptb.backfill
+import ast
+
+def backfill_function():
+    parser = argparse.ArgumentParser(description="Regenerate the HDF5 files of a range of days from finished data files")
+
+    parser.add_argument("-b", "--from", dest="fromdate", required=True, help="First day to process, as YYYY-MM-DD")
+    parser.add_argument("-e", "--to", dest="todate", required=True, help="Last day to process, as YYYY-MM-DD")
+    parser.add_argument("-ra", "--cavityregex", dest="cavityregex", default=ptb.default_cavity_regex, help="The regular expression of the cavity data")
+    parser.add_argument("-ro", "--combregex", dest="combregex", default=ptb.default_comb_regex, help="The regular expression of the comb data")
+    parser.add_argument("-dw", "--workdir", dest="workdir", default="D:/ClockData", help="Working directory, where data exists")
+    parser.add_argument("-da", "--cavisubdir", dest="cavitysubdir", default="Cavities", help="Sub-directory of cavities data")
+    parser.add_argument("-dm", "--combsubdir", dest="combsubdir", default="Comb", help="Sub-directory of comb data")
+    parser.add_argument("-df", "--finishedsubdir", dest="finishedsubdir", default="finished", help="Sub-directory of the cavities and comb sub-directories, where the finished files are")
+    parser.add_argument("-do", "--outputdir", dest="outputdir", default="output", help="Output directory of files to be uploaded (HDF5 files)")
+    parser.add_argument("-oa", "--archivedir", dest="archivedir", default=None, help="If given, minutes are appended to daily HDF5 files in this directory, instead of being written to a file each in the output directory (export.py writes the minute files from the daily files)")
+    parser.add_argument("-sn", "--stationname", dest="stationname", default="ptb01", help="Station name")
+    parser.add_argument("-ca", "--cavicolumns", dest="cavicolumns", default="[0, 1, 2]", help="Cavities data columns to include in the output data file")
+    parser.add_argument("-cm", "--combcolumns", dest="combcolumns", default="[1, 2, 3, 4, 5, 6]", help="Comb data columns to include in the output data file")
+    parser.add_argument("-sp", "--storageprofile", dest="storageprofile", default=ptb.SingleFileData.StorageProfile, choices=sorted(ptb.SingleFileData.storage_profiles), help="Compression and chunking of the datasets in the HDF5 files")
+    parser.add_argument("-cw", "--compressionworkers", dest="compressionworkers", type=int, default=0, help="Number of processes that compress the chunks of the HDF5 datasets in parallel (0 lets HDF5 compress them)")
+    parser.add_argument("-ed", "--deriveddatasets", dest="deriveddatasets", action="store_true", help="Evaluate the channels of the main equation over every minute, and write them to datasets of their own in the HDF5 files")
+    parser.add_argument("-eq", "--equations", dest="equations", default='CombData[[1]]+CombData[[0]]/2["First Var",Hz]::CavitiesData[[2]]/3+CavitiesData[[0]]["Second Var",Hz]', help="Main Equation to embed in the HDF5 file")
+    parser.add_argument("-j", "--workers", dest="workers", type=int, default=None, help="Number of processes that write files (default: number of CPUs)")
+
+    args = parser.parse_args()
+
+    ptb.SingleFileData.SetMainEquations(args.equations)
+    ptb.SingleFileData.SetDerivedDatasets(args.deriveddatasets)
+    ptb.SingleFileData.SetStorageProfile(args.storageprofile)
+    ptb.SingleFileData.SetCompressionWorkers(args.compressionworkers)
+    # columns to include in the output file
+    ptb.analysis.cavi_columns_to_include = ast.literal_eval(args.cavicolumns)
+    ptb.analysis.comb_columns_to_include = ast.literal_eval(args.combcolumns)
+
+    ptb.LineData.set_decimal_precision(30)
+    first_date = dt.datetime.strptime(args.fromdate, "%Y-%m-%d").date()
+    last_date = dt.datetime.strptime(args.todate, "%Y-%m-%d").date()
+    ptb.backfill.run_backfill(os.path.join(args.workdir, args.cavitysubdir, args.finishedsubdir),
+                              os.path.join(args.workdir, args.combsubdir, args.finishedsubdir),
+                              args.outputdir, args.stationname, first_date, last_date,
+                              args.cavityregex, args.combregex, args.workers, archive_dir=args.archivedir)
+
+if __name__ == '__main__':
+    backfill_function()
+    sys.exit(0)
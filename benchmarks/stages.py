@@ -0,0 +1,225 @@
+# Benchmark of the stages of processing the data: parsing, aligning, normalizing and writing
+# Every stage is timed separately on the same synthetic data (see synthetic.py), and reported in lines per second,
+# with the peak memory that Python allocated in it (measured with tracemalloc, in a separate run of the stage).
+# The results are stored in a JSON file, which can be given to a later run (of another commit) to compare with; the
+# stages that got slower by more than the tolerance are reported, and make the exit status 1.
+#
+# Usage: python benchmarks/stages.py [-s 180] [-n 3] [-o results.json] [-c baseline.json] [-t 0.1] [--checkdecimal]
+
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gnomeptb as ptb
+from gnomeptb.tailing import MappedLines, find_lines
+from synthetic import synthetic_files
+
+# lines parsed one by one with parse_line(), which is too slow for all of them
+parse_line_sample = 20000
+
+
+def to_mapped_lines(lines):
+    """
+    Put lines in a single buffer, the way BlockLineReader reads them
+    """
+    buffer = "".join(line + "\n" for line in lines).encode()
+    starts, ends, end = find_lines(buffer)
+    return MappedLines(buffer, starts, ends)
+
+
+def collect_minutes(cavi_lines, comb_lines):
+    """
+    Parse and align lines with DataCollection.process_data(), keeping the complete minutes instead of writing them
+    :return: list of SingleFileData objects
+    """
+    minutes = []
+    collection = ptb.DataCollection(ptb.default_cavity_regex, ptb.default_comb_regex, None, "bench01")
+    collection.file_writer.minute_writer = minutes.append
+    collection.append_cavi_data(cavi_lines)
+    collection.append_comb_data(comb_lines)
+    collection.process_data()
+    return minutes
+
+
+def parse_with_regex(parse):
+    """
+    Parse with the regexes, without the fast tokenizer
+    """
+    ptb.LineData.use_fast_tokenizer = False
+    try:
+        return parse()
+    finally:
+        ptb.LineData.use_fast_tokenizer = True
+
+
+def align_minutes(cavi_batch, comb_batch):
+    """
+    Align lines that are already parsed, like the aligner of the Pipeline does
+    :return: list of SingleFileData objects
+    """
+    minutes = []
+    collection = ptb.DataCollection(ptb.default_cavity_regex, ptb.default_comb_regex, None, "bench01")
+    collection.file_writer.minute_writer = minutes.append
+    collection.append_parsed_cavi_data(cavi_batch)
+    collection.append_parsed_comb_data(comb_batch)
+    collection.align()
+    return minutes
+
+
+def normalize(minute_batches, function):
+    cavi_batch, comb_batch = minute_batches
+    return (function(cavi_batch, ptb.analysis.cavi_columns_to_include),
+            function(comb_batch, ptb.analysis.comb_columns_to_include))
+
+
+def run_stage(stage, repeats):
+    """
+    Time a stage, and measure its peak memory
+    :param stage: function that runs the stage
+    :param repeats: number of times to run it (the median time is taken)
+    :return: tuple (median time in seconds, peak memory in bytes, result of the stage)
+    """
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        result = stage()
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(times), peak, result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the results next to the ones of a previous run
+    :return: list of the names of the stages that got slower by more than tolerance (a fraction)
+    """
+    print("")
+    print("Compared with " + str(baseline.get("commit")) + " (" + str(baseline.get("date")) + "):")
+    print("%-48s %14s %14s %8s" % ("stage", "before (l/s)", "now (l/s)", "ratio"))
+    slower = []
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        before = baseline["stages"][name]["lines_per_second"]
+        ratio = stage["lines_per_second"]/before
+        flag = ""
+        if ratio < 1 - tolerance:
+            flag = "  SLOWER"
+            slower.append(name)
+        print("%-48s %14.0f %14.0f %8.2f%s" % (name, before, stage["lines_per_second"], ratio, flag))
+    return slower
+
+
+def main_function():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--seconds", dest="seconds", type=int, default=180, help="Seconds of synthetic data to process")
+    parser.add_argument("-n", "--repeats", dest="repeats", type=int, default=3, help="Number of times to run every stage (the median time is reported)")
+    parser.add_argument("-o", "--output", dest="output", default=None, help="JSON file to store the results in")
+    parser.add_argument("-c", "--compare", dest="compare", default=None, help="JSON file with the results of a previous run, to compare with")
+    parser.add_argument("-t", "--tolerance", dest="tolerance", type=float, default=0.1, help="Slowdown (as a fraction) from which a stage is reported as slower")
+    parser.add_argument("-d", "--checkdecimal", dest="checkdecimal", action="store_true", help="Also run create_normalized_list_decimal() on a minute, and check that it gives the same result as create_normalized_list()")
+    args = parser.parse_args()
+
+    ptb.LineData.set_decimal_precision(30)
+    ptb.SingleFileData.SetMainEquations('CombData[[1]]+CombData[[0]]/2["First Var",Hz]::CavitiesData[[2]]/3+CavitiesData[[0]]["Second Var",Hz]')
+    cavi_lines, comb_lines = synthetic_files(args.seconds)
+    num_lines = len(cavi_lines) + len(comb_lines)
+    cavi_mapped = to_mapped_lines(cavi_lines)
+    comb_mapped = to_mapped_lines(comb_lines)
+    cavi_parser = ptb.LineData(ptb.default_cavity_regex)
+    comb_parser = ptb.LineData(ptb.default_comb_regex)
+    cavi_batch = cavi_parser.parse_buffer(cavi_mapped)
+    comb_batch = comb_parser.parse_buffer(comb_mapped)
+
+    # a minute of data, as the writer gets it
+    minutes = align_minutes(cavi_batch, comb_batch)
+    if len(minutes) == 0:
+        raise RuntimeError("No complete minute in " + str(args.seconds) + " seconds of data")
+    minute = minutes[0]
+    minute_batches = (minute.cavi_data.batch(), minute.comb_data.batch())
+    minute_lines = len(minute_batches[0]) + len(minute_batches[1])
+    sample_lines = cavi_lines[:parse_line_sample]
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        minute.data_output_dir = out_dir
+        minute.station_name = "bench01"
+        stages = [
+            ("LineData.parse_line", len(sample_lines), lambda: [cavi_parser.parse_line(line) for line in sample_lines]),
+            ("LineData.parse_many", num_lines,
+             lambda: (cavi_parser.parse_many(cavi_lines), comb_parser.parse_many(comb_lines))),
+            ("LineData.parse_buffer", num_lines,
+             lambda: (cavi_parser.parse_buffer(cavi_mapped), comb_parser.parse_buffer(comb_mapped))),
+            ("LineData.parse_buffer (regex only)", num_lines,
+             lambda: parse_with_regex(lambda: (cavi_parser.parse_buffer(cavi_mapped),
+                                               comb_parser.parse_buffer(comb_mapped)))),
+            ("DataCollection.process_data", num_lines, lambda: collect_minutes(cavi_lines, comb_lines)),
+            ("DataCollection.align", num_lines, lambda: align_minutes(cavi_batch, comb_batch)),
+            ("SingleFileData.create_normalized_list", minute_lines,
+             lambda: normalize(minute_batches, ptb.SingleFileData.create_normalized_list)),
+            ("SingleFileData.write_to_file", minute_lines, minute.write_to_file),
+        ]
+        if args.checkdecimal:
+            stages.append(("SingleFileData.create_normalized_list_decimal", minute_lines,
+                           lambda: normalize(minute_batches, ptb.SingleFileData.create_normalized_list_decimal)))
+
+        results = {"benchmark": "stages", "version": ptb.__version__, "commit": git_commit(),
+                   "date": str(dt.datetime.now()), "python": platform.python_version(), "numpy": np.__version__,
+                   "h5py": h5py.__version__, "machine": platform.machine(), "seconds": args.seconds,
+                   "repeats": args.repeats, "stages": {}}
+        outputs = {}
+        for name, lines, stage in stages:
+            seconds, peak, outputs[name] = run_stage(stage, args.repeats)
+            results["stages"][name] = {"lines": lines, "seconds": seconds, "lines_per_second": lines/seconds,
+                                       "peak_memory_bytes": peak}
+
+    print("%-48s %10s %12s %14s %12s" % ("stage", "lines", "time (ms)", "lines/s", "peak (MB)"))
+    for name, stage in results["stages"].items():
+        print("%-48s %10d %12.2f %14.0f %12.2f" % (name, stage["lines"], 1000*stage["seconds"],
+                                                   stage["lines_per_second"], stage["peak_memory_bytes"]/1e6))
+
+    if args.checkdecimal:
+        fixed_point = outputs["SingleFileData.create_normalized_list"]
+        reference = outputs["SingleFileData.create_normalized_list_decimal"]
+        identical = all(np.array_equal(a["array"], b["array"]) and np.array_equal(a["offsets"], b["offsets"])
+                        for a, b in zip(fixed_point, reference))
+        results["decimal_identical"] = identical
+        print("create_normalized_list() and create_normalized_list_decimal() give " +
+              ("identical results" if identical else "DIFFERENT results"))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+        print("Results written to " + args.output)
+
+    slower = []
+    if args.compare is not None:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+    return 1 if len(slower) > 0 or results.get("decimal_identical") is False else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_function())
@@ -0,0 +1,99 @@
+# Benchmark of the storage profiles of the HDF5 files (compression and chunking)
+# For every profile, writes minutes of cavities and comb data the way SingleFileData.write_to_file() stores them,
+# reads them back, and reports the write time, read time and file size.
+# The data is a synthetic minute that looks like the K&K counters output, or the first minute of real data files.
+#
+# Usage: python benchmarks/storage_profiles.py [-p gzip9 lzf ...] [-n 5] [-a cavities_file -m comb_file]
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gnomeptb as ptb
+from synthetic import synthetic_lines, cavi_sample, comb_sample, start_time
+
+
+def file_lines(path, num_lines):
+    with open(path) as f:
+        return [line for _, line in zip(range(num_lines), f)]
+
+
+def normalized_minute(cavi_lines, comb_lines):
+    """
+    Parse and normalize a minute of lines, like write_to_file() does
+    :return: tuple (cavities array, comb array)
+    """
+    cavi_batch = ptb.LineData(ptb.default_cavity_regex).parse_many(cavi_lines)
+    comb_batch = ptb.LineData(ptb.default_comb_regex).parse_many(comb_lines)
+    cavi_data = ptb.SingleFileData.create_normalized_list(cavi_batch[cavi_batch.success],
+                                                          ptb.analysis.cavi_columns_to_include)["array"]
+    comb_data = ptb.SingleFileData.create_normalized_list(comb_batch[comb_batch.success],
+                                                          ptb.analysis.comb_columns_to_include)["array"]
+    return cavi_data, comb_data
+
+
+def benchmark_profile(profile, cavi_data, comb_data, out_dir, repeats):
+    file_path = os.path.join(out_dir, profile + ".h5")
+    write_times = []
+    read_times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        with h5py.File(file_path, "w") as f:
+            f.create_dataset(ptb.SingleFileData.cavi_dataset_name, data=cavi_data,
+                             **ptb.SingleFileData.dataset_storage_options(cavi_data.shape, profile))
+            f.create_dataset(ptb.SingleFileData.comb_dataset_name, data=comb_data,
+                             **ptb.SingleFileData.dataset_storage_options(comb_data.shape, profile))
+        write_times.append(time.perf_counter() - t)
+
+        t = time.perf_counter()
+        with h5py.File(file_path, "r") as f:
+            cavi_read = f[ptb.SingleFileData.cavi_dataset_name][...]
+            comb_read = f[ptb.SingleFileData.comb_dataset_name][...]
+        read_times.append(time.perf_counter() - t)
+        if not (np.array_equal(cavi_read, cavi_data) and np.array_equal(comb_read, comb_data)):
+            raise RuntimeError("Data read back with profile " + profile + " is different from the data written")
+    return {"profile": profile, "write_s": statistics.median(write_times), "read_s": statistics.median(read_times),
+            "size_bytes": os.path.getsize(file_path)}
+
+
+def main_function():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--profiles", dest="profiles", nargs="+", default=sorted(ptb.SingleFileData.storage_profiles), help="Storage profiles to compare")
+    parser.add_argument("-n", "--repeats", dest="repeats", type=int, default=5, help="Number of times to write and read every file (the median time is reported)")
+    parser.add_argument("-a", "--cavityfile", dest="cavityfile", default=None, help="Cavities data file to take the first minute from (default: synthetic data)")
+    parser.add_argument("-m", "--combfile", dest="combfile", default=None, help="Comb data file to take the first minute from (default: synthetic data)")
+    args = parser.parse_args()
+
+    ptb.LineData.set_decimal_precision(30)
+    if args.cavityfile is not None:
+        cavi_lines = file_lines(args.cavityfile, 60*ptb.SingleFileData.cavi_sample_rate)
+    else:
+        cavi_lines = synthetic_lines(start_time, ptb.SingleFileData.cavi_sample_rate, cavi_sample, False, 1)
+    if args.combfile is not None:
+        comb_lines = file_lines(args.combfile, 60*ptb.SingleFileData.comb_sample_rate)
+    else:
+        comb_lines = synthetic_lines(start_time, ptb.SingleFileData.comb_sample_rate, comb_sample, True, 2)
+    cavi_data, comb_data = normalized_minute(cavi_lines, comb_lines)
+    print("Cavities data: " + str(cavi_data.shape) + ", comb data: " + str(comb_data.shape) +
+          ", raw size: " + str(cavi_data.nbytes + comb_data.nbytes) + " bytes")
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        results = [benchmark_profile(profile, cavi_data, comb_data, out_dir, args.repeats)
+                   for profile in args.profiles]
+
+    print("%-16s %10s %10s %12s %8s" % ("profile", "write (ms)", "read (ms)", "size (bytes)", "ratio"))
+    for r in results:
+        print("%-16s %10.2f %10.2f %12d %8.2f" % (r["profile"], 1000*r["write_s"], 1000*r["read_s"], r["size_bytes"],
+                                                (cavi_data.nbytes + comb_data.nbytes)/r["size_bytes"]))
+
+
+if __name__ == '__main__':
+    main_function()
+    sys.exit(0)
@@ -0,0 +1,54 @@
+# Synthetic data files for the benchmarks: lines like the output of the K&K counters, that match the default regular
+# expressions (cavities: 3 columns at 1 kHz; comb: status flags and 21 columns at 1 Hz).
+# The data is the same every time (fixed seeds), so results can be compared between runs.
+
+import datetime as dt
+
+import numpy as np
+
+cavi_sample = [30089915.15010000020, 8587663.48739999905, 0.0]
+comb_sample = [32365919.99990969900, 19999999.98439349980, 23359875.19833400100, 23572738.83385109900,
+               51320112.94533299650, 54701611.62395049630, 62468051.41144129630, 34201269.49379400160,
+               34999999.99953600020, 20000000.00156589970, 10000000.00132700060, 59725627.47657729680,
+               19999999.98443600160, 23359875.19851360100, 23572738.83431870120, 51320112.96735619750,
+               61425204.12941499800, 62468049.96998640150, 46581938.69217439740, 46581938.69214440140, 1.4414549]
+
+# the first line of the data, and the delay of the comb lines after the cavities lines of the same second
+start_time = dt.datetime(2016, 11, 1, 12, 0, 0, 2000)
+comb_delay = dt.timedelta(milliseconds=297)
+
+
+def synthetic_lines(start, sample_rate, values, with_flags, seed, seconds=60):
+    """
+    Generate lines of a K&K counter file: frequencies that drift slowly, with white noise. The first line of every
+    second is a sync point
+    :param start: time of the first line
+    :param sample_rate: lines per second
+    :param values: list of the mean values of the columns
+    :param with_flags: whether the lines have status flags (like the comb lines)
+    :param seed: seed of the random numbers
+    :param seconds: number of seconds of data
+    :return: list of lines (str), without line endings
+    """
+    rng = np.random.default_rng(seed)
+    n = seconds*sample_rate
+    drift = np.cumsum(rng.normal(0, 1e-3, (n, len(values))), axis=0)
+    data = np.array(values) + drift + rng.normal(0, 1e-2, (n, len(values)))
+    lines = []
+    for i in range(n):
+        t = start + dt.timedelta(seconds=i/sample_rate)
+        line = format(t, '%y%m%d') + ('*' if i % sample_rate == 0 else ' ') + format(t, '%H%M%S.%f')[:10]
+        if with_flags:
+            line += " FFFFFFFF"
+        lines.append(line + "".join(" %21.11f" % v for v in data[i]))
+    return lines
+
+
+def synthetic_files(seconds, cavi_sample_rate=1000, comb_sample_rate=1):
+    """
+    Generate the lines of a cavities file and of a comb file that cover the same time
+    :param seconds: number of seconds of data
+    :return: tuple (cavities lines, comb lines)
+    """
+    return (synthetic_lines(start_time, cavi_sample_rate, cavi_sample, False, 1, seconds),
+            synthetic_lines(start_time + comb_delay, comb_sample_rate, comb_sample, True, 2, seconds))
@@ -0,0 +1,28 @@
+#!/bin/bash
+
+import sys
+import argparse
+import ast
+import gnomeptb as ptb
+
+def export_function():
+    parser = argparse.ArgumentParser(description="Write the minute HDF5 files of the minutes in daily files (written with --archivedir)")
+    parser.add_argument("files", nargs="+", help="Daily files to export")
+    parser.add_argument("-do", "--outputdir", dest="outputdir", default="output", help="Output directory of files to be uploaded (HDF5 files)")
+    parser.add_argument("-sn", "--stationname", dest="stationname", default=None, help="Station name (default: the one of the daily files)")
+    parser.add_argument("-i", "--minutes", dest="minutes", default=None, help="Numbers of the minutes in the daily files to export, e.g. \"[0, 1, 2]\" (default: all of them)")
+    parser.add_argument("-ed", "--deriveddatasets", dest="deriveddatasets", action="store_true", help="Evaluate the channels of the main equation of the daily files over every minute, and write them to datasets of their own in the HDF5 files")
+    parser.add_argument("-sp", "--storageprofile", dest="storageprofile", default=ptb.SingleFileData.StorageProfile, choices=sorted(ptb.SingleFileData.storage_profiles), help="Compression and chunking of the datasets in the HDF5 files")
+
+    args = parser.parse_args()
+
+    ptb.SingleFileData.SetStorageProfile(args.storageprofile)
+    ptb.SingleFileData.SetDerivedDatasets(args.deriveddatasets)
+    indices = ast.literal_eval(args.minutes) if args.minutes is not None else None
+    for file_path in args.files:
+        written = ptb.daily.export_day(file_path, args.outputdir, args.stationname, indices)
+        print("Exported " + str(sum(p is not None for p in written)) + " minutes from " + file_path)
+
+if __name__ == '__main__':
+    export_function()
+    sys.exit(0)
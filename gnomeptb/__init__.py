@@ -1 +1,22 @@
-from gnomeptb.analysis import *
\ No newline at end of file
+from gnomeptb import analysis
+from gnomeptb.analysis import __version__, print_error, check_files, get_data, get_stream_data, read_mapped_files, \
+    read_mapped_stream_files, mkdir_p, DataCollection, StreamAligner, StreamBuffer, SingleFileData, LineData, LineBatch, \
+    MinuteBuffer, default_cavity_regex, default_comb_regex, default_streams
+from gnomeptb import streams
+from gnomeptb.streams import StreamDefinition, load_stations
+from gnomeptb import timestamps
+from gnomeptb import tokenizer
+from gnomeptb.tokenizer import FieldLayout
+from gnomeptb import pipeline
+from gnomeptb.pipeline import Pipeline, parser_pool, run_pipelines
+from gnomeptb import writer
+from gnomeptb.writer import WriterPool
+from gnomeptb import daily
+from gnomeptb.daily import DailyArchive
+from gnomeptb import journal
+from gnomeptb.journal import OffsetJournal
+from gnomeptb import metrics
+from gnomeptb.metrics import MetricsRegistry, MetricsExporter
+from gnomeptb import profiling
+from gnomeptb.profiling import Profiler
+from gnomeptb import equations
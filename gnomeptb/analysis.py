@@ -4,13 +4,26 @@ import decimal
 import numpy as np
 import copy
 import time
-import glob
 import os
 import sys
 import shutil
 import errno
+import collections
+import itertools
+import bisect
+import json
+import gzip
+import queue
+import threading
 import h5py
 
+from gnomeptb.chunks import get_compressor
+from gnomeptb.equations import parse_main_equation, evaluate_main_equation, normalize_channel
+from gnomeptb.fixedpoint import FixedPointArray
+from gnomeptb.streams import StreamDefinition, reference_stream
+from gnomeptb import timestamps
+from gnomeptb.tokenizer import FieldLayout
+from gnomeptb.tailing import FileWatcher, DirectoryWatcher, BlockLineReader, MappedFile, MappedLines, lower_io_priority
 
 
 __version__ = 0.1
@@ -21,173 +34,620 @@ decimal.getcontext().prec = 30
 comb_columns_to_include = [1, 2, 3, 4, 5, 6]
 cavi_columns_to_include = [0, 1, 2]
 
+# regular expressions of the lines of the K&K counters data files
+default_comb_regex = r"^(?P<year>\d{2})(?P<month>\d{2})(?P<day>\d{2})(?P<sync>(\*|\s+))(?P<hour>\d{2})(?P<min>\d{2})(?P<sec>\d{2})(?:.)(?P<msec>\d+)[(?:\s+)](?P<flags>[A-Z]{8})(?:\s+)(?P<f1>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)((?P<f2>(\-\d+|\d+)\.{0,1}\d*))(?:\s+)(?P<f3>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f4>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f5>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f6>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f7>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f8>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f9>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f10>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f11>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f12>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f13>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f14>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f15>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f16>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f17>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f18>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f19>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f20>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f21>(\-\d+|\d+)\.{0,1}\d*)(?:\s*)$"
+default_cavity_regex = r"^(?P<year>\d{2})(?P<month>\d{2})(?P<day>\d{2})(?P<sync>(\*|\s+))(?P<hour>\d{2})(?P<min>\d{2})(?P<sec>\d{2})(?:.)(?P<msec>\d+)(?:\s+)(?P<f1>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)((?P<f2>(\-\d+|\d+)\.{0,1}\d*))(?:\s+)(?P<f3>(\-\d+|\d+)\.{0,1}\d*)(?:\s*)$"
+
+
+def default_streams(cavity_regex=default_cavity_regex, comb_regex=default_comb_regex):
+    """
+    The streams of a station with a cavities counter and a comb counter, which are aligned on the sync points of the
+    cavities data. The columns to include are the ones of cavi_columns_to_include and comb_columns_to_include when the
+    streams are made
+    :param cavity_regex: regular expression of the cavities lines
+    :param comb_regex: regular expression of the comb lines
+    :return: list of StreamDefinition
+    """
+    return [StreamDefinition("cavi", cavity_regex, cavi_columns_to_include, SingleFileData.cavi_sample_rate,
+                             subdir="Cavities", dataset_name=SingleFileData.cavi_dataset_name, sync_reference=True),
+            StreamDefinition("comb", comb_regex, comb_columns_to_include, SingleFileData.comb_sample_rate,
+                             subdir="Comb", dataset_name=SingleFileData.comb_dataset_name)]
+
+
 def print_error(err):
     sys.stderr.write(str(err) + "\n")
     sys.stderr.flush()
 
 
+class PendingFiles:
+    """
+    An index of the data files that wait to be processed, in the sub-directories of the streams of a station (e.g. the
+    cavities and comb sub-directories), and of the sets of files of the same date (the first 6 characters of their
+    names), one of every stream
+    The directories are listed once; after that, the index is updated from the changes in them (see DirectoryWatcher),
+    so finding the next set doesn't list the directories again, however many files are in them.
+    Sets are ordered chronologically: the next set is the one of the file of the first stream (the cavities) with the
+    earliest date (and name), with the first file of the same date of every other stream.
+    """
+    date_length = 6  # characters of the names of the files with the date (yymmdd)
+
+    def __init__(self, workdir, subdirs, use_inotify=True):
+        """
+        :param workdir: the working absolute dir (the one that contains the sub-directories)
+        :param subdirs: dict of the sub-directories of the streams, by stream name; the files of the first stream
+                        are the ones the others are matched to
+        :param use_inotify: whether to use inotify to find changes in the directories
+        """
+        self.dirs = {name: os.path.join(workdir, subdir) for name, subdir in subdirs.items()}
+        if len(set(self.dirs.values())) != len(self.dirs):
+            raise ValueError("The streams of a station must have sub-directories of their own, got: " + str(subdirs))
+        self.first_stream = next(iter(self.dirs))
+        self.streams_by_dir = {directory: name for name, directory in self.dirs.items()}
+        self.watcher = DirectoryWatcher(list(self.dirs.values()), "*.txt", use_inotify)
+        self.files = {name: {} for name in self.dirs}  # stream -> date -> sorted list of names of the files
+        self.skipped = set()  # paths of files that are taken out of the index, until they're removed (see skip())
+        for directory, names in self.watcher.files.items():
+            for name in names:
+                self._update(directory, name, True)
+
+    def _update(self, directory, name, added):
+        path = os.path.join(directory, name)
+        if path in self.skipped:
+            if not added:
+                self.skipped.discard(path)
+            return
+        files = self.files[self.streams_by_dir[directory]]
+        names = files.setdefault(name[:PendingFiles.date_length], [])
+        if added:
+            bisect.insort(names, name)
+        else:
+            names.remove(name)
+            if len(names) == 0:
+                del files[name[:PendingFiles.date_length]]
+
+    def update(self, timeout=0):
+        """
+        Apply the changes in the directories to the index
+        :param timeout: maximum time to wait for changes, in seconds
+        :return: whether anything changed
+        """
+        changes = self.watcher.wait(timeout)
+        for directory, name, added in changes:
+            self._update(directory, name, added)
+        return len(changes) > 0
+
+    def next_files(self):
+        """
+        :return: dict with the path of the next file of every stream ("<stream>_file"; None for the streams whose file
+                 of the date of the next file of the first stream doesn't exist yet), and the number of files of the
+                 first stream ("num_files"), or None if there are no files of the first stream
+        """
+        first_files = self.files[self.first_stream]
+        if len(first_files) == 0:
+            return None
+        date = min(first_files)
+        result = {}
+        for stream, directory in self.dirs.items():
+            names = self.files[stream].get(date, [])
+            result[stream + "_file"] = os.path.join(directory, names[0]) if len(names) > 0 else None
+        result["num_files"] = sum(map(len, first_files.values()))
+        return result
+
+    def wait_next_files(self, timeout=None):
+        """
+        Wait until the next set of files is available, with a file of every stream (see next_files())
+        :param timeout: maximum time to wait in seconds (default: no limit)
+        :return: a dict like the one of next_files(), or None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.update()
+        while True:
+            files = self.next_files()
+            missing = [stream for stream in self.dirs if files is not None and files[stream + "_file"] is None]
+            if files is not None and len(missing) == 0:
+                return files
+            if files is None:
+                print_error("Unable to find any " + self.first_stream + " files... waiting for them")
+            else:
+                file_match = os.path.basename(files[self.first_stream + "_file"])[:PendingFiles.date_length] + '*.txt'
+                print_error("Unable to find " + ", ".join(missing) + " files that match " + file_match +
+                            "... waiting for them")
+
+            # wait for files to be added (the message is repeated every few seconds while nothing changes)
+            to_wait = 5  # seconds
+            if deadline is not None:
+                to_wait = min(to_wait, deadline - time.monotonic())
+                if to_wait <= 0:
+                    return None
+            self.update(to_wait)
+
+    def skip(self, file_paths):
+        """
+        Take files out of the index, so that they're not among the next files, although they're still in the
+        directories (e.g. files that are read, but are moved away only later, see FileRetirement)
+        :param file_paths: list of paths of files in the index
+        :return: None
+        """
+        for file_path in file_paths:
+            directory, name = os.path.split(file_path)
+            self._update(directory, name, False)
+            self.skipped.add(file_path)
+
+    def close(self):
+        self.watcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def check_files(workdir, cavity_subdir, comb_subdir):
     """
     Checks for available data files in cavities and comb subdirectories
-    It starts by looking in cavities, and then tries to find the equivalent comb file
+    It starts by looking in cavities, and then tries to find the equivalent comb file (see PendingFiles)
     On failure, it keeps waiting until a file is available
     :param workdir: the working absolute dir (the one that contains the comb and cavities directries)
     :param cavity_subdir: sub-directory of cavities data
     :param comb_subdir: sub-directory of comb data
     :return: a dict that contains the files found
     """
+    with PendingFiles(workdir, {"cavi": cavity_subdir, "comb": comb_subdir}) as pending:
+        files = pending.wait_next_files()
+        comb_date = os.path.basename(files["comb_file"])[:PendingFiles.date_length]
+        return {"cavity_file": files["cavi_file"], "comb_file": files["comb_file"],
+                "num_comb_files": len(pending.files["comb"][comb_date]), "num_cavity_files": files["num_files"]}
 
-    # try to find cavities files
-    cavi_files_paths = glob.glob(os.path.join(workdir, cavity_subdir, '*.txt'))
-    while len(cavi_files_paths) == 0:
-        cavi_files_paths = glob.glob(os.path.join(workdir, cavity_subdir, '*.txt'))
-        to_wait = 5  # seconds
-        print_error("Unable to find any cavity files... trying again in " + str(to_wait) + " seconds")
-        time.sleep(to_wait)
-    chosen_cavi_file = cavi_files_paths[0]
-
-    # matching comb file will have 6 chars of time then "anything"
-    cavity_file_match = os.path.basename(chosen_cavi_file)[:6]+'*.txt'
-
-    # try to find corresponding comb file
-    comb_files_paths = glob.glob(os.path.join(workdir, comb_subdir, cavity_file_match))
-    while len(comb_files_paths) == 0:
-        comb_files_paths = glob.glob(os.path.join(workdir, comb_subdir, cavity_file_match))
-        to_wait = 5  # seconds
-        print_error("Unable to find comb files that match " + cavity_file_match + "... trying again in " + str(to_wait) + " seconds.")
-        time.sleep(to_wait)
-    chosen_comb_file = comb_files_paths[0]
-    return {"comb_file": chosen_comb_file, "cavity_file": chosen_cavi_file,
-            "num_comb_files": len(comb_files_paths), "num_cavity_files": len(cavi_files_paths)}
 
-
-def get_data(workdir, cavity_subdir, comb_subdir, finished_subdir, max_queue_size = 250000):
+def get_data(workdir, cavity_subdir, comb_subdir, finished_subdir, max_queue_size = 250000, wait_timeout = 1,
+             journal = None, compress_finished = False):
     """
     a generator of all the available data from both the comb and cavities files
+    When no new data is available, it waits for the files to change (see FileWatcher), and yields as soon as
+    a new line is written. An empty result is yielded only if nothing is written for wait_timeout seconds
     :param workdir: the working absolute dir (the one that contains the comb and cavities directries)
     :param cavity_subdir: sub-directory of cavities data
     :param comb_subdir: sub-directory of comb data
     :param finished_subdir: the sub-directory, to which files has to be moved after it's processed
-    :return: a generator of a dict, whose values are lists of the data available in the file until now
+    :param max_queue_size: maximum number of lines of each file to yield at once
+    :param wait_timeout: time in seconds to wait for new data, before yielding an empty result
+    :param journal: OffsetJournal that the minutes are recorded in, if any. The first files are read from where the
+                    previous run got to in them, and files are moved to the "finished" sub-directory only once the
+                    journal has the minutes of all their lines (see FileRetirement)
+    :param compress_finished: whether to compress the files in the "finished" sub-directory (see FileRetirement)
+    :return: a generator of a dict, whose values are the lines available in the files until now (as MappedLines),
+             and the byte offsets in the files past these lines
+    """
+    return get_stream_data(workdir, {"cavi": cavity_subdir, "comb": comb_subdir}, finished_subdir, max_queue_size,
+                           wait_timeout, journal, compress_finished)
+
+
+def get_stream_data(workdir, subdirs, finished_subdir, max_queue_size=250000, wait_timeout=1, journal=None,
+                    compress_finished=False):
+    """
+    a generator of all the available data from the files of the streams of a station, like get_data() for any number
+    of streams. Files of the same date are read together (see PendingFiles)
+    :param workdir: the working absolute dir (the one that contains the sub-directories of the streams)
+    :param subdirs: dict of the sub-directories of the streams, by stream name (e.g. {"cavi": "Cavities",
+                    "comb": "Comb"}); the files of the other streams are matched to the ones of the first stream
+    :param finished_subdir: the sub-directory, to which files has to be moved after it's processed
+    :param max_queue_size: maximum number of lines of each file to yield at once
+    :param wait_timeout: time in seconds to wait for new data, before yielding an empty result
+    :param journal: OffsetJournal that the minutes are recorded in, if any (see get_data())
+    :param compress_finished: whether to compress the files in the "finished" sub-directory (see FileRetirement)
+    :return: a generator of a dict with the lines available in the file of every stream until now ("<stream>_queue",
+             as MappedLines), the paths of the files ("<stream>_file"), the byte offsets in the files past these lines
+             ("<stream>_offset"), and whether there are no lines at all ("empty")
     """
+    streams = list(subdirs)
+
+    # files that were being moved when the program stopped are moved first, so that they're not read again
+    retirement = FileRetirement(workdir, finished_subdir, compress_finished, journal,
+                                FileRetirement.record_name_for(subdirs))
+    retirement.resume()
+    pending = PendingFiles(workdir, subdirs)
+    resume_journal = journal
 
     #
     while True:
-        # get the first available, equivalent files (time-wise)
-        files = check_files(workdir, cavity_subdir, comb_subdir)
-        comb_file_path = files["comb_file"]
-        cavi_file_path = files["cavity_file"]
-
-        # open the files
-        fcomb = open(comb_file_path)
-        fcavi = open(cavi_file_path)
-        print("File open:", comb_file_path)
-        print("File open:", cavi_file_path)
+        # get the first available, equivalent files (time-wise), moving the ones that are processed meanwhile
+        files = None
+        while files is None:
+            retirement.retire_processed()
+            files = pending.wait_next_files(timeout=5)
+        file_paths = {stream: files[stream + "_file"] for stream in streams}
 
         # time to wait, before giving up that no new data will be added to the current file
         timeout_recheck_new_files = 30
 
-        # last time I found something in the files
-        last_time = dt.datetime.now()
+        # files that were not modified for a while are complete, and are read by mapping them to memory
+        offsets = {stream: 0 for stream in streams} if resume_journal is None else \
+            resume_journal.resume_stream_offsets(file_paths)
+        resume_journal = None
+        last_modification_time = dt.datetime.fromtimestamp(max(map(os.path.getmtime, file_paths.values())))
+        files_completed = dt.datetime.now() - last_modification_time > dt.timedelta(seconds=timeout_recheck_new_files)
+        if files_completed:
+            for file_path in file_paths.values():
+                print("File mapped:", file_path)
+            for mapped_data in read_mapped_stream_files(file_paths, max_queue_size, offsets):
+                offsets = {stream: mapped_data[stream + "_offset"] for stream in streams}
+                yield mapped_data
+
+        # open the files
+        readers = {stream: BlockLineReader(file_paths[stream], offsets[stream]) for stream in streams}
+        watcher = FileWatcher(list(file_paths.values()))
+        for file_path in file_paths.values():
+            print("File open:", file_path)
+
+        # last time I found something in the files (for completed files, the last time they were written)
+        last_time = last_modification_time if files_completed else dt.datetime.now()
 
         # keep reading the file (and yield in the middle)
         while True:
-            cavi_queue = []
-            # keep reading until no lines are found or max size is reached (to prevent memory overflow)
-            while len(cavi_queue) < max_queue_size:
-                cavi_line = next(tail_line(fcavi))
-                if cavi_line is None:
-                    break
-                else:
-                    cavi_queue.append(cavi_line.replace("\n", ""))
-                    last_time = dt.datetime.now()
-            comb_queue = []
             # keep reading until no lines are found or max size is reached (to prevent memory overflow)
-            while len(comb_queue) < max_queue_size:
-                comb_line = next(tail_line(fcomb))
-                if comb_line is None:
-                    break
-                else:
-                    comb_queue.append(comb_line.replace("\n", ""))
-                    last_time = dt.datetime.now()
+            queues = {stream: readers[stream].read_buffer(max_queue_size) for stream in streams}
+            empty = all(len(lines) == 0 for lines in queues.values())
+            if not empty:
+                last_time = dt.datetime.now()
 
-            if len(cavi_queue) == 0 and len(comb_queue) == 0:
+            if empty:
                 # if no data was found for some time (=timeout_recheck_new_files), close the files, and try to move them
                 if dt.datetime.now() - last_time > dt.timedelta(seconds=timeout_recheck_new_files):
                     # keep record of the last position
-                    fcomb_ptr = fcomb.tell()
-                    fcavi_ptr = fcavi.tell()
-                    fcomb.close()
-                    fcavi.close()
-
-                    # prepare the "finished" sub-directory
-                    new_comb_dir = os.path.join(os.path.dirname(comb_file_path), finished_subdir)
-                    mkdir_p(new_comb_dir)
-                    new_comb_file_path = os.path.join(new_comb_dir, os.path.basename(comb_file_path))
-
-                    new_cavi_dir = os.path.join(os.path.dirname(cavi_file_path), finished_subdir)
-                    mkdir_p(new_cavi_dir)
-                    new_cavi_file_path = os.path.join(new_cavi_dir, os.path.basename(cavi_file_path))
+                    offsets = {stream: readers[stream].offset for stream in streams}
+                    for reader in readers.values():
+                        reader.close()
+
+                    if journal is not None:
+                        # the lines may not be written yet, so the files are moved once the journal has them, and
+                        # meanwhile the next files are read
+                        retirement.retire_when_processed(file_paths, offsets)
+                        pending.skip(list(file_paths.values()))
+                        watcher.close()
+                        break
 
                     # move the files to the "finished" sub-directory
                     try:
-                        shutil.copy(comb_file_path, new_comb_file_path)
-                        shutil.copy(cavi_file_path, new_cavi_file_path)
-                    except Exception as e:
+                        retirement.retire(list(file_paths.values()))
+                    except OSError as e:
                         # if the movement of the files failed, reopen them and try to read them further
-                        try:
-                            os.remove(new_comb_file_path)
-                            os.remove(new_cavi_file_path)
-                        except:
-                            pass
-
-                        print_error("Unable to copy files after having read them. "
+                        print_error("Unable to move files after having read them. "
                                     "Assuming the file is still being used. Exception says: " + str(e))
-                        fcomb = open(comb_file_path)
-                        fcavi = open(cavi_file_path)
-
                         # restore the last pointer position
-                        fcomb.seek(fcomb_ptr)
-                        fcavi.seek(fcavi_ptr)
+                        readers = {stream: BlockLineReader(file_paths[stream], offsets[stream]) for stream in streams}
                         continue
-
-                    try:
-                        os.remove(comb_file_path)
-                        os.remove(cavi_file_path)
-
-                    except Exception as e:
-                        print_error(
-                            "SEVERE ERROR: Unable to delete files after having read them. This is very dangerous, "
-                            "as it may lead to the file being read more than once. Exception says: " + str(e))
-                        raise
+                    watcher.close()
 
                     # break to read the next file
                     break
 
-            # return the lines found in queues
-            yield {"cavi_queue": cavi_queue, "comb_queue": comb_queue,
-                   "empty": True if (len(cavi_queue) == 0 and len(comb_queue) == 0) else False}
+                # wait for something to be written in the files, and read it right away
+                if watcher.wait(wait_timeout):
+                    continue
+
+            # return the lines found in queues, and the position in the files past them
+            data_queues = {"empty": empty}
+            for stream in streams:
+                data_queues[stream + "_queue"] = queues[stream]
+                data_queues[stream + "_file"] = file_paths[stream]
+                data_queues[stream + "_offset"] = readers[stream].offset
+            yield data_queues
 
             # if returning back from a non-empty submission of data, reset counter
-            if not (len(cavi_queue) == 0 and len(comb_queue) == 0):
+            if not empty:
                 last_time = dt.datetime.now()
+            retirement.retire_processed()
+
+
+def read_mapped_files(cavi_file_path, comb_file_path, max_queue_size=250000, cavi_offset=0, comb_offset=0):
+    """
+    a generator of all the lines of a pair of cavities and comb files that are no longer being written. The files are
+    mapped to memory and the lines are parsed from there, without reading them
+    :param cavi_file_path: path of the cavities file
+    :param comb_file_path: path of the comb file
+    :param max_queue_size: maximum number of lines of each file to yield at once
+    :param cavi_offset: byte position in the cavities file to start from
+    :param comb_offset: byte position in the comb file to start from
+    :return: a generator of dicts like the ones of get_data()
+    """
+    return read_mapped_stream_files({"cavi": cavi_file_path, "comb": comb_file_path}, max_queue_size,
+                                    {"cavi": cavi_offset, "comb": comb_offset})
 
 
-def tail_line(file):
+def read_mapped_stream_files(file_paths, max_queue_size=250000, offsets=None):
     """
-        read last line, closes file and returns, if file is no longer the newest one
-    :param file: file object
-    :return:  yields the line that was read from the file
+    a generator of all the lines of the files of the streams of a station that are no longer being written, like
+    read_mapped_files() for any number of streams
+    :param file_paths: dict of the paths of the files, by stream name
+    :param max_queue_size: maximum number of lines of each file to yield at once
+    :param offsets: dict of the byte positions in the files to start from, by stream name (default: the beginning)
+    :return: a generator of dicts like the ones of get_stream_data()
     """
+    offsets = dict(offsets or {stream: 0 for stream in file_paths})
+    mapped_files = {stream: MappedFile(file_path, offsets[stream]) for stream, file_path in file_paths.items()}
+    chunks = {stream: mapped.chunks(max_queue_size) for stream, mapped in mapped_files.items()}
+    empty = MappedLines(b"", np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    # chunks of all the files are given together, and the files with fewer lines (e.g. the comb file) run out first
     while True:
-        where = file.tell()  # get current pointer position
-        line = file.readline()
-        if not line or line[-1] != '\n':  # if no line is found OR the line doesn't end with \n (so, incomplete line)
-            time.sleep(10e-3)
-            file.seek(where)
-            yield None
-        else:
-            yield line
+        data_queues = {"empty": False}
+        exhausted = True
+        for stream, stream_chunks in chunks.items():
+            queue, offset = next(stream_chunks, (empty, offsets[stream]))
+            exhausted = exhausted and queue is empty
+            offsets[stream] = offset
+            data_queues[stream + "_queue"] = queue
+            data_queues[stream + "_file"] = file_paths[stream]
+            data_queues[stream + "_offset"] = offset
+        if exhausted:
+            break
+        yield data_queues
+    for mapped in mapped_files.values():
+        mapped.close()
+
+
+class FileRetirement:
+    """
+    Moves the data files that are completely processed to the "finished" sub-directory next to them
+    Files are moved by renaming them, which takes no time however large the files are. Only when the "finished"
+    directory is on another file system, they are copied (and the copy is made durable before the original is
+    deleted).
+    The moves that are being done are recorded in a file in the working directory before they are started, and the
+    record is removed once they're all done. A retirement that is interrupted (e.g. by a crash, or because only one of
+    the files could be moved) is completed when the program starts again (see resume()), so files are never processed
+    a second time.
+    With a journal, files that are read are moved only once the journal has the minutes of all their lines (see
+    retire_when_processed()), so a crash before their minutes are written doesn't lose them: the files are still where
+    the journal resumes from. Until then, they're recorded in the same file.
+    Optionally, the finished files are compressed with gzip afterwards, by a thread with the lowest I/O priority. These
+    compressions are recorded in the same file, until they're done.
+    """
+    record_name = "gnomeptb_retirement.json"
+    compression_level = 6
+
+    def __init__(self, workdir, finished_subdir, compress=False, journal=None, record_name=None):
+        """
+        :param workdir: the working directory, where the record is kept
+        :param finished_subdir: the sub-directory, to which files are moved
+        :param compress: whether to compress the files after they're moved
+        :param journal: OffsetJournal that the minutes are recorded in, if any (see retire_when_processed())
+        :param record_name: name of the record file (default: record_name)
+        """
+        self.record_path = os.path.join(workdir, record_name or FileRetirement.record_name)
+        self.finished_subdir = finished_subdir
+        self.compress = compress
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.moves = []  # list of [source, destination] of the moves being done
+        # files that are read, waiting for the journal to have their lines, in the order they were read: list of
+        # {"files": {stream: path}, "offsets": {stream: byte position past the lines that were read}}
+        self.processed = []
+        self.compressions = []  # paths of finished files that are not compressed yet
+        self.compression_queue = queue.Queue()
+        self.compression_thread = None
+
+    @staticmethod
+    def record_name_for(subdirs):
+        """
+        :param subdirs: dict of the sub-directories of the streams of a station, by stream name
+        :return: name of the record of the files of a station, which is named after its sub-directories, so that
+                 stations that share the working directory have records of their own
+        """
+        return "gnomeptb_retirement_" + "_".join(subdirs.values()) + ".json"
+
+    def finished_path(self, file_path):
+        """
+        :param file_path: path of a data file
+        :return: path of the file in the "finished" sub-directory
+        """
+        return os.path.join(os.path.dirname(file_path), self.finished_subdir, os.path.basename(file_path))
+
+    def _save(self):
+        """
+        Write the record of the moves and compressions that are not done yet, or remove it if there are none
+        """
+        if len(self.moves) == 0 and len(self.compressions) == 0 and len(self.processed) == 0:
+            try:
+                os.remove(self.record_path)
+            except FileNotFoundError:
+                pass
+            return
+        temp_path = os.path.join(os.path.dirname(self.record_path), "." + os.path.basename(self.record_path) + ".tmp")
+        with open(temp_path, "w") as f:
+            json.dump({"moves": self.moves, "compressions": self.compressions, "processed": self.processed}, f,
+                      indent=1)
+        publish_file(temp_path, self.record_path)
+
+    def resume(self):
+        """
+        Complete the retirements that were interrupted, as recorded in the record of a previous run, and move the files
+        that it read whose lines are in the journal now. The other files it read are read again, from where the journal
+        resumes
+        :return: None
+        """
+        try:
+            with open(self.record_path) as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.moves = record.get("moves", [])
+            self.compressions = record.get("compressions", [])
+            self.processed = record.get("processed", [])
+        for source, destination in self.moves:
+            if os.path.exists(source):
+                print("Completing the interrupted move of " + source + " to " + destination)
+                mkdir_p(os.path.dirname(destination))
+                move_file(source, destination)
+        with self.lock:
+            self.moves = []
+            self._save()
+        for file_path in list(self.compressions):
+            self._start_compression(file_path)
+        self.retire_processed()
+        with self.lock:
+            self.processed = []
+            self._save()
+
+    def retire_when_processed(self, file_paths, offsets):
+        """
+        Move files that are read to the "finished" sub-directory once the journal has the minutes of all the lines that
+        were read in them (see retire_processed()). Without a journal, they're moved right away
+        :param file_paths: dict of the paths of the files, by stream name
+        :param offsets: dict of the byte positions in the files past the lines that were read, by stream name
+        :return: None
+        """
+        with self.lock:
+            self.processed.append({"files": dict(file_paths), "offsets": dict(offsets)})
+            self._save()
+        self.retire_processed()
+
+    def retire_processed(self):
+        """
+        Move the files that are read and whose lines are all in the journal, in the order they were read. Files that
+        can't be moved are tried again the next time
+        :return: None
+        """
+        while len(self.processed) > 0:
+            files = self.processed[0]
+            if self.journal is not None and not self.journal.is_past(files["files"], files["offsets"]):
+                return
+            try:
+                self.retire(list(files["files"].values()))
+            except OSError as e:
+                print_error("Unable to move files after their minutes were written. They're moved later. "
+                            "Exception says: " + str(e))
+                return
+            with self.lock:
+                self.processed.pop(0)
+                self._save()
+
+    def retire(self, file_paths):
+        """
+        Move files to the "finished" sub-directory. Either all of them are moved, or, if one can't be moved (e.g.
+        because it's still being used), none
+        :param file_paths: list of paths of the files
+        :return: list of the new paths of the files
+        :raise OSError: if the files couldn't be moved; the files are where they were
+        :raise RuntimeError: if the files couldn't be moved, and the ones that were moved couldn't be moved back
+        """
+        moves = [[file_path, self.finished_path(file_path)] for file_path in file_paths]
+        with self.lock:
+            self.moves = moves
+            self._save()
+
+        moved = []
+        try:
+            for source, destination in moves:
+                mkdir_p(os.path.dirname(destination))
+                move_file(source, destination)
+                moved.append((source, destination))
+        except OSError:
+            # put back the files that were moved, so that all of them are read further
+            try:
+                for source, destination in reversed(moved):
+                    move_file(destination, source)
+            except OSError as e:
+                # the record stays, so the files are moved when the program starts again
+                raise RuntimeError("SEVERE ERROR: Unable to move back files after moving other files failed. "
+                                   "Exception says: " + str(e)) from e
+            with self.lock:
+                self.moves = []
+                self._save()
+            raise
+
+        destinations = [destination for _, destination in moves]
+        with self.lock:
+            self.moves = []
+            if self.compress:
+                self.compressions.extend(destinations)
+            self._save()
+        if self.compress:
+            for destination in destinations:
+                self._start_compression(destination)
+        return destinations
+
+    def _start_compression(self, file_path):
+        if self.compression_thread is None:
+            self.compression_thread = threading.Thread(target=self._compress_files, name="file-compressor",
+                                                       daemon=True)
+            self.compression_thread.start()
+        self.compression_queue.put(file_path)
+
+    def _compress_files(self):
+        lower_io_priority()
+        while True:
+            file_path = self.compression_queue.get()
+            try:
+                compress_file(file_path, FileRetirement.compression_level)
+            except OSError as e:
+                print_error("Unable to compress the finished file " + file_path + ". Exception says: " + str(e))
+                continue
+            with self.lock:
+                self.compressions.remove(file_path)
+                self._save()
+
+
+def move_file(source, destination):
+    """
+    Move a file by renaming it, or, if the destination is on another file system, by copying it. A copy is made
+    durable and given its final name atomically before the source is deleted, so the destination is never incomplete
+    :param source: path of the file
+    :param destination: new path of the file
+    :return: None
+    """
+    try:
+        os.replace(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temp_path = os.path.join(os.path.dirname(destination), "." + os.path.basename(destination) + ".tmp")
+    shutil.copy2(source, temp_path)
+    publish_file(temp_path, destination)
+    os.remove(source)
+
+
+def compress_file(file_path, level=6):
+    """
+    Replace a file with a gzip compressed copy of it (with .gz added to its name)
+    If the file was compressed already (but not removed), it's only removed
+    :param file_path: path of the file
+    :param level: gzip compression level
+    :return: path of the compressed file
+    """
+    compressed_path = file_path + ".gz"
+    if not os.path.exists(file_path) and os.path.exists(compressed_path):
+        return compressed_path
+    temp_path = os.path.join(os.path.dirname(file_path), "." + os.path.basename(compressed_path) + ".tmp")
+    with open(file_path, "rb") as source, gzip.open(temp_path, "wb", compresslevel=level) as destination:
+        shutil.copyfileobj(source, destination, 1 << 20)
+    publish_file(temp_path, compressed_path)
+    os.remove(file_path)
+    return compressed_path
+
+
+def publish_file(temp_path, file_path):
+    """
+    Make a completely written file durable, and give it its final name atomically
+    :param temp_path: the temporary path the file was written to
+    :param file_path: the final path of the file
+    :return: None
+    """
+    with open(temp_path, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, file_path)
+    # make the rename itself durable. Directories can't be opened on Windows, where this isn't needed
+    try:
+        dir_fd = os.open(os.path.dirname(file_path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
 
 
 def mkdir_p(path):
@@ -205,133 +665,404 @@ def mkdir_p(path):
             raise
 
 
-class DataCollection:
+class StreamAligner:
     """
-    A class that takes lines of data, and processes them and writes them to HDF5 files
+    A class that takes lines of any number of data streams, and processes them and writes them to HDF5 files.
+    The lines of every stream are parsed, and aligned in time on the sync points of the sync reference: every second
+    between two of its sync points is given to the file writer together with the lines of the other streams in the
+    same time window
     """
-    def __init__(self, cavi_regex_str, comb_regex_str, data_output_dir, station_name):
-        self.comb_queue = []
-        self.cavi_queue = []
-        self.comb_processed_queue = []
-        self.cavi_processed_queue = []
-        self.cavi_line_data = LineData(cavi_regex_str)
-        self.comb_line_data = LineData(comb_regex_str)
+    def __init__(self, streams, data_output_dir, station_name):
+        """
+        :param streams: list of StreamDefinition
+        :param data_output_dir: output directory of the HDF5 files
+        :param station_name: station name
+        """
+        self.streams = list(streams)
+        self.reference = reference_stream(self.streams)
+        self.queues = {stream.name: [] for stream in self.streams}
+        self.line_data = {stream.name: LineData(stream.regex) for stream in self.streams}
+        # the streams that are matched to the sync reference are looked up by time
+        self.processed_queues = {stream.name: StreamBuffer(self.line_data[stream.name].num_data_columns(),
+                                                           time_index=stream is not self.reference)
+                                 for stream in self.streams}
         self.data_output_dir = data_output_dir
-        self.file_writer = SingleFileData(data_output_dir, station_name)
+        self.file_writer = SingleFileData(data_output_dir, station_name, streams=self.streams)
         self.station_name = station_name
 
-    def append_comb_data(self, data):
+    @staticmethod
+    def _append_to_queue(queue, data):
+        """
+        Add lines to a queue of lines to be parsed. The queue is a list of pieces, each of which is either a list of
+        lines (str or bytes), or a MappedLines object (lines in a mapped file, that are parsed in place)
+        :param queue: the queue
+        :param data: a line, a list of lines, or MappedLines
+        :return: None
+        """
+        if isinstance(data, MappedLines):
+            queue.append(data)
+            return
+        if len(queue) == 0 or isinstance(queue[-1], MappedLines):
+            queue.append([])
         if type(data) == list:
-            self.comb_queue.extend(data)
+            queue[-1].extend(data)
 
         else:
-            self.comb_queue.append(data)
+            queue[-1].append(data)
 
-    def append_cavi_data(self, data):
-        if type(data) == list:
-            self.cavi_queue.extend(data)
+    @staticmethod
+    def _parse_queue(line_data, queue):
+        """
+        Parse all the lines in a queue (see _append_to_queue())
+        :param line_data: LineData object to parse with
+        :param queue: the queue
+        :return: list of LineBatch, in the order of the queue
+        """
+        return [line_data.parse_buffer(piece) if isinstance(piece, MappedLines) else line_data.parse_many(piece)
+                for piece in queue]
 
-        else:
-            self.cavi_queue.append(data)
+    def append_data(self, stream_name, data):
+        StreamAligner._append_to_queue(self.queues[stream_name], data)
+
+    def append_parsed(self, stream_name, batch):
+        """
+        Add lines of a stream that are already parsed (e.g. in another process), to be aligned with align()
+        :param stream_name: name of the stream
+        :param batch: LineBatch
+        :return: None
+        """
+        self.processed_queues[stream_name].append(batch)
+
+    def resume_positions(self, positions):
+        """
+        Where to resume reading the files from, after a restart, to get back to the state in which the lines before
+        the given positions were processed, and the ones from them on weren't (see OffsetJournal)
+        :param positions: dict of the positions of the first lines that are not processed, by stream name
+        :return: dict with the paths of the files ("<stream>_file") and the byte positions in them
+                 ("<stream>_offset"), or None if they're not known
+        """
+        state = {}
+        for name, position in positions.items():
+            file_position = self.processed_queues[name].file_position(position)
+            if file_position is None:
+                return None
+            state[name + "_file"], state[name + "_offset"] = file_position
+        return state
 
     def process_data(self):
 
-        # parse lines in the queue
-        self.comb_queue = [s.replace("\r", "").replace("\n", "") for s in self.comb_queue]
-        self.cavi_queue = [s.replace("\r", "").replace("\n", "") for s in self.cavi_queue]
-        self.comb_queue = list(filter(None, self.comb_queue))
-        self.cavi_queue = list(filter(None, self.cavi_queue))
+        # parse lines in the queues, all at once, to columns
+        for stream in self.streams:
+            for parsed_data in StreamAligner._parse_queue(self.line_data[stream.name], self.queues[stream.name]):
+                self.append_parsed(stream.name, parsed_data)
+            self.queues[stream.name] = []
+        self.align()
 
-        parsed_comb_data = [0]*len(self.comb_queue)
-        parsed_cavi_data = [0]*len(self.cavi_queue)
-        for i in range(len(self.comb_queue)):
-            try:
-                self.comb_line_data.parse_line(self.comb_queue[i])
-                parsed_comb_data[i] = copy.copy(self.comb_line_data)
-            except re.error as e:
-                print_error(str(e))
-                parsed_comb_data[i] = LineData()
+    def align(self):
+        """
+        Match the parsed lines of the streams in time, and give every matched second (the lines between two sync
+        points of the sync reference) to the file writer
+        :return: None
+        """
+        reference_queue = self.processed_queues[self.reference.name]
+        others = [stream for stream in self.streams if stream is not self.reference]
+        # look up the lines of the other streams of all the complete batches of the reference (between every two sync
+        # points) at once
+        sync_points = list(reference_queue.sync_points)
+        sync_times = np.array(reference_queue.sync_times, dtype="datetime64[us]")
+        index_ranges = {stream.name: self.processed_queues[stream.name].find_time_ranges(sync_times[:-1],
+                                                                                         sync_times[1:])
+                        for stream in others}
+
+        # every iteration emits the batch between the next two sync points, or drops it if it can't be matched
+        for k in range(len(sync_points) - 1):
+            batch_begin = sync_points[k]
+            batch_end = sync_points[k+1]  # the point past the last point
+
+            # points in the other streams that correspond to the reference data (and were not dropped by previous
+            # batches)
+            ranges = {stream.name: self.processed_queues[stream.name].index_range_to_positions(
+                index_ranges[stream.name][0][k], index_ranges[stream.name][1][k]) for stream in others}
+            missing = [stream for stream in others if ranges[stream.name] is None]
+
+            # if no corresponding points in time were found in a stream, return
+            # (so that more data can be brought next time)
+            if len(missing) > 0:
+                # if a stream has 60 seconds of data, delete the reference data as no match of it will be found
+                # this is necessary in case the reference data recording started before the other stream's
+                if any(len(self.processed_queues[stream.name]) > 60*stream.sample_rate for stream in missing):
+                    reference_queue.drop_until(batch_end)
+                    continue
+                return
+            ranges[self.reference.name] = (batch_begin, batch_end)
+
+            # lines that failed parsing carry no data, so only the successful ones go to the file
+            batches = []
+            for stream in self.streams:
+                batch = self.processed_queues[stream.name].get(*ranges[stream.name])
+                batches.append(batch[batch.success])
+            # the aligner carries nothing over from a complete minute but the lines after it, so a minute that ends
+            # with this batch can be resumed from where they are in the files
+            self.file_writer.resume_state = self.resume_positions({stream.name: ranges[stream.name][1]
+                                                                   for stream in self.streams})
+            self.file_writer.append_batch(*batches)
+
+            # delete the parts of the queues that are used/skipped
+            # the reason for starting from the beginning is to remove additional data that was not matched before
+            # ideally, the beginnings of all the ranges are the first lines in the queues
+            for name, (_, end) in ranges.items():
+                self.processed_queues[name].drop_until(end)
+
+
+class DataCollection(StreamAligner):
+    """
+    A class that takes lines of data of the cavities and the comb, and processes them and writes them to HDF5 files
+    (a StreamAligner of the default streams)
+    """
+    def __init__(self, cavi_regex_str, comb_regex_str, data_output_dir, station_name):
+        super().__init__(default_streams(cavi_regex_str, comb_regex_str), data_output_dir, station_name)
 
-        for i in range(len(self.cavi_queue)):
-            try:
-                self.cavi_line_data.parse_line(self.cavi_queue[i])
-                parsed_cavi_data[i] = copy.copy(self.cavi_line_data)
-            except re.error as e:
-                print_error(str(e))
-                parsed_cavi_data[i] = LineData()
+    @property
+    def cavi_line_data(self):
+        return self.line_data["cavi"]
 
-        self.comb_processed_queue.extend(parsed_comb_data)
-        self.cavi_processed_queue.extend(parsed_cavi_data)
-        self.comb_queue = []
-        self.cavi_queue = []
+    @property
+    def comb_line_data(self):
+        return self.line_data["comb"]
 
-        while True:
-            # find the next sync point
-            cavi_sync_point_batch_begin = None
-            for i in range(len(self.cavi_processed_queue)):
-                if self.cavi_processed_queue[i].success:
-                    # print(self.cavi_processed_queue[i])
-                    if self.cavi_processed_queue[i].sync:
-                        cavi_sync_point_batch_begin = i
-                        break
+    @property
+    def cavi_processed_queue(self):
+        return self.processed_queues["cavi"]
 
-            # if no sync point is found, return (to get more data from text files)
-            if cavi_sync_point_batch_begin is None:
-                return
+    @property
+    def comb_processed_queue(self):
+        return self.processed_queues["comb"]
 
-            # after having found a first sync point, find the next one
-            cavi_sync_point_batch_end = None
-            for i in range(cavi_sync_point_batch_begin+1, len(self.cavi_processed_queue)):
-                if self.cavi_processed_queue[i].success:
-                    if self.cavi_processed_queue[i].sync:
-                        cavi_sync_point_batch_end = i  # the point past the last point
-                        break
-            if cavi_sync_point_batch_end is None:
-                return
-            # print([cavi_sync_point_batch_begin,cavi_sync_point_batch_end])
-            # print(self.cavi_processed_queue[cavi_sync_point_batch_begin].time,self.cavi_processed_queue[cavi_sync_point_batch_end].time)
-            # print(self.cavi_processed_queue[cavi_sync_point_batch_begin].time)
-            # print(self.cavi_processed_queue[cavi_sync_point_batch_end+1].time)
-
-            # seek points in comb data that correspond to cavity data
-            comb_sync_point_batch_begin = None
-            comb_sync_point_batch_end = None
-            comb_sync_point_batch_range = []
-            for i in range(len(self.comb_processed_queue)):
-                if self.comb_processed_queue[i].success:
-                    begin = self.cavi_processed_queue[cavi_sync_point_batch_begin].time
-                    tm = self.comb_processed_queue[i].time
-                    end = self.cavi_processed_queue[cavi_sync_point_batch_end].time
-                    if begin <= tm < end:
-                        comb_sync_point_batch_range.append(i)
-                        # break
-
-            # if no corresponding points in time were found in comb data, return
-            # (so that more data can be brought next time)
-            if len(comb_sync_point_batch_range) == 0:
-                # if there are 60 seconds of comb data, delete the cavity data as no match of it will be found
-                # this is necessary in case cavity data recording started before comb data
-                if len(self.comb_processed_queue) > 60*SingleFileData.comb_sample_rate:
-                    del self.cavi_processed_queue[cavi_sync_point_batch_begin:cavi_sync_point_batch_end]
-                    self.process_data()
-                return
+    def append_comb_data(self, data):
+        self.append_data("comb", data)
+
+    def append_cavi_data(self, data):
+        self.append_data("cavi", data)
+
+    def append_parsed_comb_data(self, batch):
+        self.append_parsed("comb", batch)
+
+    def append_parsed_cavi_data(self, batch):
+        self.append_parsed("cavi", batch)
+
+    def resume_state(self, cavi_position, comb_position):
+        """
+        :param cavi_position: position of the first cavities line that is not processed
+        :param comb_position: position of the first comb line that is not processed
+        :return: see resume_positions()
+        """
+        return self.resume_positions({"cavi": cavi_position, "comb": comb_position})
+
+
+class StreamBuffer:
+    """
+    A FIFO queue of parsed lines of one data stream, kept as a deque of LineBatch chunks, with an index of the
+    sync points in it that is updated as lines arrive
+    Lines are addressed by their position since the stream started, so positions don't change when lines are
+    dropped from the front. Nothing is ever copied, except when lines are taken out with get()
+    Optionally, the times of the successfully parsed lines are kept sorted in a single array, so that lines can be
+    looked up by time with binary search (see find_time_ranges())
+    """
+
+    def __init__(self, num_columns, time_index=False):
+        """
+        :param num_columns: number of data columns of the stream
+        :param time_index: whether to keep the sorted time index
+        """
+        self.num_columns = num_columns
+        self.chunks = collections.deque()
+        self.chunk_starts = collections.deque()  # position of the first line of every chunk
+        self.sync_points = collections.deque()  # positions of the lines that are successfully parsed sync points
+        self.sync_times = collections.deque()  # times of these sync points
+        self.begin = 0  # position of the first line in the queue
+        self.end = 0  # position past the last line in the queue
+        self.end_file_position = None  # (file, byte position) past the last line, if known
+
+        # the time index: times of the successful lines, sorted, with their positions. Both arrays grow by
+        # doubling, and only [index_begin, index_end) is in use
+        self.time_index = time_index
+        self.index_times = np.zeros(0, dtype="datetime64[us]")
+        self.index_positions = np.zeros(0, dtype=np.int64)
+        self.index_begin = 0
+        self.index_end = 0
+
+    def __len__(self):
+        return self.end - self.begin
+
+    def append(self, batch):
+        """
+        Add parsed lines to the end of the queue
+        :param batch: LineBatch
+        :return: None
+        """
+        if batch.file is not None and batch.end_offset is not None:
+            self.end_file_position = (batch.file, batch.end_offset)
+        if len(batch) == 0:
+            return
+        self.chunks.append(batch)
+        self.chunk_starts.append(self.end)
+        sync_offsets = np.flatnonzero(batch.success & batch.sync)
+        self.sync_points.extend((sync_offsets + self.end).tolist())
+        self.sync_times.extend(batch.time[sync_offsets])
+        if self.time_index:
+            successful = np.flatnonzero(batch.success)
+            self._add_to_time_index(batch.time[successful], successful + self.end)
+        self.end += len(batch)
+
+    def _add_to_time_index(self, times, positions):
+        """
+        Add times (and their line positions) to the time index, keeping it sorted
+        :param times: datetime64 array
+        :param positions: int64 array
+        :return: None
+        """
+        # forget the lines that were dropped already
+        in_use = self.index_positions[self.index_begin:self.index_end]
+        live = np.flatnonzero(in_use >= self.begin)
+        if len(live) == 0:
+            self.index_begin = self.index_end
+        elif len(live) < len(in_use):
+            if live[0] == len(in_use) - len(live):
+                # the dropped lines are all at the front
+                self.index_begin += int(live[0])
             else:
-                comb_sync_point_batch_begin = comb_sync_point_batch_range[0]
-                comb_sync_point_batch_end = comb_sync_point_batch_range[-1]+1
-            # print(cavi_sync_point_batch_begin, cavi_sync_point_batch_end)
-            # print(comb_sync_point_batch_begin, comb_sync_point_batch_end)
-            # print(self.cavi_processed_queue[cavi_sync_point_batch_begin].time, self.comb_processed_queue[comb_sync_point_batch_begin].time)
-            # print(self.cavi_processed_queue[cavi_sync_point_batch_end].time, self.comb_processed_queue[comb_sync_point_batch_end].time)
-            self.file_writer.append_batch(self.cavi_processed_queue[cavi_sync_point_batch_begin:
-                                                                    cavi_sync_point_batch_end],
-                                          self.comb_processed_queue[comb_sync_point_batch_begin:
-                                                                    comb_sync_point_batch_end])
-
-            # delete the parts of the queue that are used/skipped
-            # the reason for starting from zero is to remove additional data that was not matched before
-            # ideally, comb_sync_point_batch_begin = cavi_sync_point_batch_begin = 0
-            del self.cavi_processed_queue[0:cavi_sync_point_batch_end]
-            del self.comb_processed_queue[0:comb_sync_point_batch_end]
+                # only possible when lines were not in order
+                live += self.index_begin
+                self.index_times[self.index_begin:self.index_begin + len(live)] = self.index_times[live]
+                self.index_positions[self.index_begin:self.index_begin + len(live)] = self.index_positions[live]
+                self.index_end = self.index_begin + len(live)
+
+        num_live = self.index_end - self.index_begin
+        num_new = len(times)
+        if num_new == 0:
+            return
+        in_order = (num_live == 0 or times[0] >= self.index_times[self.index_end - 1]) and \
+            bool(np.all(times[1:] >= times[:-1]))
+
+        # make room: move the live part to the front, and grow if it's still too small
+        if self.index_end + num_new > len(self.index_times):
+            capacity = max(2*(num_live + num_new), 64)
+            new_times = np.zeros(capacity, dtype=self.index_times.dtype)
+            new_positions = np.zeros(capacity, dtype=np.int64)
+            new_times[:num_live] = self.index_times[self.index_begin:self.index_end]
+            new_positions[:num_live] = self.index_positions[self.index_begin:self.index_end]
+            self.index_times = new_times
+            self.index_positions = new_positions
+            self.index_begin = 0
+            self.index_end = num_live
+
+        self.index_times[self.index_end:self.index_end + num_new] = times
+        self.index_positions[self.index_end:self.index_end + num_new] = positions
+        self.index_end += num_new
+        if not in_order:
+            # lines that come out of order are rare, sort everything (stable, so equal times keep their order)
+            in_use = slice(self.index_begin, self.index_end)
+            order = np.argsort(self.index_times[in_use], kind="stable")
+            self.index_times[in_use] = self.index_times[in_use][order]
+            self.index_positions[in_use] = self.index_positions[in_use][order]
+
+    def drop_until(self, position):
+        """
+        Remove all lines before position from the front of the queue
+        :param position: position of the first line to keep
+        :return: None
+        """
+        position = min(max(position, self.begin), self.end)
+        self.begin = position
+        while len(self.chunks) > 0 and self.chunk_starts[0] + len(self.chunks[0]) <= position:
+            self.chunks.popleft()
+            self.chunk_starts.popleft()
+        while len(self.sync_points) > 0 and self.sync_points[0] < position:
+            self.sync_points.popleft()
+            self.sync_times.popleft()
+
+    def _chunks_in_range(self, begin, end):
+        """
+        A generator of the chunks that have lines in [begin, end)
+        :return: yields tuples (chunk, position of its first line)
+        """
+        for chunk, start in zip(self.chunks, self.chunk_starts):
+            if start >= end:
+                break
+            if start + len(chunk) > begin:
+                yield chunk, start
+
+    def time_at(self, position):
+        """
+        :param position: position of a line in the queue
+        :return: the time of the line
+        """
+        for chunk, start in self._chunks_in_range(position, position + 1):
+            return chunk.time[position - start]
+        raise IndexError("Line " + str(position) + " is not in the queue")
+
+    def file_position(self, position):
+        """
+        Find where a line is in its file, so that reading the file can be resumed from it
+        :param position: position of a line in the queue, or the end of the queue
+        :return: tuple (path of the file, byte position of the line in it), or None if it's not known
+        """
+        if position >= self.end:
+            return self.end_file_position
+        for chunk, start in self._chunks_in_range(position, position + 1):
+            if chunk.file_offsets is None:
+                return None
+            return chunk.file, int(chunk.file_offsets[position - start])
+        raise IndexError("Line " + str(position) + " is not in the queue")
+
+    def get(self, begin, end):
+        """
+        Copy the lines in [begin, end) out of the queue
+        :param begin: position of the first line
+        :param end: position past the last line
+        :return: LineBatch
+        """
+        begin = max(begin, self.begin)
+        parts = [chunk[max(begin - start, 0):end - start] for chunk, start in self._chunks_in_range(begin, end)]
+        return LineBatch.concatenate(parts or [LineBatch.empty(self.num_columns)])
+
+    def find_time_ranges(self, begin_times, end_times):
+        """
+        Binary search of many time windows [begin_time, end_time) in the time index, all at once
+        Use index_range_to_positions() to get the lines of a window
+        :param begin_times: datetime64 array of the first times to include
+        :param end_times: datetime64 array of the times past the last times to include
+        :return: tuple of two arrays (first entry of every window in the index, entry past the last one)
+        """
+        if not self.time_index:
+            raise Exception("The time index is not enabled for this StreamBuffer")
+        times = self.index_times[self.index_begin:self.index_end]
+        return (np.searchsorted(times, begin_times, side="left") + self.index_begin,
+                np.searchsorted(times, end_times, side="left") + self.index_begin)
+
+    def index_range_to_positions(self, index_begin, index_end):
+        """
+        Convert a range of entries of the time index (from find_time_ranges()) to the lines in the queue
+        :param index_begin: first entry
+        :param index_end: entry past the last one
+        :return: tuple (position of the first line, position past the last line), or None if none of the lines
+                 is still in the queue
+        """
+        positions = self.index_positions[index_begin:index_end]
+        positions = positions[positions >= self.begin]
+        if len(positions) == 0:
+            return None
+        return int(positions.min()), int(positions.max()) + 1
+
+    def find_time_range(self, begin_time, end_time):
+        """
+        Find the successfully parsed lines in the queue whose time is in [begin_time, end_time)
+        :param begin_time: the first time to include
+        :param end_time: the time past the last time to include
+        :return: tuple (position of the first such line, position past the last such line), or None if there are none
+        """
+        index_ranges = self.find_time_ranges(np.array([begin_time]), np.array([end_time]))
+        return self.index_range_to_positions(index_ranges[0][0], index_ranges[1][0])
 
 
 def large_round(num):
@@ -349,6 +1080,7 @@ class SingleFileData:
     cavi_dataset_name = "CavitiesData"
     comb_dataset_name = "CombData"
     attr_data_format = "AtomicClockData_PTB"
+    # formats of the dates and times in the attributes (timestamps.format_times() formats datetime64 the same way)
     f_dateFormat = "%Y/%m/%d"
     f_timeFormat = "%H:%M:%S.%f"
     comb_sample_rate = 1
@@ -358,29 +1090,138 @@ class SingleFileData:
     Latitude = 52.296052
     MainEquation = None
 
+    # storage options of the datasets, as given to h5py's create_dataset(). "chunk_rows" sets explicit chunks of that
+    # many rows (with all the columns); without it, h5py chooses the chunks
+    storage_profiles = {
+        "gzip1": {"compression": "gzip", "compression_opts": 1},
+        "gzip4": {"compression": "gzip", "compression_opts": 4},
+        "gzip6": {"compression": "gzip", "compression_opts": 6},
+        "gzip9": {"compression": "gzip", "compression_opts": 9},
+        "shuffle-gzip1": {"shuffle": True, "compression": "gzip", "compression_opts": 1},
+        "shuffle-gzip4": {"shuffle": True, "compression": "gzip", "compression_opts": 4},
+        "shuffle-gzip9": {"shuffle": True, "compression": "gzip", "compression_opts": 9},
+        "lzf": {"compression": "lzf"},
+        "shuffle-lzf": {"shuffle": True, "compression": "lzf"},
+        "none": {},
+        "none-chunked": {"chunk_rows": 10000},
+    }
+    StorageProfile = "gzip9"
+    # number of processes that compress the chunks of the datasets (see chunks.ChunkCompressor); 0 lets HDF5 do it
+    CompressionWorkers = 0
+    # whether the channels of the main equation are evaluated and written to datasets of their own, in this group
+    DerivedDatasets = False
+    derived_group_name = "DerivedChannels"
+
     @staticmethod
     def SetMainEquations(eq):
+        if SingleFileData.DerivedDatasets:
+            parse_main_equation(eq)
         SingleFileData.MainEquation = eq
 
+    @staticmethod
+    def SetDerivedDatasets(enabled):
+        """
+        Choose whether the channels of the main equation are written to the files, as datasets evaluated from the data
+        (see equations.evaluate_main_equation()), so that they don't have to be computed from every file again
+        :param enabled: True to write them
+        :return: None
+        """
+        if enabled and SingleFileData.MainEquation is not None:
+            # raises ValueError now, instead of for every file, if the equation can't be evaluated
+            parse_main_equation(SingleFileData.MainEquation)
+        SingleFileData.DerivedDatasets = enabled
+
+    @staticmethod
+    def SetStorageProfile(name):
+        """
+        Choose how the datasets are stored (compression and chunking)
+        :param name: name of one of SingleFileData.storage_profiles
+        :return: None
+        """
+        if name not in SingleFileData.storage_profiles:
+            raise ValueError("Unknown storage profile: " + str(name) + ". Available profiles: " +
+                             ", ".join(sorted(SingleFileData.storage_profiles)))
+        SingleFileData.StorageProfile = name
+
+    @staticmethod
+    def SetCompressionWorkers(num_workers):
+        """
+        Compress the chunks of the datasets in parallel processes, and write them with direct chunk writes
+        :param num_workers: number of processes; 0 lets HDF5 compress the chunks
+        :return: None
+        """
+        SingleFileData.CompressionWorkers = num_workers
+
+    @staticmethod
+    def _create_dataset(hdf5file_obj, name, data):
+        """
+        Create a dataset with the data, stored with the current storage profile
+        :param hdf5file_obj: h5py file object
+        :param name: name of the dataset
+        :param data: numpy array
+        :return: h5py dataset
+        """
+        options = SingleFileData.dataset_storage_options(data.shape)
+        if SingleFileData.CompressionWorkers <= 0:
+            return hdf5file_obj.create_dataset(name, data=data, **options)
+        dataset = hdf5file_obj.create_dataset(name, shape=data.shape, dtype=data.dtype, **options)
+        get_compressor(SingleFileData.CompressionWorkers).write_dataset(dataset, data)
+        return dataset
+
+    @staticmethod
+    def dataset_storage_options(shape, profile=None):
+        """
+        Get the options of h5py's create_dataset() for a dataset, from a storage profile
+        :param shape: shape of the dataset
+        :param profile: name of the profile (default: the current one, SingleFileData.StorageProfile)
+        :return: dict of options
+        """
+        options = dict(SingleFileData.storage_profiles[profile or SingleFileData.StorageProfile])
+        chunk_rows = options.pop("chunk_rows", None)
+        # chunks can't be larger than a fixed-size dataset, or empty
+        if chunk_rows is not None and shape[0] > 0 and all(d > 0 for d in shape[1:]):
+            options["chunks"] = (min(chunk_rows, shape[0]),) + tuple(shape[1:])
+        return options
+
     @staticmethod
     def create_normalized_list(input_list, to_include_list, prec=4, to_type=np.float64):
         """
-        Create a list+offsets from 2d Decimals list
-        :param input_list: input 2d list
+        Create a list+offsets from the fixed-point columns of parsed lines
+        The offsets are calculated and subtracted with exact integer arithmetic on whole columns. The result is
+        identical to create_normalized_list_decimal(), which is used instead for columns with too many digits for
+        the precision of the Decimal context.
+        :param input_list: LineBatch of the lines
         :param to_include_list: list of column numbers to include
         :param prec: precision to subtract
         :param to_type: type to convert to after subtracting the mean
         :return: dict with "offsets" and "array"
         """
-        data = np.zeros([len(input_list), len(to_include_list)],
-                             dtype=np.float64).tolist()
+        data = np.zeros([len(input_list), len(to_include_list)], dtype=np.float64)
+        offsets = [None]*len(to_include_list)
+        for k in range(len(to_include_list)):
+            normalized = input_list.values[to_include_list[k]].subtract_rounded_mean(prec)
+            if normalized is None:
+                normalized = SingleFileData.create_normalized_list_decimal(input_list, [to_include_list[k]], prec)
+                data[:, k] = normalized["array"][:, 0]
+                offsets[k] = normalized["offsets"][0]
+            else:
+                data[:, k], offsets[k] = normalized
 
+        return {"array": data.astype(to_type), "offsets": np.array(offsets, dtype=to_type)}
 
-        for i in range(len(input_list)):
-            k = 0
-            for j in to_include_list:
-                data[i][k] = input_list[i].data[j]
-                k += 1
+    @staticmethod
+    def create_normalized_list_decimal(input_list, to_include_list, prec=4, to_type=np.float64):
+        """
+        Create a list+offsets from the fixed-point columns of parsed lines, element by element with Decimal
+        This is slow, and is the reference for create_normalized_list()
+        :param input_list: LineBatch of the lines
+        :param to_include_list: list of column numbers to include
+        :param prec: precision to subtract
+        :param to_type: type to convert to after subtracting the mean
+        :return: dict with "offsets" and "array"
+        """
+        columns = [input_list.values[j].to_decimals() for j in to_include_list]
+        data = [list(row) for row in zip(*columns)]
 
 
         # calculate offsets
@@ -403,127 +1244,261 @@ class SingleFileData:
         offsets = np.array(offsets, dtype=to_type)
         return {"array": data, "offsets": offsets}
 
-    def __init__(self, data_output_dir, station_name):
+    def __init__(self, data_output_dir, station_name, minute_writer=None, streams=None):
+        """
+        :param data_output_dir: directory to write the HDF5 files to
+        :param station_name: name of the station, with which the files are named
+        :param minute_writer: function that takes a SingleFileData object with a complete minute of data, and writes
+                              it (e.g. in another process). If None, minutes are written with write_to_file() right away
+        :param streams: list of StreamDefinition of the data of the minutes (default: default_streams())
+        """
         self.data_output_dir = data_output_dir
         self.station_name = station_name
+        self.minute_writer = minute_writer
+        self.streams = streams if streams is not None else default_streams()
+        self.reference = reference_stream(self.streams)
+        # where to resume reading the files from, once the data up to now is written (see DataCollection.resume_state())
+        self.resume_state = None
+        # number of batches that check_added_data_sanity() rejected, which made the minute they were in be dropped
+        self.num_rejected_batches = 0
+
+        # the lines of the minute of every stream, by name, in buffers that are allocated for a whole minute
+        self.data = {stream.name: MinuteBuffer(SingleFileData.max_batches*stream.sample_rate)
+                     for stream in self.streams}
+        self.num_batches = 0
+
+    @property
+    def cavi_data(self):
+        return self.data["cavi"]
+
+    @property
+    def comb_data(self):
+        return self.data["comb"]
 
-        self.all_data = {}
+    def detach_data(self):
+        """
+        Move the data collected until now to a new SingleFileData object, which can be written independently
+        :return: SingleFileData object with the data
+        """
+        result = SingleFileData(self.data_output_dir, self.station_name, streams=self.streams)
+        # the buffers are swapped, so this object gets the new (not allocated yet) ones
+        result.data, self.data = self.data, result.data
+        result.num_batches = self.num_batches
+        result.resume_state = self.resume_state
         self.num_batches = 0
-        self.clear()
+        return result
+
+    def start_time(self):
+        """
+        :return: time of the first line of the sync reference (the cavities) in the data (datetime64), or None if
+                 there's no data
+        """
+        reference_data = self.data[self.reference.name]
+        if len(reference_data) == 0:
+            return None
+        return reference_data.time[0]
+
+    def end_time(self):
+        """
+        :return: time of the last line of the sync reference (the cavities) in the data (datetime64), or None if
+                 there's no data
+        """
+        reference_data = self.data[self.reference.name]
+        if len(reference_data) == 0:
+            return None
+        return reference_data.time[len(reference_data) - 1]
 
     def clear(self):
         self.num_batches = 0
-        self.all_data = {"cavi_data": [], "comb_data": []}
+        for buffer in self.data.values():
+            buffer.clear()
 
-    def append_batch(self, cavi_data_list, comb_data_list):
-        if self.check_added_data_sanity(cavi_data_list, comb_data_list) is True:
-            self.all_data["cavi_data"].extend(cavi_data_list)
-            self.all_data["comb_data"].extend(comb_data_list)
+    def append_batch(self, *batches):
+        """
+        Add a second of data (the lines between two sync points of the sync reference, and the lines of the other
+        streams in the same time)
+        :param batches: LineBatch of every stream, in the order of the streams (cavities, then comb)
+        :return: None
+        """
+        if self.check_added_data_sanity(*batches) is True:
+            for stream, batch in zip(self.streams, batches):
+                self.data[stream.name].append(batch)
             self.num_batches += 1
         else:
+            self.num_rejected_batches += 1
             self.clear()
 
         if self.num_batches >= 60:
-            self.write_to_file()
-            self.clear()
+            if self.minute_writer is None:
+                self.write_to_file()
+                self.clear()
+            else:
+                self.minute_writer(self.detach_data())
 
-    def check_added_data_sanity(self, cavi_data_list, comb_data_list):
-        if len(cavi_data_list) < SingleFileData.cavi_sample_rate:
-            print_error("An error in a batch was found; the number of points for cavity data is < 1000 points")
+    def check_added_data_sanity(self, *batches):
+        reference_batch = batches[self.streams.index(self.reference)]
+        if len(reference_batch) < self.reference.sample_rate:
+            print_error("An error in a batch was found; the number of points for " + self.reference.name +
+                        " data is < " + str(self.reference.sample_rate) + " points")
             print_error("Raising error flag")
             return False
         else:
             return True
 
+    def normalize(self):
+        """
+        Normalize the columns to include of the minute (subtract their offsets)
+        :return: dict with the arrays of every stream ("cavi_data", "comb_data"), their offsets ("cavi_offsets",
+                 "comb_offsets") and the times of their first lines ("cavi_t0", "comb_t0") and past their last samples
+                 ("cavi_t1", "comb_t1"), as datetime64
+        """
+        result = {}
+        for stream in self.streams:
+            all_data = self.data[stream.name].batch()
+
+            #############################################
+            # prepare data to write to file, be very careful that the data must remain exact (fixed-point integers
+            # or Decimal) until the offset is subtracted. FLOATING POINT IS FORBIDDEN BEFORE SUBTRACTING
+            #############################################
+
+            normalized_data = SingleFileData.create_normalized_list(all_data, stream.columns)
+
+            #############################################
+
+            t0 = all_data.time[0]
+            result[stream.name + "_data"] = normalized_data["array"]
+            result[stream.name + "_offsets"] = normalized_data["offsets"]
+            result[stream.name + "_t0"] = t0
+            result[stream.name + "_t1"] = timestamps.end_time(t0, len(all_data), stream.sample_rate)
+        return result
+
     def write_to_file(self):
         if SingleFileData.MainEquation is None:
             print_error("MainEquation is not set. Use SingleFileData.SetMainEquations(value) to set it. Exiting...")
             exit(2)
 
-        year   = self.all_data["cavi_data"][0].time.strftime('%Y')
-        month  = self.all_data["cavi_data"][0].time.strftime('%m')
-        day    = self.all_data["cavi_data"][0].time.strftime('%d')
-        hour   = self.all_data["cavi_data"][0].time.strftime('%H')
-        minute = self.all_data["cavi_data"][0].time.strftime('%M')
-        second = self.all_data["cavi_data"][0].time.strftime('%S')
-
-        out_dir = os.path.join(self.data_output_dir, year, month, day)
-        file_name = self.station_name + "_" + year + month + day + "_" + hour + minute + second + ".h5"
-        file_path = os.path.join(out_dir, file_name)
-        mkdir_p(out_dir)
+        return SingleFileData.write_minute_file(self.data_output_dir, self.station_name, self.normalize(),
+                                                streams=self.streams)
 
+    @staticmethod
+    def _write_derived_datasets(hdf5file_obj, minute, main_equation):
+        """
+        Evaluate the channels of the main equation over a minute, and write them to datasets named after the channels,
+        at the sampling rate of the cavities data. Like the data, they're stored with their offset subtracted
+        :param hdf5file_obj: h5py file object
+        :param minute: dict like the one of normalize()
+        :param main_equation: the main equation
+        :return: None
+        """
+        try:
+            channels = evaluate_main_equation(main_equation, minute, SingleFileData.cavi_sample_rate,
+                                              SingleFileData.comb_sample_rate)
+        except ValueError as e:
+            print_error("Unable to evaluate the main equation, the file is written without derived datasets. "
+                        "Exception says: " + str(e))
+            return
+        # the channels are evaluated at the times of the cavities data, so they have its times
+        dates, times = timestamps.format_times([minute["cavi_t0"], minute["cavi_t1"]])
+        group = hdf5file_obj.create_group(SingleFileData.derived_group_name)
+        for channel, values in channels:
+            data, offset = normalize_channel(values)
+            ds = SingleFileData._create_dataset(group, channel.name, data.reshape(-1, 1))
+            ds.attrs["Date"] = str(dates[0])
+            ds.attrs["SamplingRate(Hz)"] = np.float32(SingleFileData.cavi_sample_rate)
+            ds.attrs["Units"] = channel.unit
+            ds.attrs["t0"] = str(times[0])
+            ds.attrs["t1"] = str(times[1])
+            ds.attrs["Expression"] = channel.expression
+            ds.attrs["Offset_column_0"] = offset
 
-        #############################################
-        # prepare data to write to file, be very careful that the data must remain of type Decimal until the offset is
-        # subtracted, which is why no optimized numpy operations are used. NUMPY IS FORBIDDEN BEFORE SUBTRACTING
-        #############################################
-
-        cavi_normalized_data = SingleFileData.create_normalized_list(self.all_data["cavi_data"],
-                                                                     cavi_columns_to_include)
-        cavi_data = cavi_normalized_data["array"]
-        cavi_offsets = cavi_normalized_data["offsets"]
-
-        comb_normalized_data = SingleFileData.create_normalized_list(self.all_data["comb_data"],
-                                                                     comb_columns_to_include)
-        comb_data = comb_normalized_data["array"]
-        comb_offsets = comb_normalized_data["offsets"]
+    @staticmethod
+    def minute_file_path(data_output_dir, station_name, cavi_t0):
+        """
+        :return: path of the file of the minute that starts at cavi_t0 (datetime64), in the year/month/day tree of
+                 data_output_dir
+        """
+        # YYYY-MM-DDTHH:MM:SS
+        stamp = np.datetime_as_string(np.datetime64(cavi_t0, "s"))
+        year   = stamp[0:4]
+        month  = stamp[5:7]
+        day    = stamp[8:10]
+        hour   = stamp[11:13]
+        minute = stamp[14:16]
+        second = stamp[17:19]
+
+        out_dir = os.path.join(data_output_dir, year, month, day)
+        file_name = station_name + "_" + year + month + day + "_" + hour + minute + second + ".h5"
+        return os.path.join(out_dir, file_name)
 
-        #############################################
+    @staticmethod
+    def write_minute_file(data_output_dir, station_name, minute, main_equation=None, streams=None):
+        """
+        Write a normalized minute of data to its HDF5 file
+        :param data_output_dir: output directory of the HDF5 files
+        :param station_name: station name
+        :param minute: dict like the one of normalize()
+        :param main_equation: main equation to embed in the file (default: SingleFileData.MainEquation)
+        :param streams: list of StreamDefinition of the data in the minute, a dataset each (default: default_streams())
+        :return: path of the written file, or None if it couldn't be opened
+        """
+        if streams is None:
+            streams = default_streams()
+        reference = reference_stream(streams)
+        reference_t0 = minute[reference.name + "_t0"]
+
+        file_path = SingleFileData.minute_file_path(data_output_dir, station_name, reference_t0)
+        out_dir = os.path.dirname(file_path)
+        file_name = os.path.basename(file_path)
+        mkdir_p(out_dir)
 
+        # the file is written under a temporary name, and renamed when complete, so that a half-written file is never
+        # seen under its final name (e.g. by the uploader)
+        temp_path = os.path.join(out_dir, "." + file_name + ".tmp")
         print("Opening file for write: " + file_path)
         try:
-            hdf5file_obj = h5py.File(file_path, "w")
+            hdf5file_obj = h5py.File(temp_path, "w")
             print("File " + file_name + " is open successfully... writing data...")
         except Exception as e:
             print_error("File open error: " + file_path + ". Exception says: " + str(e))
-            return
+            return None
 
         hdf5file_obj.attrs["WriterVersion"] = __version__
         hdf5file_obj.attrs["LocalFileCreationTime"] = str(dt.datetime.utcnow().strftime("%Y-%m-%d_%H-%M-%S_UTC"))
         hdf5file_obj.attrs["DataModel"] = "AtomicClocks_PTB"
-        hdf5file_obj.attrs["DefaultDataset"] = SingleFileData.cavi_dataset_name
+        hdf5file_obj.attrs["DefaultDataset"] = reference.dataset_name
         hdf5file_obj.attrs["DefaultMainEquation"] = "MainEquation"
         hdf5file_obj.attrs["DefaultMainEquationVersion"] = "1.0"
         hdf5file_obj.attrs["DefaultMainEquationVarName"] = "Cavities frequencies"
-
-
-
-        cavi_ds = hdf5file_obj.create_dataset(SingleFileData.cavi_dataset_name, data=cavi_data,
-                                              compression="gzip", compression_opts=9)
-        cavi_ds.attrs["Date"] = self.all_data["cavi_data"][0].time.strftime(SingleFileData.f_dateFormat)
-        cavi_ds.attrs["SamplingRate(Hz)"] = np.float32(SingleFileData.cavi_sample_rate)
-        cavi_ds.attrs["Units"] = "Hz"
-        cavi_ds.attrs["t0"] = self.all_data["cavi_data"][0].time.strftime(SingleFileData.f_timeFormat)
-        cavi_ds.attrs["t1"] = (self.all_data["cavi_data"][0].time +
-                               dt.timedelta(seconds=(len(cavi_data)/self.cavi_sample_rate))).\
-            strftime(SingleFileData.f_timeFormat)
-        cavi_ds.attrs["Longitude"] = np.float64(SingleFileData.Longitude)
-        cavi_ds.attrs["Altitude"] = np.float64(SingleFileData.Altitude)
-        cavi_ds.attrs["Latitude"] = np.float64(SingleFileData.Latitude)
-        cavi_ds.attrs["MissingPoints"] = np.int32(self.max_batches*self.cavi_sample_rate - len(cavi_data))
-        for i in range(len(cavi_offsets)):
-            cavi_ds.attrs["Offset_column_"+str(i)] = cavi_offsets[i]
-
-        comb_ds = hdf5file_obj.create_dataset(SingleFileData.comb_dataset_name, data=comb_data,
-                                              compression="gzip", compression_opts=9)
-        comb_ds.attrs["Date"] = self.all_data["comb_data"][0].time.strftime(SingleFileData.f_dateFormat)
-        comb_ds.attrs["SamplingRate(Hz)"] = np.float32(SingleFileData.comb_sample_rate)
-        comb_ds.attrs["Units"] = "Hz"
-        comb_ds.attrs["t0"] = self.all_data["comb_data"][0].time.strftime(SingleFileData.f_timeFormat)
-        comb_ds.attrs["t1"] = (self.all_data["comb_data"][0].time +
-                               dt.timedelta(seconds=(len(comb_data)/self.comb_sample_rate))).\
-            strftime(SingleFileData.f_timeFormat)
-        comb_ds.attrs["Longitude"] = np.float64(SingleFileData.Longitude)
-        comb_ds.attrs["Altitude"] = np.float64(SingleFileData.Altitude)
-        comb_ds.attrs["Latitude"] = np.float64(SingleFileData.Latitude)
-        comb_ds.attrs["MissingPoints"] = np.int32(self.max_batches*self.comb_sample_rate - len(comb_data))
-        for i in range(len(comb_offsets)):
-            comb_ds.attrs["Offset_column_"+str(i)] = comb_offsets[i]
-
-        hdf5file_obj[SingleFileData.cavi_dataset_name].attrs["MainEquation"] = SingleFileData.MainEquation
+        hdf5file_obj.attrs["StorageProfile"] = SingleFileData.StorageProfile
+
+        for stream in streams:
+            data = minute[stream.name + "_data"]
+            offsets = minute[stream.name + "_offsets"]
+            # dates and times of the first sample and past the last one of the dataset, for its attributes
+            dates, times = timestamps.format_times([minute[stream.name + "_t0"], minute[stream.name + "_t1"]])
+            ds = SingleFileData._create_dataset(hdf5file_obj, stream.dataset_name, data)
+            ds.attrs["Date"] = str(dates[0])
+            ds.attrs["SamplingRate(Hz)"] = np.float32(stream.sample_rate)
+            ds.attrs["Units"] = stream.units
+            ds.attrs["t0"] = str(times[0])
+            ds.attrs["t1"] = str(times[1])
+            ds.attrs["Longitude"] = np.float64(SingleFileData.Longitude)
+            ds.attrs["Altitude"] = np.float64(SingleFileData.Altitude)
+            ds.attrs["Latitude"] = np.float64(SingleFileData.Latitude)
+            ds.attrs["MissingPoints"] = np.int32(SingleFileData.max_batches*stream.sample_rate - len(data))
+            for i in range(len(offsets)):
+                ds.attrs["Offset_column_"+str(i)] = offsets[i]
+
+        if main_equation is None:
+            main_equation = SingleFileData.MainEquation
+        hdf5file_obj[reference.dataset_name].attrs["MainEquation"] = main_equation
+        if SingleFileData.DerivedDatasets:
+            SingleFileData._write_derived_datasets(hdf5file_obj, minute, main_equation)
 
         hdf5file_obj.close()
+        publish_file(temp_path, file_path)
         print("Done writing file: " + file_path)
+        return file_path
 
 
 class LineData:
@@ -543,6 +1518,9 @@ class LineData:
     key_msecond = "msec"
     key_flags = "flags"
 
+    # whether lines are split with the tokenizer of the layout of the regex (see FieldLayout), when it has one
+    use_fast_tokenizer = True
+
     @staticmethod
     def set_decimal_precision(precision):
         """
@@ -552,11 +1530,22 @@ class LineData:
         """
         decimal.getcontext().prec = precision
 
+    @staticmethod
+    def decimal_precision():
+        """
+        :return: the precision of the Decimal class
+        """
+        return decimal.getcontext().prec
+
     def __init__(self, regex_str=""):
         """
         Constructor of the parser function
         :param regex_str: String that represents the regex of the parser
         """
+        self.layout = None
+        # number of lines that parse_many() and parse_buffer() tokenized with the layout, and matched with the regex
+        self.num_fast_lines = 0
+        self.num_regex_lines = 0
         if regex_str == "":
             self.regex_str = None
             self.regex_comp = None
@@ -574,6 +1563,23 @@ class LineData:
         """
         self.regex_str = regex_str
         self.regex_comp = re.compile(regex_str)
+        self.regex_comp_bytes = re.compile(regex_str.encode())
+        # for matching lines in place in a buffer, where ^ has to match after a newline
+        self.regex_comp_buffer = re.compile(regex_str.encode(), re.MULTILINE)
+        # lines of a fixed layout of fields are split instead, which is faster
+        self.layout = FieldLayout.from_regex(regex_str)
+
+    def num_data_columns(self):
+        """
+        Count the data columns in the regex, which are the groups f1, f2, ... (until the first missing number)
+        :return: number of data columns
+        """
+        if self.regex_comp is None:
+            return 0
+        i = 0
+        while "f" + str(i + 1) in self.regex_comp.groupindex:
+            i += 1
+        return i
 
     def _init_empty(self):
         """
@@ -619,6 +1625,156 @@ class LineData:
         self._parse_data_from_parsed_line()
         self.success = True
 
+    def parse_many(self, lines):
+        """
+        Parse many lines at once, and return them as columns (see LineBatch) rather than one object per line.
+        Values are kept as exact fixed-point numbers, so, like parse_line, no precision is lost.
+        Lines that don't comply with the regex are kept with success=False, so that the result has one row
+        per non-empty line.
+        :param lines: list of lines, either str or bytes. Line endings are removed from str lines; bytes lines are
+                      expected to have none (like the ones from BlockLineReader). Empty lines are dropped
+        :return: LineBatch object
+        """
+        if (self.regex_str is None) or (self.regex_comp is None):
+            raise Exception("regex expression are not initialized. Use set_regex_str(str) to do it.")
+        as_bytes = len(lines) > 0 and isinstance(lines[0], bytes)
+        if not as_bytes:
+            lines = [s.replace("\r", "").replace("\n", "") for s in lines]
+        lines = list(filter(None, lines))
+        match = self.regex_comp_bytes.match if as_bytes else self.regex_comp.match
+        return self._parse_lines(len(lines), lambda: lines, lambda indices: [match(lines[i]) for i in indices],
+                                 lambda i: lines[i], as_bytes)
+
+    def parse_buffer(self, lines):
+        """
+        Parse lines that are inside a buffer, like parse_many() does. The regex is matched in place in the buffer
+        (e.g. a memory-mapped file, see MappedFile), so lines are never copied to separate objects.
+        The batch has the positions of the lines in their file, if the lines know them
+        :param lines: MappedLines object
+        :return: LineBatch object
+        """
+        if (self.regex_str is None) or (self.regex_comp is None):
+            raise Exception("regex expression are not initialized. Use set_regex_str(str) to do it.")
+        buffer = lines.buffer
+        starts = lines.starts.tolist()
+        ends = lines.ends.tolist()
+
+        def match(indices):
+            return list(map(self.regex_comp_buffer.match, itertools.repeat(buffer, len(indices)),
+                            [starts[i] for i in indices], [ends[i] for i in indices]))
+
+        batch = self._parse_lines(len(lines), lambda: [buffer[b:e] for b, e in zip(starts, ends)], match, lines.line,
+                                  True)
+        if lines.path is not None:
+            batch.file_offsets = lines.file_offsets()
+            batch.file = lines.path
+            batch.end_offset = lines.end_offset
+        return batch
+
+    def _parse_lines(self, num_lines, get_lines, match, get_line, as_bytes):
+        """
+        Parse lines with the tokenizer of the layout of the regex, if it has one, and with the regex the lines that the
+        tokenizer doesn't accept (or all of them, without a layout)
+        :param num_lines: number of lines
+        :param get_lines: function that returns the list of the lines (for the tokenizer)
+        :param match: function that matches a list of line numbers with the regex, and returns the match objects
+        :param get_line: function that returns line i (for error messages)
+        :param as_bytes: whether the lines are bytes (or str)
+        :return: LineBatch object, whose num_fast_lines is the number of lines that were tokenized
+        """
+        if self.layout is None or not LineData.use_fast_tokenizer:
+            self.num_regex_lines += num_lines
+            return self._batch_from_matches(match(range(num_lines)), get_line, as_bytes)
+
+        columns, fast = self.layout.tokenize(get_lines())
+        time, valid_time = timestamps.decode(columns[0], columns[1])
+        batch = self._batch_from_columns(time, valid_time, columns[2:], np.ones(len(fast), dtype=bool),
+                                         lambda i: get_line(fast[i]), as_bytes, plain_numbers=True)
+        indices = fast
+        if len(fast) < num_lines:
+            slow = np.setdiff1d(np.arange(num_lines), fast)
+            slow_batch = self._batch_from_matches(match(slow.tolist()), lambda i: get_line(slow[i]), as_bytes)
+            batch = LineBatch.concatenate([batch, slow_batch])
+            indices = np.concatenate([fast, slow])
+        if np.any(np.diff(indices) < 0):
+            # back to the order of the lines
+            batch = batch[np.argsort(indices, kind="stable")]
+        batch.num_fast_lines = len(fast)
+        self.num_fast_lines += len(fast)
+        self.num_regex_lines += num_lines - len(fast)
+        return batch
+
+    def _group_keys(self):
+        """
+        :return: tuple of the names of the groups of the regex that are parsed: date and time, sync, flags (if the
+                 regex has them) and data columns
+        """
+        date_keys = (LineData.key_year, LineData.key_month, LineData.key_day, LineData.key_hour,
+                     LineData.key_minute, LineData.key_second, LineData.key_msecond)
+        flags_keys = (LineData.key_flags,) if LineData.key_flags in self.regex_comp.groupindex else ()
+        return date_keys + ("sync",) + flags_keys + tuple("f" + str(i + 1) for i in range(self.num_data_columns()))
+
+    def _batch_from_matches(self, matches, get_line, as_bytes):
+        """
+        Collect the groups of regex matches of lines in columns
+        :param matches: list of match objects (None for lines that don't match)
+        :param get_line: function that returns line i (for error messages)
+        :param as_bytes: whether the lines are bytes (or str)
+        :return: LineBatch object
+        """
+        num_lines = len(matches)
+        num_columns = self.num_data_columns()
+        has_flags = LineData.key_flags in self.regex_comp.groupindex
+        keys = self._group_keys()
+
+        # placeholder for lines that fail, which is a valid date and zeros for data
+        failed_fields = ("0", "1", "1", "0", "0", "0", "0", " ") + (("",) if has_flags else ()) + ("0",)*num_columns
+        if as_bytes:
+            failed_fields = tuple(f.encode() for f in failed_fields)
+
+        success = np.ones(num_lines, dtype=bool)
+        all_fields = [None]*num_lines
+        for i in range(num_lines):
+            match_obj = matches[i]
+            if match_obj is None:
+                print_error("Failure while parsing line: " + _line_to_str(get_line(i)) + " as expression of the form " +
+                            self.regex_str + ". Apparently it doesn't comply to the regex provided.")
+                success[i] = False
+                all_fields[i] = failed_fields
+            else:
+                all_fields[i] = match_obj.group(*keys)
+
+        columns = list(zip(*all_fields)) if num_lines > 0 else [()]*len(keys)
+        time, valid_time = timestamps.from_fields(*columns[:7])
+        return self._batch_from_columns(time, valid_time, columns[7:], success, get_line, as_bytes)
+
+    def _batch_from_columns(self, time, valid_time, columns, success, get_line, as_bytes, plain_numbers=False):
+        """
+        Convert the fields of lines to a batch
+        :param time: datetime64[us] array of the timestamps of the lines
+        :param valid_time: boolean array, False where the date/time of a line isn't valid
+        :param columns: list of the columns of fields (str or bytes) after the date/time, in the order of _group_keys()
+        :param success: boolean array; False for the lines that failed already
+        :param get_line: function that returns line i (for error messages)
+        :param as_bytes: whether the fields are bytes (or str)
+        :param plain_numbers: whether the data fields are known to be plain decimals (see FixedPointArray)
+        :return: LineBatch object
+        """
+        num_lines = len(success)
+        num_columns = self.num_data_columns()
+        has_flags = LineData.key_flags in self.regex_comp.groupindex
+        first_value = len(columns) - num_columns
+        for i in np.flatnonzero(success & ~valid_time):
+            print_error("Failure while parsing line: " + _line_to_str(get_line(i)) + ". The date/time in it is not valid.")
+        success &= valid_time
+
+        sync_mark = b"*" if as_bytes else "*"
+        sync = np.array([s == sync_mark for s in columns[0]], dtype=bool)
+        flags = np.array(columns[1] if has_flags else [""]*num_lines, dtype=str)
+        from_strings = FixedPointArray.from_plain_strings if plain_numbers else FixedPointArray.from_strings
+        values = [from_strings(columns[first_value + j]) for j in range(num_columns)]
+        return LineBatch(time, sync, success, flags, values)
+
     def _parse_line_regex(self, line):
         self.line_str = line
         # this next line object is non-copyable! be careful when copying this class!
@@ -644,7 +1800,8 @@ class LineData:
                                       hour=int(p.group(LineData.key_hour)),
                                       minute=int(p.group(LineData.key_minute)),
                                       second=int(p.group(LineData.key_second)),
-                                      microsecond=int(p.group(LineData.key_msecond))*1000)
+                                      # the digits after the decimal point, whatever their number
+                                      microsecond=int(p.group(LineData.key_msecond).ljust(6, "0")[:6]))
 
     def _parse_data_from_parsed_line(self):
         i = int(1)
@@ -676,3 +1833,212 @@ class LineData:
                         "Regex Str": str(self.regex_str)})
         else:
             return "<No parsed data>"
+
+
+def _line_to_str(line):
+    """
+    :param line: str or bytes line
+    :return: the line as str, for printing
+    """
+    return line.decode(errors="replace") if isinstance(line, bytes) else line
+
+
+class LineBatch:
+    """
+    Many parsed lines of a data file, stored as columns instead of one LineData object per line
+    Row i of every column belongs to the same line
+    Batches parsed from a file (see LineData.parse_buffer()) also know where their lines are in the file
+    """
+
+    def __init__(self, time, sync, success, flags, values, file_offsets=None, file=None, end_offset=None):
+        """
+        :param time: datetime64[us] array of the timestamps of the lines
+        :param sync: boolean array; True where the line is a sync point (marked with "*")
+        :param success: boolean array; False where the line could not be parsed
+        :param flags: string array of the status flags of the lines ("" if the regex has no flags)
+        :param values: list of FixedPointArray, one per data column (f1, f2, ...)
+        :param file_offsets: int64 array of the byte positions of the lines in their file, if known
+        :param file: path of the file of the lines, if known
+        :param end_offset: byte position in the file past the last line (and any empty lines after it), if known
+        """
+        self.time = time
+        self.sync = sync
+        self.success = success
+        self.flags = flags
+        self.values = values
+        self.file_offsets = file_offsets
+        self.file = file
+        self.end_offset = end_offset
+        # number of the lines that were split by the tokenizer of the layout of the regex (the others by the regex)
+        self.num_fast_lines = 0
+
+    @staticmethod
+    def empty(num_columns):
+        """
+        Create a batch with no lines
+        :param num_columns: number of data columns
+        :return: LineBatch
+        """
+        return LineBatch(np.zeros(0, dtype="datetime64[us]"), np.zeros(0, dtype=bool), np.zeros(0, dtype=bool),
+                         np.zeros(0, dtype=str), [FixedPointArray.empty() for _ in range(num_columns)])
+
+    def __len__(self):
+        return len(self.time)
+
+    def num_data_columns(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        """
+        Select lines with a slice, a boolean mask or an index array
+        :param index: slice/mask/index array
+        :return: LineBatch
+        """
+        return LineBatch(self.time[index], self.sync[index], self.success[index], self.flags[index],
+                         [v[index] for v in self.values],
+                         self.file_offsets[index] if self.file_offsets is not None else None, self.file)
+
+    @staticmethod
+    def concatenate(batches):
+        """
+        Concatenate batches of lines (that are parsed with the same regex) into a single batch
+        :param batches: list of LineBatch
+        :return: LineBatch
+        """
+        batches = [b for b in batches if len(b) > 0] or batches[:1]
+        if len(batches) == 1:
+            return batches[0]
+        # positions in the file are kept only if all the lines are from the same file
+        same_file = batches[0].file is not None and all(b.file == batches[0].file and b.file_offsets is not None
+                                                        for b in batches)
+        return LineBatch(np.concatenate([b.time for b in batches]),
+                         np.concatenate([b.sync for b in batches]),
+                         np.concatenate([b.success for b in batches]),
+                         np.concatenate([b.flags for b in batches]),
+                         [FixedPointArray.concatenate([b.values[j] for b in batches])
+                          for j in range(batches[0].num_data_columns())],
+                         np.concatenate([b.file_offsets for b in batches]) if same_file else None,
+                         batches[0].file if same_file else None,
+                         batches[-1].end_offset if same_file else None)
+
+
+class MinuteBuffer:
+    """
+    The lines of one stream in a minute, in arrays that are allocated once for the whole minute and filled as batches
+    (seconds) are appended, instead of a list of batches that are concatenated when the minute is written. Only what
+    the minute needs is kept: the times, sync marks and flags of the lines, and their values as fixed-point mantissas.
+    So the memory of a minute is known in advance, and doesn't grow with the number of batches.
+    The values of every column share one exponent: when a batch has more decimals than the lines before it, the
+    mantissas of these lines are scaled, the same way FixedPointArray.concatenate() does it, so values stay exact.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: number of lines to allocate the arrays for; they grow if more lines are appended
+        """
+        self.capacity = capacity
+        self.length = 0
+        # the arrays are allocated with the first batch, which gives the number of columns and the type of the flags
+        self.time = None
+        self.sync = None
+        self.flags = None
+        self.mantissas = []
+        self.exponents = []
+        self.negative_zeros = []  # boolean arrays, or None until a value in the column is a negative zero
+
+    def __len__(self):
+        return self.length
+
+    def _allocate(self, batch):
+        capacity = max(self.capacity, len(batch))
+        self.time = np.empty(capacity, dtype=batch.time.dtype)
+        self.sync = np.empty(capacity, dtype=bool)
+        self.flags = np.empty(capacity, dtype=batch.flags.dtype)
+        self.mantissas = [np.empty(capacity, dtype=np.int64) for _ in range(batch.num_data_columns())]
+        self.exponents = [0]*batch.num_data_columns()
+        self.negative_zeros = [None]*batch.num_data_columns()
+
+    def _grow(self, capacity):
+        def grown(a):
+            result = np.empty(capacity, dtype=a.dtype) if a.dtype != object else np.zeros(capacity, dtype=object)
+            result[:self.length] = a[:self.length]
+            return result
+        self.time = grown(self.time)
+        self.sync = grown(self.sync)
+        self.flags = grown(self.flags)
+        self.mantissas = [grown(m) for m in self.mantissas]
+        self.negative_zeros = [grown(nz) if nz is not None else None for nz in self.negative_zeros]
+
+    def append(self, batch):
+        """
+        Copy the lines of a batch to the end of the buffer
+        :param batch: LineBatch of successfully parsed lines
+        :return: None
+        """
+        if self.time is None:
+            self._allocate(batch)
+        num_lines = len(batch)
+        if self.length + num_lines > len(self.time):
+            self._grow(max(2*len(self.time), self.length + num_lines))
+        lines = slice(self.length, self.length + num_lines)
+        self.time[lines] = batch.time
+        self.sync[lines] = batch.sync
+        if batch.flags.dtype.itemsize > self.flags.dtype.itemsize:
+            self.flags = self.flags.astype(batch.flags.dtype)
+        self.flags[lines] = batch.flags
+        if num_lines > 0:
+            for j, column in enumerate(batch.values):
+                self._put_values(j, lines, column)
+        self.length += num_lines
+
+    def _put_values(self, j, lines, column):
+        if self.length == 0:
+            self.exponents[j] = column.exponent
+        elif column.exponent < self.exponents[j]:
+            # the lines already in the buffer are scaled to the exponent of the new ones
+            rescaled = FixedPointArray(self.mantissas[j][:self.length], self.exponents[j]).rescale(column.exponent)
+            if rescaled.mantissa.dtype != self.mantissas[j].dtype:
+                self.mantissas[j] = self.mantissas[j].astype(object)
+            self.mantissas[j][:self.length] = rescaled.mantissa
+            self.exponents[j] = column.exponent
+        column = column.rescale(self.exponents[j])
+        if column.mantissa.dtype != self.mantissas[j].dtype:
+            self.mantissas[j] = self.mantissas[j].astype(object)
+        self.mantissas[j][lines] = column.mantissa
+        if column.negative_zero is not None:
+            if self.negative_zeros[j] is None:
+                self.negative_zeros[j] = np.zeros(len(self.mantissas[j]), dtype=bool)
+            self.negative_zeros[j][lines] = column.negative_zero
+        elif self.negative_zeros[j] is not None:
+            self.negative_zeros[j][lines] = False
+
+    def clear(self):
+        """
+        Remove all the lines, keeping the arrays to be filled again
+        :return: None
+        """
+        self.length = 0
+        self.mantissas = [m if m.dtype != object else np.empty(len(m), dtype=np.int64) for m in self.mantissas]
+        self.negative_zeros = [None]*len(self.negative_zeros)
+
+    def batch(self):
+        """
+        :return: LineBatch with the lines in the buffer (which are views of its arrays), or None if nothing was ever
+                 appended
+        """
+        if self.time is None:
+            return None
+        n = self.length
+        return LineBatch(self.time[:n], self.sync[:n], np.ones(n, dtype=bool), self.flags[:n],
+                         [FixedPointArray(m[:n], e, nz[:n] if nz is not None else None)
+                          for m, e, nz in zip(self.mantissas, self.exponents, self.negative_zeros)])
+
+    def __getstate__(self):
+        # only the lines are sent to other processes, not the free space after them
+        state = dict(self.__dict__)
+        if self.time is not None:
+            n = self.length
+            state.update(capacity=n, time=self.time[:n], sync=self.sync[:n], flags=self.flags[:n],
+                         mantissas=[m[:n] for m in self.mantissas],
+                         negative_zeros=[nz[:n] if nz is not None else None for nz in self.negative_zeros])
+        return state
@@ -0,0 +1,102 @@
+import datetime as dt
+import glob
+import os
+
+from gnomeptb import analysis
+from gnomeptb.analysis import print_error, read_mapped_files, DataCollection, SingleFileData
+from gnomeptb.daily import DailyArchive
+from gnomeptb.writer import WriterPool
+
+
+def _file_date(path):
+    """
+    Get the date of a data file from its name, which starts with the date as yymmdd
+    :param path: path of the file
+    :return: datetime.date, or None if the name doesn't start with a date
+    """
+    try:
+        return dt.datetime.strptime(os.path.basename(path)[:6], "%y%m%d").date()
+    except ValueError:
+        return None
+
+
+def find_file_pairs(cavity_dir, comb_dir, first_date, last_date):
+    """
+    Find the pairs of cavities and comb files of the days in a range of dates, matched by date like check_files() does
+    :param cavity_dir: directory of the cavities files
+    :param comb_dir: directory of the comb files
+    :param first_date: first day to include (datetime.date)
+    :param last_date: last day to include (datetime.date)
+    :return: list of tuples (date, cavities file path, comb file path), sorted by date
+    """
+    pairs = []
+    for cavi_file_path in sorted(glob.glob(os.path.join(cavity_dir, '*.txt'))):
+        date = _file_date(cavi_file_path)
+        if date is None or not (first_date <= date <= last_date):
+            continue
+        comb_files_paths = sorted(glob.glob(os.path.join(comb_dir, os.path.basename(cavi_file_path)[:6] + '*.txt')))
+        if len(comb_files_paths) == 0:
+            print_error("No comb file found for " + cavi_file_path + ". Skipping it.")
+            continue
+        if len(comb_files_paths) > 1:
+            print_error("More than one comb file found for " + cavi_file_path + ". Using " + comb_files_paths[0])
+        pairs.append((date, cavi_file_path, comb_files_paths[0]))
+    return pairs
+
+
+def run_backfill(cavity_dir, comb_dir, data_output_dir, station_name, first_date, last_date,
+                 cavity_regex=analysis.default_cavity_regex, comb_regex=analysis.default_comb_regex,
+                 num_workers=None, max_queue_size=250000, archive_dir=None):
+    """
+    Regenerate the HDF5 files of a range of days from data files that are no longer being written
+    The files of all days are parsed and aligned in order, by a single DataCollection, exactly like the live pipeline
+    does (including the data that carries over from one day's files to the next), and every complete minute is given
+    to a pool of processes that normalize and write it. So the output is the same as the live pipeline's, but
+    normalizing and compressing, which take most of the time, run in parallel.
+    The settings of the writer (main equation, columns to include) are taken from the current ones in this process.
+    :param cavity_dir: directory of the cavities files (e.g. the "finished" sub-directory)
+    :param comb_dir: directory of the comb files
+    :param data_output_dir: output directory of the HDF5 files
+    :param station_name: station name
+    :param first_date: first day to process (datetime.date)
+    :param last_date: last day to process (datetime.date)
+    :param cavity_regex: regular expression of the cavities data
+    :param comb_regex: regular expression of the comb data
+    :param num_workers: number of processes (default: number of CPUs)
+    :param max_queue_size: maximum number of lines to parse at once
+    :param archive_dir: if given, minutes are appended to daily files in this directory (see DailyArchive), by a
+                        single thread, instead of being written to files of their own by the pool of processes
+    :return: number of minutes written
+    """
+    if SingleFileData.MainEquation is None:
+        print_error("MainEquation is not set. Use SingleFileData.SetMainEquations(value) to set it.")
+        return 0
+    pairs = find_file_pairs(cavity_dir, comb_dir, first_date, last_date)
+    if len(pairs) == 0:
+        print_error("No data files found between " + str(first_date) + " and " + str(last_date))
+        return 0
+
+    archive = DailyArchive(archive_dir, station_name) if archive_dir is not None else None
+    if archive is not None:
+        pool = WriterPool(1, write_function=archive.append)
+    else:
+        pool = WriterPool(num_workers or os.cpu_count() or 1, use_processes=True)
+
+    # minutes that are submitted and not written yet are limited, so that parsing doesn't fill the memory
+    with pool:
+        collection = DataCollection(cavity_regex, comb_regex, data_output_dir, station_name)
+        collection.file_writer.minute_writer = pool.submit
+
+        for date, cavi_file_path, comb_file_path in pairs:
+            print("Backfilling " + str(date) + ": " + cavi_file_path + ", " + comb_file_path)
+            for data_queues in read_mapped_files(cavi_file_path, comb_file_path, max_queue_size):
+                collection.append_cavi_data(data_queues["cavi_queue"])
+                collection.append_comb_data(data_queues["comb_queue"])
+                collection.process_data()
+
+    if archive is not None:
+        archive.close()
+    num_written = pool.num_written
+    num_failed = pool.num_failed
+    print("Backfill done: " + str(num_written) + " minutes written, " + str(num_failed) + " failed")
+    return num_written
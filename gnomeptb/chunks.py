@@ -0,0 +1,125 @@
+import itertools
+import multiprocessing.util
+import os
+import zlib
+
+import numpy as np
+
+from gnomeptb.processes import process_pool
+
+# HDF5 filter ids, from <H5Zpublic.h>
+_FILTER_DEFLATE = 1
+_FILTER_SHUFFLE = 2
+
+# the compressor of this process, created by get_compressor()
+_compressor = None
+
+
+def get_compressor(num_workers):
+    """
+    Get the ChunkCompressor of this process, creating it on first use
+    :param num_workers: number of processes of the compressor
+    :return: ChunkCompressor
+    """
+    global _compressor
+    if _compressor is None or _compressor.num_workers != num_workers:
+        if _compressor is not None:
+            _compressor.close()
+        _compressor = ChunkCompressor(num_workers)
+        # stop the processes when this process exits. A worker process (e.g. of a WriterPool) would otherwise wait for
+        # them forever when it exits. This has to run before the queues of the pool are closed (exitpriority 10)
+        multiprocessing.util.Finalize(_compressor, _compressor.close, exitpriority=100)
+    return _compressor
+
+
+def direct_write_filters(dataset):
+    """
+    Find whether the chunks of a dataset can be compressed outside HDF5, i.e. its filters are deflate (gzip), optionally
+    after shuffle, which are done exactly like HDF5 does them with zlib and numpy
+    :param dataset: h5py dataset
+    :return: tuple (shuffle, deflate level), or None if the dataset isn't chunked or has other filters (e.g. lzf)
+    """
+    if dataset.chunks is None:
+        return None
+    plist = dataset.id.get_create_plist()
+    filters = [plist.get_filter(i) for i in range(plist.get_nfilters())]
+    filter_ids = [f[0] for f in filters]
+    if filter_ids == [_FILTER_DEFLATE]:
+        return False, filters[0][2][0]
+    if filter_ids == [_FILTER_SHUFFLE, _FILTER_DEFLATE]:
+        return True, filters[1][2][0]
+    return None
+
+
+def split_chunks(data, chunk_shape):
+    """
+    Split an array into the chunks of a dataset. Chunks at the edges are padded with zeros to the full chunk shape,
+    like HDF5 stores them
+    :param data: numpy array
+    :param chunk_shape: shape of the chunks
+    :return: tuple (list of offsets of the chunks, list of chunks as contiguous arrays)
+    """
+    offsets = list(itertools.product(*[range(0, n, c) for n, c in zip(data.shape, chunk_shape)]))
+    chunks = []
+    for offset in offsets:
+        chunk = data[tuple(slice(o, o + c) for o, c in zip(offset, chunk_shape))]
+        if chunk.shape != tuple(chunk_shape):
+            padded = np.zeros(chunk_shape, dtype=data.dtype)
+            padded[tuple(slice(0, n) for n in chunk.shape)] = chunk
+            chunk = padded
+        chunks.append(np.ascontiguousarray(chunk))
+    return offsets, chunks
+
+
+def compress_chunk(chunk, shuffle, level):
+    """
+    Compress a chunk the way the HDF5 shuffle and deflate filters do
+    :param chunk: contiguous numpy array with the full chunk
+    :param shuffle: whether to shuffle the bytes of the elements first
+    :param level: deflate (gzip) level
+    :return: compressed bytes
+    """
+    raw = chunk.tobytes()
+    if shuffle and chunk.itemsize > 1:
+        # the shuffle filter puts the first bytes of all elements first, then all the second bytes, etc.
+        raw = np.frombuffer(raw, dtype=np.uint8).reshape(-1, chunk.itemsize).T.tobytes()
+    return zlib.compress(raw, level)
+
+
+class ChunkCompressor:
+    """
+    Compresses the chunks of datasets in parallel, in a pool of processes, and writes the compressed chunks with HDF5
+    direct chunk writes, so that HDF5 doesn't compress them one after another. The files are the same as if HDF5
+    compressed the chunks: the datasets have the same filters, and any HDF5 reader can read them.
+    Only deflate (gzip) and shuffle can be done this way; datasets with other filters are written normally.
+    """
+
+    def __init__(self, num_workers=None):
+        """
+        :param num_workers: number of processes (default: number of CPUs)
+        """
+        self.num_workers = num_workers
+        self.executor = process_pool(num_workers)
+
+    def write_dataset(self, dataset, data):
+        """
+        Write all the data of a dataset, compressing its chunks in parallel if possible
+        :param dataset: h5py dataset, created with the shape and type of data
+        :param data: numpy array
+        :return: None
+        """
+        filters = direct_write_filters(dataset)
+        if filters is None:
+            dataset[...] = data
+            return
+        shuffle, level = filters
+        offsets, chunks = split_chunks(data, dataset.chunks)
+        # small chunks are sent to the processes in groups, so that the overhead of sending them doesn't dominate
+        group_size = max(1, len(chunks) // (4*(self.num_workers or os.cpu_count() or 1)))
+        compressed = self.executor.map(compress_chunk, chunks, itertools.repeat(shuffle), itertools.repeat(level),
+                                       chunksize=group_size)
+        for offset, chunk_bytes in zip(offsets, compressed):
+            dataset.id.write_direct_chunk(offset, chunk_bytes)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,228 @@
+import os
+
+import h5py
+import numpy as np
+
+from gnomeptb.analysis import __version__, print_error, mkdir_p, SingleFileData
+
+
+def _to_microseconds(t):
+    """
+    :param t: datetime64 or datetime
+    :return: microseconds since the epoch (int)
+    """
+    return int(np.datetime64(t, "us").astype(np.int64))
+
+
+def _from_microseconds(us):
+    """
+    :param us: microseconds since the epoch
+    :return: datetime64
+    """
+    return np.datetime64(int(us), "us")
+
+
+class DailyArchive:
+    """
+    Writes minutes of data to one HDF5 file per day, instead of a file per minute, by appending them to datasets that
+    grow. This saves creating 1440 files a day, with their attributes and metadata, for local archiving.
+    A daily file has:
+    - CavitiesData and CombData: the normalized data of all the minutes of the day, one minute after the other
+      (extendable, chunked datasets, stored with the current storage profile)
+    - Minutes: a table with a row per minute: the rows of the minute in both datasets, t0/t1, MissingPoints and the
+      offsets of the columns (all that the attributes of the minute files have)
+    The minute files, in the usual format, can be exported from the daily files with export_minute() and export_day().
+    Days are the days of the first cavities line of the minutes, like the directories of the minute files.
+    Appending is idempotent: a minute that is already in its daily file (e.g. appended again after a restart without a
+    journal, or after a crash before the journal was saved) is skipped, like a minute file that is written again.
+    """
+    minutes_table_name = "Minutes"
+    cavi_chunk_rows = 10000  # 10 seconds of cavities data
+    comb_chunk_rows = 600  # 10 minutes of comb data
+
+    def __init__(self, archive_dir, station_name):
+        """
+        :param archive_dir: directory of the daily files
+        :param station_name: station name
+        """
+        self.archive_dir = archive_dir
+        self.station_name = station_name
+        self.file = None
+        self.file_date = None
+        self.minute_times = set()  # cavi_t0 of the minutes in the current file, in microseconds
+
+    def day_file_path(self, date):
+        """
+        :param date: datetime.date of the day
+        :return: path of the file of the day
+        """
+        return os.path.join(self.archive_dir, date.strftime("%Y"), date.strftime("%m"),
+                            self.station_name + "_" + date.strftime("%Y%m%d") + "_daily.h5")
+
+    @staticmethod
+    def minutes_dtype(num_cavi_columns, num_comb_columns):
+        """
+        :return: numpy dtype of the rows of the minutes table
+        """
+        return np.dtype([("cavi_begin", np.int64), ("cavi_end", np.int64),
+                         ("cavi_t0", np.int64), ("cavi_t1", np.int64), ("cavi_missing", np.int32),
+                         ("cavi_offsets", np.float64, (num_cavi_columns,)),
+                         ("comb_begin", np.int64), ("comb_end", np.int64),
+                         ("comb_t0", np.int64), ("comb_t1", np.int64), ("comb_missing", np.int32),
+                         ("comb_offsets", np.float64, (num_comb_columns,))])
+
+    @staticmethod
+    def _create_data_dataset(hdf5file_obj, name, num_columns, chunk_rows):
+        options = dict(SingleFileData.storage_profiles[SingleFileData.StorageProfile])
+        options["chunks"] = (options.pop("chunk_rows", chunk_rows), num_columns)
+        hdf5file_obj.create_dataset(name, shape=(0, num_columns), maxshape=(None, num_columns), dtype=np.float64,
+                                    **options)
+
+    def _open_day(self, date, num_cavi_columns, num_comb_columns):
+        """
+        Make the file of a day the current one, creating it if it doesn't exist
+        """
+        if self.file is not None and self.file_date == date:
+            return
+        self.close()
+        file_path = self.day_file_path(date)
+        mkdir_p(os.path.dirname(file_path))
+        hdf5file_obj = h5py.File(file_path, "a")
+        if DailyArchive.minutes_table_name not in hdf5file_obj:
+            hdf5file_obj.attrs["WriterVersion"] = __version__
+            hdf5file_obj.attrs["DataModel"] = "AtomicClocks_PTB_Daily"
+            hdf5file_obj.attrs["StationName"] = self.station_name
+            hdf5file_obj.attrs["Date"] = date.strftime(SingleFileData.f_dateFormat)
+            hdf5file_obj.attrs["StorageProfile"] = SingleFileData.StorageProfile
+            hdf5file_obj.attrs["MainEquation"] = SingleFileData.MainEquation
+            DailyArchive._create_data_dataset(hdf5file_obj, SingleFileData.cavi_dataset_name, num_cavi_columns,
+                                              DailyArchive.cavi_chunk_rows)
+            DailyArchive._create_data_dataset(hdf5file_obj, SingleFileData.comb_dataset_name, num_comb_columns,
+                                              DailyArchive.comb_chunk_rows)
+            hdf5file_obj.create_dataset(DailyArchive.minutes_table_name, shape=(0,), maxshape=(None,),
+                                        dtype=DailyArchive.minutes_dtype(num_cavi_columns, num_comb_columns),
+                                        chunks=(1440,))
+        self.file = hdf5file_obj
+        self.file_date = date
+        self.minute_times = set(int(t) for t in hdf5file_obj[DailyArchive.minutes_table_name]["cavi_t0"])
+
+    @staticmethod
+    def _extend(dataset, data):
+        """
+        Append rows to an extendable dataset
+        :return: tuple (first row, row past the last one) of the new rows
+        """
+        begin = dataset.shape[0]
+        dataset.resize(begin + len(data), axis=0)
+        dataset[begin:] = data
+        return begin, begin + len(data)
+
+    def append(self, minute):
+        """
+        Normalize a minute of data and append it to the file of its day
+        :param minute: SingleFileData object with a complete minute of data
+        :return: path of the daily file
+        """
+        if SingleFileData.MainEquation is None:
+            print_error("MainEquation is not set. Use SingleFileData.SetMainEquations(value) to set it. Exiting...")
+            exit(2)
+        return self.append_normalized(minute.normalize())
+
+    def append_normalized(self, minute):
+        """
+        Append a normalized minute of data to the file of its day
+        :param minute: dict like the one of SingleFileData.normalize()
+        :return: path of the daily file
+        """
+        cavi_data = minute["cavi_data"]
+        comb_data = minute["comb_data"]
+        self._open_day(np.datetime64(minute["cavi_t0"], "D").item(), cavi_data.shape[1], comb_data.shape[1])
+
+        minute_time = _to_microseconds(minute["cavi_t0"])
+        if minute_time in self.minute_times:
+            print("Minute " + str(minute["cavi_t0"]) + " is already in " + self.file.filename + ", skipping it")
+            return self.file.filename
+
+        table = self.file[DailyArchive.minutes_table_name]
+        row = np.zeros(1, dtype=table.dtype)
+        for prefix, data, sample_rate in (("cavi", cavi_data, SingleFileData.cavi_sample_rate),
+                                          ("comb", comb_data, SingleFileData.comb_sample_rate)):
+            dataset_name = SingleFileData.cavi_dataset_name if prefix == "cavi" else SingleFileData.comb_dataset_name
+            begin, end = DailyArchive._extend(self.file[dataset_name], data)
+            row[prefix + "_begin"] = begin
+            row[prefix + "_end"] = end
+            row[prefix + "_t0"] = _to_microseconds(minute[prefix + "_t0"])
+            row[prefix + "_t1"] = _to_microseconds(minute[prefix + "_t1"])
+            row[prefix + "_missing"] = SingleFileData.max_batches*sample_rate - len(data)
+            row[prefix + "_offsets"] = minute[prefix + "_offsets"]
+        DailyArchive._extend(table, row)
+        self.minute_times.add(minute_time)
+        # the data is flushed for every minute, so that a crash loses as little as possible
+        self.file.flush()
+        print("Appended minute " + str(minute["cavi_t0"]) + " to " + self.file.filename)
+        return self.file.filename
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.file_date = None
+            self.minute_times = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+
+def read_minute(hdf5file_obj, index):
+    """
+    Read a minute of data from a daily file
+    :param hdf5file_obj: h5py file object of the daily file
+    :param index: number of the minute in the file (its row in the minutes table)
+    :return: dict like the one of SingleFileData.normalize()
+    """
+    row = hdf5file_obj[DailyArchive.minutes_table_name][index]
+    minute = {}
+    for prefix, dataset_name in (("cavi", SingleFileData.cavi_dataset_name),
+                                 ("comb", SingleFileData.comb_dataset_name)):
+        minute[prefix + "_data"] = hdf5file_obj[dataset_name][row[prefix + "_begin"]:row[prefix + "_end"]]
+        minute[prefix + "_offsets"] = row[prefix + "_offsets"]
+        minute[prefix + "_t0"] = _from_microseconds(row[prefix + "_t0"])
+        minute[prefix + "_t1"] = _from_microseconds(row[prefix + "_t1"])
+    return minute
+
+
+def export_minute(daily_file_path, index, data_output_dir, station_name=None):
+    """
+    Write the minute file of a minute in a daily file, exactly like it's written without the daily files
+    The main equation is the one that the daily file was written with
+    :param daily_file_path: path of the daily file
+    :param index: number of the minute in the file
+    :param data_output_dir: output directory of the minute files
+    :param station_name: station name (default: the one of the daily file)
+    :return: path of the minute file, or None if it couldn't be written
+    """
+    return export_day(daily_file_path, data_output_dir, station_name, [index])[0]
+
+
+def export_day(daily_file_path, data_output_dir, station_name=None, indices=None):
+    """
+    Write the minute files of the minutes in a daily file (see export_minute())
+    :param daily_file_path: path of the daily file
+    :param data_output_dir: output directory of the minute files
+    :param station_name: station name (default: the one of the daily file)
+    :param indices: numbers of the minutes to export (default: all of them)
+    :return: list of the paths of the minute files (None for the ones that couldn't be written)
+    """
+    with h5py.File(daily_file_path, "r") as hdf5file_obj:
+        if station_name is None:
+            station_name = hdf5file_obj.attrs["StationName"]
+        main_equation = hdf5file_obj.attrs["MainEquation"]
+        if indices is None:
+            indices = range(len(hdf5file_obj[DailyArchive.minutes_table_name]))
+        return [SingleFileData.write_minute_file(data_output_dir, station_name, read_minute(hdf5file_obj, index),
+                                                 main_equation)
+                for index in indices]
@@ -0,0 +1,186 @@
+import ast
+import decimal
+import functools
+import re
+
+import numpy as np
+
+# names of the data in the expressions, and the keys of their columns in the minute dict (see SingleFileData.normalize())
+data_names = {"CavitiesData": "cavi", "CombData": "comb"}
+
+# functions that can be used in the expressions, with Python's f(x) or Mathematica's F[x] syntax
+functions = {"sqrt": np.sqrt, "exp": np.exp, "log": np.log, "log10": np.log10, "sin": np.sin, "cos": np.cos,
+             "tan": np.tan, "abs": np.abs}
+
+_operators = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.BitXor, ast.USub, ast.UAdd)
+
+# an expression followed by its name and unit: expression["Name",Unit]
+_channel_regex = re.compile(r'^(?P<expression>.*)\[\s*"(?P<name>[^"]*)"\s*,\s*(?P<unit>[^\]]*?)\s*\]\s*$', re.DOTALL)
+
+
+class DerivedChannel:
+    """
+    One of the expressions of a main equation, compiled to be evaluated on whole columns of a minute.
+    Expressions are arithmetic (+, -, *, /, and ^ or ** for powers) of numbers, functions (see functions) and columns
+    of the data, written CavitiesData[[i]] and CombData[[i]], where i is the number of the column in the dataset of the
+    file (starting from 0). They are checked against this grammar before being compiled, so nothing else can be
+    evaluated.
+    """
+
+    def __init__(self, expression, name, unit):
+        """
+        :param expression: the expression, e.g. CombData[[1]]+CombData[[0]]/2
+        :param name: name of the channel
+        :param unit: unit of the channel
+        """
+        self.expression = expression
+        self.name = name
+        self.unit = unit
+        self.columns = set()  # (data key, column number) of the columns the expression uses
+        try:
+            tree = ast.parse(expression.strip(), mode="eval")
+        except SyntaxError as e:
+            raise ValueError("Invalid expression " + expression + ": " + str(e))
+        tree = ast.fix_missing_locations(self._convert(tree))
+        self.code = compile(tree, "<" + name + ">", "eval")
+
+    @staticmethod
+    def variable_name(key, column):
+        return key + "_" + str(column)
+
+    def _convert(self, node):
+        """
+        Check a node of the syntax tree of the expression, and convert it to what is evaluated: data columns become
+        variables, F[x] becomes f(x) and ^ becomes **
+        :return: the converted node
+        """
+        if isinstance(node, ast.Expression):
+            return ast.Expression(body=self._convert(node.body))
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return node
+        if isinstance(node, ast.BinOp) and isinstance(node.op, _operators):
+            op = ast.Pow() if isinstance(node.op, ast.BitXor) else node.op
+            return ast.BinOp(left=self._convert(node.left), op=op, right=self._convert(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, _operators):
+            return ast.UnaryOp(op=node.op, operand=self._convert(node.operand))
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name):
+            if node.value.id in data_names:
+                return self._convert_column(node)
+            if node.value.id.lower() in functions:
+                return self._convert_call(node.value.id, [node.slice])
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id.lower() in functions and \
+                len(node.keywords) == 0:
+            return self._convert_call(node.func.id, node.args)
+        raise ValueError("Unsupported element '" + ast.unparse(node) + "' in the expression " + self.expression)
+
+    def _convert_column(self, node):
+        index = node.slice
+        # Mathematica's Data[[i]] is parsed by Python as a subscript with a list of one element
+        if isinstance(index, ast.List) and len(index.elts) == 1:
+            index = index.elts[0]
+        if not (isinstance(index, ast.Constant) and type(index.value) is int and index.value >= 0):
+            raise ValueError("Columns must be given by their number, e.g. " + node.value.id + "[[0]], in the "
+                             "expression " + self.expression)
+        key = data_names[node.value.id]
+        self.columns.add((key, index.value))
+        return ast.Name(id=DerivedChannel.variable_name(key, index.value), ctx=ast.Load())
+
+    def _convert_call(self, name, args):
+        if len(args) != 1:
+            raise ValueError("The function " + name + " takes one argument, in the expression " + self.expression)
+        return ast.Call(func=ast.Name(id=name.lower(), ctx=ast.Load()), args=[self._convert(args[0])], keywords=[])
+
+    def evaluate(self, variables, num_samples):
+        """
+        :param variables: dict of the columns (arrays) of the expression, by their variable name
+        :param num_samples: number of samples (for expressions that don't use any column)
+        :return: array of the values of the channel
+        """
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            result = eval(self.code, {"__builtins__": {}}, dict(functions, **variables))
+        return np.full(num_samples, result, dtype=np.longdouble) if np.ndim(result) == 0 else result
+
+
+@functools.lru_cache(maxsize=16)
+def parse_main_equation(main_equation):
+    """
+    Parse a main equation: expressions with their name and unit, separated by "::", e.g.
+    CombData[[1]]+CombData[[0]]/2["First Var",Hz]::CavitiesData[[2]]/3+CavitiesData[[0]]["Second Var",Hz]
+    Equations are parsed and compiled once, and cached
+    :param main_equation: the main equation
+    :return: tuple of DerivedChannel
+    """
+    channels = []
+    for part in main_equation.split("::"):
+        match = _channel_regex.match(part.strip())
+        if match is None:
+            raise ValueError("Expected an expression followed by [\"Name\",Unit] in the main equation, got: " + part)
+        name = match.group("name")
+        if name == "" or "/" in name or name in (c.name for c in channels):
+            raise ValueError("Names of channels in the main equation must be unique, not empty and without '/': " +
+                             name)
+        channels.append(DerivedChannel(match.group("expression"), name, match.group("unit")))
+    return tuple(channels)
+
+
+def _sample_times(num_samples, sample_rate):
+    """
+    :return: seconds since the first sample of the samples of a dataset, as float64
+    """
+    return np.arange(num_samples, dtype=np.float64)/sample_rate
+
+
+def evaluate_main_equation(main_equation, minute, cavi_sample_rate, comb_sample_rate):
+    """
+    Evaluate the channels of a main equation over a minute of data. The columns are the values in the data files (the
+    normalized data plus its offset), in extended precision where the platform has it. Comb data is resampled to the
+    times of the cavities data, by linear interpolation between the comb samples (and held at the first and last
+    sample outside them).
+    :param main_equation: the main equation (see parse_main_equation())
+    :param minute: dict like the one of SingleFileData.normalize()
+    :param cavi_sample_rate: sampling rate of the cavities data (Hz)
+    :param comb_sample_rate: sampling rate of the comb data (Hz)
+    :return: list of tuples (DerivedChannel, array of its values at the times of the cavities data)
+    """
+    channels = parse_main_equation(main_equation)
+    for key in set(data_names.values()):
+        if key + "_data" not in minute:
+            raise ValueError("The main equation is evaluated over the " + ", ".join(sorted(data_names)) + " datasets, "
+                             "and the minute has no " + key + " data")
+    num_samples = len(minute["cavi_data"])
+    cavi_times = _sample_times(num_samples, cavi_sample_rate)
+    comb_times = _sample_times(len(minute["comb_data"]), comb_sample_rate) + \
+        (minute["comb_t0"] - minute["cavi_t0"]) / np.timedelta64(1, "s")
+    variables = {}
+    for channel in channels:
+        for key, column in channel.columns:
+            name = DerivedChannel.variable_name(key, column)
+            if name in variables:
+                continue
+            data = minute[key + "_data"]
+            if column >= data.shape[1]:
+                raise ValueError("The main equation uses the column " + str(column) + " of " + key + " data, which "
+                                 "has " + str(data.shape[1]) + " columns")
+            values = data[:, column]
+            if key == "comb":
+                if len(values) == 0:
+                    raise ValueError("There's no comb data to resample")
+                # the normalized data is interpolated, before adding the offset, to keep its precision
+                values = np.interp(cavi_times, comb_times, values)
+            variables[name] = values.astype(np.longdouble) + np.longdouble(minute[key + "_offsets"][column])
+    return [(channel, channel.evaluate(variables, num_samples)) for channel in channels]
+
+
+def normalize_channel(values, prec=4):
+    """
+    Subtract an offset from the values of a channel, like SingleFileData.create_normalized_list() does with the data:
+    their mean, rounded to prec significant digits
+    :param values: array of the values
+    :param prec: number of significant digits of the offset
+    :return: tuple (float64 array, offset as float64)
+    """
+    finite = values[np.isfinite(values)]
+    offset = 0.0
+    if len(finite) > 0:
+        offset = float(decimal.Context(prec=prec).create_decimal(float(finite.mean())))
+    return (values - np.longdouble(offset)).astype(np.float64), np.float64(offset)
@@ -0,0 +1,244 @@
+import decimal
+import numpy as np
+
+
+class FixedPointArray:
+    """
+    A column of exact decimal numbers, held as integer mantissas that share one decimal exponent, so that
+    value[i] = mantissa[i] * 10**exponent
+    Mantissas are stored as int64 when they all fit, and as Python integers (numpy object array) otherwise,
+    so no precision is ever lost, no matter how many digits the data files have
+    """
+
+    def __init__(self, mantissa, exponent=0, negative_zero=None):
+        """
+        :param mantissa: numpy array of integer mantissas (int64 or object)
+        :param exponent: the common decimal exponent of the column
+        :param negative_zero: boolean mask of values that were written as negative zero (e.g. "-0.000"), or None
+        """
+        self.mantissa = mantissa
+        self.exponent = exponent
+        self.negative_zero = negative_zero
+
+    @staticmethod
+    def _parse_number(s):
+        """
+        Convert a single number (str or bytes) to a mantissa and the number of digits after the decimal point
+        :param s: number, e.g. "-12.0500"
+        :return: tuple (mantissa, scale), where value = mantissa * 10**(-scale)
+        """
+        point = b"." if isinstance(s, bytes) else "."
+        integer_part, found, fraction_part = s.partition(point)
+        try:
+            return int(integer_part + fraction_part), len(fraction_part)
+        except ValueError:
+            pass
+        # anything that is not plain "digits.digits" goes through Decimal, which understands all the other forms
+        d = decimal.Decimal(s.decode() if isinstance(s, bytes) else s)
+        if not d.is_finite():
+            raise ValueError("Only finite numbers can be stored as fixed-point: " + str(s))
+        sign, digits, exponent = d.as_tuple()
+        mantissa = int("".join(map(str, digits))) * (-1 if sign else 1)
+        if exponent > 0:
+            return mantissa * 10**exponent, 0
+        return mantissa, -exponent
+
+    @staticmethod
+    def _to_mantissa_array(values):
+        """
+        Put a list of Python integers in a numpy array, as int64 if possible, or as objects otherwise
+        :param values: list of int
+        :return: numpy array
+        """
+        try:
+            return np.array(values, dtype=np.int64)
+        except OverflowError:
+            arr = np.empty(len(values), dtype=object)
+            arr[:] = values
+            return arr
+
+    @staticmethod
+    def from_strings(strings):
+        """
+        Create a fixed-point column from the text representation of the numbers. Conversion is exact.
+        :param strings: list of numbers as str or bytes
+        :return: FixedPointArray
+        """
+        if len(strings) == 0:
+            return FixedPointArray.empty()
+        parsed = [FixedPointArray._parse_number(s) for s in strings]
+        scale = max(p[1] for p in parsed)
+        pow10 = [10**k for k in range(scale + 1)]
+        mantissa = FixedPointArray._to_mantissa_array([m * pow10[scale - sc] for m, sc in parsed])
+
+        negative_zero = None
+        zeros = np.flatnonzero(mantissa == 0)
+        if len(zeros) > 0:
+            minus = b"-" if isinstance(strings[0], bytes) else "-"
+            mask = np.zeros(len(mantissa), dtype=bool)
+            mask[zeros] = [strings[i].lstrip().startswith(minus) for i in zeros]
+            if mask.any():
+                negative_zero = mask
+        return FixedPointArray(mantissa, -scale, negative_zero)
+
+    @staticmethod
+    def from_plain_strings(strings):
+        """
+        Create a fixed-point column from numbers that are known to be plain decimals: an optional minus sign, digits, and
+        optionally a decimal point and more digits (e.g. the fields checked by a FieldLayout). They are converted with
+        operations on the whole column, instead of number by number. The result is the same as from_strings(), which
+        is used instead when the mantissas don't fit in int64
+        :param strings: list of numbers as str or bytes
+        :return: FixedPointArray
+        """
+        if len(strings) == 0:
+            return FixedPointArray.empty()
+        text = np.array(strings)
+        point = b"." if text.dtype.kind == "S" else "."
+        dot = np.char.find(text, point)
+        scales = np.where(dot >= 0, np.char.str_len(text) - dot - 1, 0)
+        scale = int(scales.max())
+        try:
+            mantissa = np.char.replace(text, point, point[:0]).astype(np.int64)
+        except OverflowError:
+            return FixedPointArray.from_strings(strings)
+        if scale > 18:
+            return FixedPointArray.from_strings(strings)
+        factors = np.array([10**k for k in range(scale + 1)], dtype=np.int64)[scale - scales]
+        if np.any(np.abs(mantissa) > np.iinfo(np.int64).max // factors):
+            return FixedPointArray.from_strings(strings)
+        mantissa = mantissa * factors
+
+        negative_zero = None
+        zeros = mantissa == 0
+        if zeros.any():
+            mask = zeros & np.char.startswith(text, b"-" if text.dtype.kind == "S" else "-")
+            if mask.any():
+                negative_zero = mask
+        return FixedPointArray(mantissa, -scale, negative_zero)
+
+    @staticmethod
+    def empty():
+        return FixedPointArray(np.zeros(0, dtype=np.int64), 0)
+
+    def __len__(self):
+        return len(self.mantissa)
+
+    def __getitem__(self, index):
+        """
+        Select elements with a slice, a boolean mask or an index array
+        :param index: slice/mask/index array
+        :return: FixedPointArray
+        """
+        negative_zero = None if self.negative_zero is None else self.negative_zero[index]
+        return FixedPointArray(self.mantissa[index], self.exponent, negative_zero)
+
+    def rescale(self, exponent):
+        """
+        Express the column with a smaller (or equal) exponent, by scaling the mantissas. Exact.
+        :param exponent: the new exponent
+        :return: FixedPointArray
+        """
+        if exponent > self.exponent:
+            raise ValueError("Rescaling to a larger exponent would lose precision")
+        if exponent == self.exponent:
+            return self
+        factor = 10**(self.exponent - exponent)
+        mantissa = self.mantissa
+        if mantissa.dtype != object:
+            limit = np.iinfo(np.int64).max // factor
+            if len(mantissa) > 0 and np.abs(mantissa).max() > limit:
+                mantissa = mantissa.astype(object)
+        return FixedPointArray(mantissa * factor, exponent, self.negative_zero)
+
+    @staticmethod
+    def concatenate(arrays):
+        """
+        Concatenate columns, with a common exponent for all of them
+        :param arrays: list of FixedPointArray
+        :return: FixedPointArray
+        """
+        arrays = [a for a in arrays if len(a) > 0]
+        if len(arrays) == 0:
+            return FixedPointArray.empty()
+        if len(arrays) == 1:
+            return arrays[0]
+        exponent = min(a.exponent for a in arrays)
+        arrays = [a.rescale(exponent) for a in arrays]
+        if any(a.mantissa.dtype == object for a in arrays):
+            mantissa = np.concatenate([a.mantissa.astype(object) for a in arrays])
+        else:
+            mantissa = np.concatenate([a.mantissa for a in arrays])
+        negative_zero = None
+        if any(a.negative_zero is not None for a in arrays):
+            negative_zero = np.concatenate([np.zeros(len(a), dtype=bool) if a.negative_zero is None
+                                            else a.negative_zero for a in arrays])
+        return FixedPointArray(mantissa, exponent, negative_zero)
+
+    @staticmethod
+    def _exact_sum(mantissa):
+        """
+        Sum integer mantissas without overflow. int64 mantissas are split in 32-bit halves, whose sums can't overflow
+        :param mantissa: numpy array of int64 or objects
+        :return: Python int
+        """
+        if mantissa.dtype == object:
+            return int(mantissa.sum())
+        high, low = np.divmod(mantissa, 1 << 32)
+        return (int(high.sum()) << 32) + int(low.sum())
+
+    def subtract_rounded_mean(self, prec):
+        """
+        Calculate the mean of the column, round it to prec significant digits, and subtract it from every element.
+        This is done on the integer mantissas, and gives exactly the same result as doing it with Decimal in the
+        current Decimal context: summing element by element, dividing by the number of elements, rounding the mean,
+        subtracting it, and finally converting each result to float64
+        :param prec: number of significant digits of the subtracted mean (the offset)
+        :return: tuple (float64 array, offset as Decimal); or None if the Decimal context would have rounded a sum or
+                 a difference (too many digits for its precision), which this can't reproduce
+        """
+        context = decimal.getcontext()
+        limit = 10**context.prec
+        exact = decimal.Context(prec=decimal.MAX_PREC)
+        mantissa = self.mantissa
+        if mantissa.dtype != object and len(mantissa) > 0 and mantissa.min() == np.iinfo(np.int64).min:
+            mantissa = mantissa.astype(object)
+
+        # if the sum of absolute values fits in the precision, every partial sum with Decimal is exact
+        if FixedPointArray._exact_sum(np.abs(mantissa)) >= limit:
+            return None
+        total = decimal.Decimal(FixedPointArray._exact_sum(mantissa)).scaleb(self.exponent, context=exact)
+        mean = total / len(mantissa)
+        offset = decimal.Context(prec=context.prec).create_decimal(decimal.Context(prec=prec).create_decimal(mean))
+
+        # bring the column and the offset to a common exponent, and subtract
+        exponent = min(self.exponent, offset.as_tuple().exponent)
+        diff = self.rescale(exponent).mantissa - int(offset.scaleb(-exponent, context=exact))
+        max_diff = int(np.abs(diff).max()) if len(diff) > 0 else 0
+        if max_diff >= limit:
+            return None
+
+        # convert to float64 with correct rounding, like float(Decimal) does. Dividing two floats that are exact
+        # (integers up to 2**53 and powers of ten up to 10**22) is correctly rounded; otherwise use exact int division
+        scale = 10**(-exponent)
+        if max_diff <= 2**53 and scale <= 10**22:
+            result = diff.astype(np.float64) / float(scale)
+        else:
+            result = np.array([int(d) / scale for d in diff], dtype=np.float64)
+
+        # -0 - 0 is the only difference that gives negative zero
+        if self.negative_zero is not None and offset.is_zero():
+            result[self.negative_zero] = -0.0
+        return result, offset
+
+    def to_decimals(self):
+        """
+        Convert the column to a list of Decimal objects (exact)
+        :return: list of decimal.Decimal
+        """
+        exact = decimal.Context(prec=decimal.MAX_PREC)
+        result = [decimal.Decimal(int(m)).scaleb(self.exponent, context=exact) for m in self.mantissa]
+        if self.negative_zero is not None:
+            for i in np.flatnonzero(self.negative_zero):
+                result[i] = result[i].copy_negate()
+        return result
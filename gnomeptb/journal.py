@@ -0,0 +1,149 @@
+import datetime as dt
+import json
+import os
+import threading
+
+from gnomeptb.analysis import print_error, publish_file
+
+
+class OffsetJournal:
+    """
+    A small file that records how far the data files are processed, so that after a restart (or a crash) reading
+    resumes where it stopped, instead of reading the files from the beginning again.
+    For the last minute that was written, it has the byte positions in the files of every stream (the cavities and comb
+    files) of the first lines that are not in it or in any minute before it. The aligner carries nothing else over
+    from one minute to the next, so reading from these positions gets the program back to the same state.
+    The journal is saved, atomically and durably, every time a minute is written. Minutes that are written out of order
+    (by several writers) are recorded in order, so the journal never skips a minute that's still being written.
+    """
+    version = 1
+
+    def __init__(self, path):
+        """
+        :param path: path of the journal file; if it exists, it has the state of a previous run
+        """
+        self.path = path
+        self.state = OffsetJournal.load(path)
+        self.lock = threading.Lock()
+        self.next_sequence = 0  # sequence number of the next minute that is added
+        self.next_commit = 0  # sequence number of the first minute that is not recorded yet
+        self.minutes = {}  # sequence number -> [resume state, start time, whether it's finished]
+
+    @staticmethod
+    def load(path):
+        """
+        :param path: path of the journal file
+        :return: the state in the file (dict), or None if there's no valid journal
+        """
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print_error("Unable to read the journal " + path + ", starting from the beginning of the files. "
+                        "Exception says: " + str(e))
+            return None
+        if not isinstance(state, dict) or state.get("version") != OffsetJournal.version:
+            print_error("The journal " + path + " has an unknown format, starting from the beginning of the files.")
+            return None
+        return state
+
+    def resume_offsets(self, cavi_file_path, comb_file_path):
+        """
+        Find where to start reading a pair of files from. Files other than the ones in the journal (e.g. the files
+        after them, if the ones in the journal were finished) are read from the beginning
+        :param cavi_file_path: path of the cavities file
+        :param comb_file_path: path of the comb file
+        :return: tuple (byte position in the cavities file, byte position in the comb file)
+        """
+        offsets = self.resume_stream_offsets({"cavi": cavi_file_path, "comb": comb_file_path})
+        return offsets["cavi"], offsets["comb"]
+
+    def resume_stream_offsets(self, file_paths):
+        """
+        Find where to start reading the files of the streams of a station from, like resume_offsets()
+        :param file_paths: dict of the paths of the files, by stream name
+        :return: dict of the byte positions in the files, by stream name
+        """
+        offsets = {}
+        for prefix, file_path in file_paths.items():
+            offset = 0
+            if self.state is not None and prefix + "_file" in self.state and \
+                    os.path.abspath(self.state[prefix + "_file"]) == os.path.abspath(file_path):
+                offset = self.state[prefix + "_offset"]
+                if offset > os.path.getsize(file_path):
+                    print_error("The file " + file_path + " is shorter than the position in the journal. "
+                                "It's read from the beginning.")
+                    offset = 0
+                else:
+                    print("Resuming " + file_path + " from byte " + str(offset) + ", after the minute " +
+                          str(self.state["last_minute"]))
+            offsets[prefix] = offset
+        return offsets
+
+    def is_past(self, file_paths, offsets):
+        """
+        Whether the minutes recorded in the journal have all the lines of files up to the given positions, so that
+        they're not read again after a restart. The files have to be read in order, and not before the files in the
+        journal (e.g. the first files that were read after the ones in the journal are finished)
+        :param file_paths: dict of the paths of the files, by stream name
+        :param offsets: dict of the byte positions in the files, by stream name
+        :return: bool
+        """
+        state = self.state
+        if state is None:
+            return False
+        for prefix, file_path in file_paths.items():
+            if prefix + "_file" not in state:
+                return False
+            # the journal resumes from a later file, or from this one past the position
+            if os.path.abspath(state[prefix + "_file"]) == os.path.abspath(file_path) and \
+                    state[prefix + "_offset"] < offsets[prefix]:
+                return False
+        return True
+
+    def add_minute(self, minute):
+        """
+        Take note of a minute that is going to be written. Minutes have to be added in the order of the data
+        :param minute: SingleFileData object with a complete minute of data
+        :return: sequence number of the minute, to be given to finish_minute()
+        """
+        with self.lock:
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            self.minutes[sequence] = [minute.resume_state, minute.start_time(), False]
+        return sequence
+
+    def finish_minute(self, sequence):
+        """
+        Take note that a minute is written (or that writing it failed, which can't be helped by writing it again), and
+        save the journal if all the minutes before it are finished too
+        :param sequence: sequence number of the minute, from add_minute()
+        :return: None
+        """
+        with self.lock:
+            self.minutes[sequence][2] = True
+            latest = None
+            while self.next_commit in self.minutes and self.minutes[self.next_commit][2]:
+                resume_state, start_time, _ = self.minutes.pop(self.next_commit)
+                self.next_commit += 1
+                if resume_state is not None:
+                    latest = (resume_state, start_time)
+            if latest is not None:
+                self._save(*latest)
+
+    def _save(self, resume_state, start_time):
+        state = dict(resume_state)
+        state["version"] = OffsetJournal.version
+        state["last_minute"] = str(start_time)
+        state["saved"] = str(dt.datetime.utcnow())
+        temp_path = os.path.join(os.path.dirname(self.path) or ".", "." + os.path.basename(self.path) + ".tmp")
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(state, f, indent=1)
+            publish_file(temp_path, self.path)
+        except OSError as e:
+            print_error("Unable to save the journal " + self.path + ". Exception says: " + str(e))
+            return
+        self.state = state
@@ -0,0 +1,243 @@
+import datetime as dt
+import json
+import os
+import threading
+import time
+
+from gnomeptb.analysis import print_error, publish_file
+
+
+class Counter:
+    """
+    A number that only goes up (e.g. lines read), or a function that returns such a number
+    """
+    kind = "counter"
+
+    def __init__(self, function=None):
+        self.function = function
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.count += amount
+
+    def value(self):
+        return self.function() if self.function is not None else self.count
+
+
+class Gauge:
+    """
+    A number that goes up and down (e.g. the number of lines in a queue), or a function that returns it
+    """
+    kind = "gauge"
+
+    def __init__(self, function=None):
+        self.function = function
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def value(self):
+        return self.function() if self.function is not None else self.current
+
+
+class Histogram:
+    """
+    The distribution of observed values (e.g. durations), as the numbers of values up to each bucket boundary, with
+    their count and sum
+    """
+    kind = "histogram"
+
+    def __init__(self, buckets):
+        """
+        :param buckets: increasing list of the upper boundaries of the buckets
+        """
+        self.buckets = list(buckets)
+        self.counts = [0]*len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for i, boundary in enumerate(self.buckets):
+                if value <= boundary:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    def value(self):
+        """
+        :return: dict with "count", "sum" and "buckets" (list of tuples (boundary, number of values up to it))
+        """
+        with self.lock:
+            cumulative = 0
+            buckets = []
+            for boundary, count in zip(self.buckets, self.counts):
+                cumulative += count
+                buckets.append((boundary, cumulative))
+            return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class MetricsRegistry:
+    """
+    The metrics of the program, by name and labels (e.g. gnomeptb_lines_read_total with stream="cavi")
+    Metrics are created the first time they're asked for, and the same object is returned afterwards. They can be
+    written as JSON or in the Prometheus text format (see MetricsExporter).
+    """
+
+    def __init__(self, prefix="gnomeptb_"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.metrics = {}  # name -> (help, {labels: metric})
+        self.start_time = time.time()
+
+    def _get(self, name, help_text, labels, create):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            _, by_labels = self.metrics.setdefault(self.prefix + name, (help_text, {}))
+            if key not in by_labels:
+                by_labels[key] = create()
+            return by_labels[key]
+
+    def counter(self, name, help_text, function=None, **labels):
+        return self._get(name, help_text, labels, lambda: Counter(function))
+
+    def gauge(self, name, help_text, function=None, **labels):
+        return self._get(name, help_text, labels, lambda: Gauge(function))
+
+    def histogram(self, name, help_text, buckets, **labels):
+        return self._get(name, help_text, labels, lambda: Histogram(buckets))
+
+    def collect(self):
+        """
+        :return: list of tuples (name, help, kind, labels as a dict, value) of all the metrics
+        """
+        with self.lock:
+            metrics = [(name, help_text, list(by_labels.items())) for name, (help_text, by_labels) in
+                       sorted(self.metrics.items())]
+        samples = []
+        for name, help_text, by_labels in metrics:
+            for key, metric in by_labels:
+                try:
+                    value = metric.value()
+                except Exception as e:
+                    print_error("Unable to get the value of the metric " + name + ". Exception says: " + str(e))
+                    continue
+                samples.append((name, help_text, metric.kind, dict(key), value))
+        return samples
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels.items()) + ([extra] if extra is not None else [])
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"' for k, v in items) + "}"
+
+
+def to_prometheus(samples):
+    """
+    :param samples: list from MetricsRegistry.collect()
+    :return: the metrics in the Prometheus text format (str)
+    """
+    lines = []
+    described = set()
+    for name, help_text, kind, labels, value in samples:
+        if name not in described:
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + kind)
+            described.add(name)
+        if kind == "histogram":
+            for boundary, count in value["buckets"]:
+                lines.append(name + "_bucket" + _format_labels(labels, ("le", repr(float(boundary)))) + " " +
+                             str(count))
+            lines.append(name + "_bucket" + _format_labels(labels, ("le", "+Inf")) + " " + str(value["count"]))
+            lines.append(name + "_sum" + _format_labels(labels) + " " + repr(float(value["sum"])))
+            lines.append(name + "_count" + _format_labels(labels) + " " + str(value["count"]))
+        else:
+            lines.append(name + _format_labels(labels) + " " + repr(float(value)))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """
+    Writes the metrics of a registry to a file every few seconds, in a background thread, so that they can be looked
+    at (or collected, e.g. by the textfile collector of the Prometheus node exporter) without any service in the
+    program. The file is replaced atomically, so it's never seen half-written.
+    Files whose names end with .prom are written in the Prometheus text format, others as JSON. The JSON has the
+    rates per second of the counters too, over the time since the file was written last.
+    """
+
+    def __init__(self, registry, path, interval=10):
+        """
+        :param registry: MetricsRegistry
+        :param path: path of the file
+        :param interval: seconds between writes
+        """
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.prometheus = path.endswith(".prom")
+        self.previous = {}  # (name, labels) -> value of counters at the previous write
+        self.previous_time = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self.write()
+
+    def to_json(self, samples):
+        now = time.time()
+        elapsed = now - self.previous_time if self.previous_time is not None else None
+        metrics = {}
+        for name, _, kind, labels, value in samples:
+            entry = {"labels": labels, "value": value}
+            if kind == "counter":
+                key = (name, tuple(sorted(labels.items())))
+                if elapsed and key in self.previous:
+                    entry["rate"] = (value - self.previous[key])/elapsed
+                self.previous[key] = value
+            metrics.setdefault(name, []).append(entry)
+        self.previous_time = now
+        return json.dumps({"time": str(dt.datetime.utcnow()), "uptime_s": now - self.registry.start_time,
+                           "metrics": metrics}, indent=1)
+
+    def write(self):
+        """
+        Write the current values of the metrics to the file
+        :return: None
+        """
+        samples = self.registry.collect()
+        text = to_prometheus(samples) if self.prometheus else self.to_json(samples)
+        temp_path = os.path.join(os.path.dirname(self.path) or ".", "." + os.path.basename(self.path) + ".tmp")
+        try:
+            with open(temp_path, "w") as f:
+                f.write(text)
+            publish_file(temp_path, self.path)
+        except OSError as e:
+            print_error("Unable to write the metrics to " + self.path + ". Exception says: " + str(e))
+
+    def stop(self):
+        """
+        Stop writing, and write the final values
+        :return: None
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.write()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,334 @@
+import concurrent.futures
+import queue
+import threading
+
+import numpy as np
+
+from gnomeptb.analysis import print_error, DataCollection, LineData, StreamAligner
+from gnomeptb.daily import DailyArchive
+from gnomeptb.metrics import MetricsRegistry
+from gnomeptb.processes import process_pool
+from gnomeptb.tailing import MappedLines
+from gnomeptb.writer import WriterPool
+
+# marks the end of the data, passed from each stage to the next one
+_END = object()
+
+# parsers of a worker process by regex, made by _parse_in_worker() the first time a regex is parsed
+_worker_line_data = {}
+
+
+class _Stopped(Exception):
+    """
+    Raised in a stage that waits on a queue, when the pipeline is stopped
+    """
+    pass
+
+
+def _parse_piece(line_data, piece):
+    """
+    Parse lines as they come from get_data()
+    :param line_data: LineData object to parse with
+    :param piece: a list of lines (str or bytes), or MappedLines
+    :return: LineBatch
+    """
+    if isinstance(piece, MappedLines):
+        return line_data.parse_buffer(piece)
+    return line_data.parse_many(piece)
+
+
+def _init_parser(decimal_precision):
+    """
+    Set up a worker process that parses lines
+    """
+    LineData.set_decimal_precision(decimal_precision)
+
+
+def _parse_in_worker(regex, piece):
+    """
+    Parse lines in a worker process. Any worker parses the lines of any stream, so the streams (of all the stations
+    that share the workers) are spread over them
+    :param regex: regular expression of the lines
+    :param piece: lines, as for _parse_piece()
+    :return: LineBatch
+    """
+    if regex not in _worker_line_data:
+        _worker_line_data[regex] = LineData(regex)
+    return _parse_piece(_worker_line_data[regex], piece)
+
+
+def parser_pool(num_parsers):
+    """
+    Start worker processes that parse lines, which can be shared by several pipelines (see Pipeline)
+    :param num_parsers: number of processes
+    :return: the pool (concurrent.futures.Executor), to be shut down by the caller
+    """
+    return process_pool(num_parsers, initializer=_init_parser, initargs=(LineData.decimal_precision(),))
+
+
+class Pipeline:
+    """
+    Processes the data in four stages that run at the same time:
+    reader (get_data()) -> parser -> aligner (StreamAligner) -> writer (WriterPool)
+    The reader, parser and aligner run in their own threads, connected by bounded queues, and the aligner gives complete
+    minutes to a WriterPool, which limits the number of minutes being written. When a stage falls behind, the queue
+    before it fills up and the stages before it wait (back-pressure), so the memory use stays bounded and reading slows
+    down to the pace of the slowest stage, instead of piling up lines.
+    Parsing can be spread over several processes (num_parsers > 1); the parsed chunks are still aligned in the order
+    they were read. The parsing processes can be shared by the pipelines of several stations (see run_pipelines()).
+    Writing can be spread over several processes too (num_writers > 1).
+    With an archive directory, minutes are appended to daily files (see DailyArchive) instead, by a single thread.
+    Every stage records what it does in self.metrics (a MetricsRegistry): lines read, parsed (by the fast tokenizer or
+    the regex) and that failed to parse, the sizes of the queues, batches rejected by the sanity check, and the durations and lag of the writes. They can be
+    written to a file periodically with a MetricsExporter. With a Profiler, every minute that the aligner emits is
+    reported to it, with the sizes of the queues.
+    """
+    poll_interval = 0.5  # seconds, how often stages waiting on a queue check whether the pipeline is stopped
+
+    def __init__(self, cavity_regex, comb_regex, data_output_dir, station_name, queue_size=4, num_parsers=1,
+                 num_writers=1, archive_dir=None, journal=None, profiler=None, streams=None, shared_parsers=None):
+        """
+        :param cavity_regex: regular expression of the cavities data (if streams is None)
+        :param comb_regex: regular expression of the comb data (if streams is None)
+        :param data_output_dir: output directory of the HDF5 files
+        :param station_name: station name
+        :param queue_size: maximum number of chunks of lines waiting between two stages
+        :param num_parsers: number of processes that parse lines; with 1, lines are parsed in the parser thread
+        :param num_writers: number of processes that write minutes; with 1, minutes are written in a thread
+        :param archive_dir: if given, minutes are appended to daily files in this directory, instead of being written
+                            to files of their own in data_output_dir
+        :param journal: OffsetJournal to record the written minutes in, if any (see get_data() to resume from it)
+        :param profiler: started Profiler to report the emitted minutes to, if any
+        :param streams: list of StreamDefinition of the data (see get_stream_data() for the data source); by default,
+                        the cavities and comb streams with the regexes above
+        :param shared_parsers: pool of processes that parse lines (see parser_pool()), shared with other pipelines,
+                               which is used instead of num_parsers processes of its own
+        """
+        self.num_parsers = num_parsers
+        self.shared_parsers = shared_parsers
+        self.metrics = MetricsRegistry()
+        if streams is None:
+            self.collection = DataCollection(cavity_regex, comb_regex, data_output_dir, station_name)
+        else:
+            self.collection = StreamAligner(streams, data_output_dir, station_name)
+        self.streams = self.collection.streams
+        self.stream_names = [stream.name for stream in self.streams]
+        self.archive = None
+        if archive_dir is not None:
+            if self.stream_names != ["cavi", "comb"]:
+                raise ValueError("Daily archives have the cavities and comb data only, and can't be written with the "
+                                 "streams " + ", ".join(self.stream_names))
+            # the daily files are appended to in order, so by a single thread
+            self.archive = DailyArchive(archive_dir, station_name)
+            self.writer = WriterPool(1, write_function=self.archive.append, journal=journal, metrics=self.metrics)
+        else:
+            self.writer = WriterPool(num_writers, use_processes=num_writers > 1, journal=journal,
+                                     metrics=self.metrics)
+        self.profiler = profiler
+        self.collection.file_writer.minute_writer = self.writer.submit if profiler is None else self._emit_minute
+        self.read_queue = queue.Queue(queue_size)
+        self.parsed_queue = queue.Queue(queue_size)
+        self.stopping = threading.Event()
+        self.errors = []
+        self._register_metrics()
+
+    def _register_metrics(self):
+        self.lines_read = {}
+        self.lines_parsed = {}
+        self.parse_failures = {}
+        self.tokenized_lines = {}
+        for stream in self.stream_names:
+            self.lines_read[stream] = self.metrics.counter("lines_read_total", "Lines read from the data files",
+                                                           stream=stream)
+            self.lines_parsed[stream] = self.metrics.counter("lines_parsed_total", "Lines parsed", stream=stream)
+            self.parse_failures[stream] = self.metrics.counter("parse_failures_total",
+                                                               "Lines that didn't match the regular expression",
+                                                               stream=stream)
+            # lines split by the tokenizer of the layout of the regex, and the lines matched with the regex instead
+            self.tokenized_lines[stream] = {
+                path: self.metrics.counter("parse_path_lines_total", "Lines parsed by the tokenizer of the layout of "
+                                           "the regex (path=fast) and by the regex (path=regex)",
+                                           stream=stream, path=path)
+                for path in ("fast", "regex")}
+            self.metrics.gauge("processed_queue_lines", "Parsed lines waiting to be aligned",
+                               self.collection.processed_queues[stream].__len__, stream=stream)
+        for name in ("read", "parsed"):
+            self.metrics.gauge("queue_size", "Chunks of lines waiting between two stages",
+                               getattr(self, name + "_queue").qsize, queue=name)
+        self.metrics.counter("batches_rejected_total", "Batches (seconds) rejected by the sanity check, with the "
+                             "minute they were in", lambda: self.collection.file_writer.num_rejected_batches)
+
+    def _put(self, q, item):
+        """
+        Put an item in a queue, waiting while it's full
+        """
+        while True:
+            if self.stopping.is_set():
+                raise _Stopped()
+            try:
+                q.put(item, timeout=Pipeline.poll_interval)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q):
+        """
+        Take an item from a queue, waiting while it's empty
+        """
+        while True:
+            if self.stopping.is_set():
+                raise _Stopped()
+            try:
+                return q.get(timeout=Pipeline.poll_interval)
+            except queue.Empty:
+                pass
+
+    def queue_sizes(self):
+        """
+        :return: dict of the number of items waiting in each queue, and of minutes being written
+        """
+        return {"read": self.read_queue.qsize(), "parsed": self.parsed_queue.qsize(),
+                "write": self.writer.in_flight()}
+
+    def _emit_minute(self, minute):
+        sizes = self.queue_sizes()
+        for stream in self.streams:
+            sizes[stream.name + "_processed_lines"] = len(self.collection.processed_queues[stream.name])
+        self.profiler.minute_emitted(minute.start_time().item(), sizes)
+        self.writer.submit(minute)
+
+    def _read(self, data_source):
+        for data_queues in data_source:
+            if self.stopping.is_set():
+                raise _Stopped()
+            if data_queues["empty"]:
+                print("No new data found...")
+                continue
+            # mapped files are closed (and moved) by the reader, possibly before the lines are parsed
+            for stream in self.stream_names:
+                key = stream + "_queue"
+                self.lines_read[stream].inc(len(data_queues[key]))
+                if isinstance(data_queues[key], MappedLines):
+                    data_queues[key] = data_queues[key].detach()
+            self._put(self.read_queue, data_queues)
+        self._put(self.read_queue, _END)
+
+    def _parse(self):
+        pool = self.shared_parsers
+        if pool is None and self.num_parsers > 1:
+            pool = parser_pool(self.num_parsers)
+        try:
+            while True:
+                data_queues = self._get(self.read_queue)
+                if data_queues is _END:
+                    break
+                if pool is None:
+                    parsed = tuple(_parse_piece(self.collection.line_data[stream.name],
+                                                data_queues[stream.name + "_queue"]) for stream in self.streams)
+                else:
+                    # the futures are queued in order, so the aligner gets the results in order too. The bounded queue
+                    # limits the number of chunks being parsed at once
+                    parsed = tuple(pool.submit(_parse_in_worker, stream.regex, data_queues[stream.name + "_queue"])
+                                   for stream in self.streams)
+                self._put(self.parsed_queue, parsed)
+            self._put(self.parsed_queue, _END)
+        finally:
+            # a shared pool is shut down by whoever made it
+            if pool is not None and pool is not self.shared_parsers:
+                pool.shutdown(wait=not self.stopping.is_set())
+
+    def _align(self):
+        while True:
+            parsed = self._get(self.parsed_queue)
+            if parsed is _END:
+                break
+            batches = [p.result() if isinstance(p, concurrent.futures.Future) else p for p in parsed]
+            for stream, batch in zip(self.stream_names, batches):
+                self.lines_parsed[stream].inc(len(batch))
+                self.parse_failures[stream].inc(int(np.count_nonzero(~batch.success)))
+                self.tokenized_lines[stream]["fast"].inc(batch.num_fast_lines)
+                self.tokenized_lines[stream]["regex"].inc(len(batch) - batch.num_fast_lines)
+                self.collection.append_parsed(stream, batch)
+            self.collection.align()
+
+    def _run_stage(self, stage, *args):
+        try:
+            stage(*args)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            print_error("Pipeline stage '" + threading.current_thread().name + "' failed. Exception says: " + str(e))
+            self.errors.append(e)
+            self.stopping.set()
+
+    def run(self, data_source):
+        """
+        Process all the data of a source, until it ends (which get_data() never does), or until a stage fails.
+        Before returning, the minutes that were given to the writer are all written
+        :param data_source: iterable of dicts, like the ones get_data() (or get_stream_data(), for the streams of the
+                            pipeline) yields
+        :return: None
+        """
+        stages = [("reader", self._read, (data_source,)), ("parser", self._parse, ()),
+                  ("aligner", self._align, ())]
+        threads = [threading.Thread(target=self._run_stage, args=(stage,) + args, name=name, daemon=True)
+                   for name, stage, args in stages]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(Pipeline.poll_interval)
+        except KeyboardInterrupt:
+            self.stopping.set()
+            raise
+        finally:
+            self.writer.close()
+            if self.archive is not None:
+                self.archive.close()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def stop(self):
+        """
+        Stop all the stages. Data that is still in the queues is not processed, but complete minutes that were
+        given to the writer are still written
+        :return: None
+        """
+        self.stopping.set()
+
+
+def run_pipelines(pipelines, data_sources):
+    """
+    Run several pipelines (e.g. of several stations) at the same time in one process, each in threads of its own, until
+    they all end. If one of them fails, all of them are stopped
+    :param pipelines: list of Pipeline
+    :param data_sources: list of the data sources of the pipelines (see Pipeline.run())
+    :return: None
+    """
+    errors = []
+
+    def run(pipeline, data_source):
+        try:
+            pipeline.run(data_source)
+        except BaseException as e:
+            errors.append(e)
+            for other in pipelines:
+                other.stop()
+
+    threads = [threading.Thread(target=run, args=(pipeline, data_source), name="pipeline-" + str(i), daemon=True)
+               for i, (pipeline, data_source) in enumerate(zip(pipelines, data_sources))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(Pipeline.poll_interval)
+    except KeyboardInterrupt:
+        for pipeline in pipelines:
+            pipeline.stop()
+        for thread in threads:
+            thread.join()
+        raise
+    if len(errors) > 0:
+        raise errors[0]
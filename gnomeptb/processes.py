@@ -0,0 +1,17 @@
+import concurrent.futures
+import multiprocessing
+
+
+def process_pool(num_workers=None, initializer=None, initargs=()):
+    """
+    Create a pool of worker processes that are started fresh ("spawn"), on all platforms
+    Forked processes would inherit the open files of this process, including HDF5 files that are being written. HDF5
+    locks the files it opens, so the copies of the locks in the workers would keep the files locked after they're
+    closed here, and they couldn't be opened again (e.g. by the uploader).
+    :param num_workers: number of processes (default: number of CPUs)
+    :param initializer: function to call in every process when it starts
+    :param initargs: arguments of initializer
+    :return: concurrent.futures.ProcessPoolExecutor
+    """
+    return concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                                  initializer=initializer, initargs=initargs)
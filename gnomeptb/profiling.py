@@ -0,0 +1,300 @@
+import datetime as dt
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+
+from gnomeptb.analysis import print_error, mkdir_p
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all the threads of the process every few milliseconds (with sys._current_frames()), in a
+    thread of its own, and counts the samples per thread and function: the samples in which the function was running
+    itself, and the samples in which it was anywhere on the stack (which includes the time in the functions it called).
+    A thread that waits (e.g. on a queue of the pipeline) is sampled in the function it waits in, which shows which
+    stages are idle.
+    Only the threads of this process are sampled; parsers and writers that run in worker processes aren't.
+    """
+
+    def __init__(self, interval=0.01):
+        """
+        :param interval: seconds between samples
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.ignored_threads = set()  # identifiers of the threads that aren't sampled (e.g. of the profiler)
+        self.stopping = threading.Event()
+        self.thread = None
+        self.functions = {}  # (thread name, file, line, function name) -> [self samples, total samples]
+        self.threads = {}  # thread name -> number of samples
+        self.num_samples = 0
+
+    def reset(self):
+        """
+        Start counting from zero
+        :return: the counts until now, as returned by counts()
+        """
+        with self.lock:
+            result = self.counts()
+            self.functions = {}
+            self.threads = {}
+            self.num_samples = 0
+        return result
+
+    def counts(self):
+        """
+        :return: dict with the number of samples ("num_samples"), the samples per thread ("threads"), and the list
+                 "functions" of [thread name, file, line, function name, self samples, total samples], most running
+                 first
+        """
+        functions = sorted(([*key, *counts] for key, counts in self.functions.items()), key=lambda f: -f[4])
+        return {"num_samples": self.num_samples, "threads": dict(self.threads), "functions": functions}
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        self.ignored_threads.add(threading.get_ident())
+        while not self.stopping.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """
+        Take a sample of the stacks of all the threads
+        :return: None
+        """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        with self.lock:
+            self.num_samples += 1
+            for ident, frame in frames.items():
+                if ident in self.ignored_threads:
+                    continue
+                name = names.get(ident, str(ident))
+                self.threads[name] = self.threads.get(name, 0) + 1
+                seen = set()
+                top = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = (name, code.co_filename, code.co_firstlineno, code.co_name)
+                    counts = self.functions.get(key)
+                    if counts is None:
+                        counts = self.functions[key] = [0, 0]
+                    if top:
+                        counts[0] += 1
+                        top = False
+                    # recursive functions are counted once per sample
+                    if key not in seen:
+                        counts[1] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+        del frames
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class Profiler:
+    """
+    Profiling of the running program: a SamplingProfiler runs all the time, and tracemalloc traces the memory that
+    Python allocates. Every few minutes of data that are emitted, a capture is written to a directory of its own in the
+    profile directory: the samples per function since the previous capture (profile.json, with the time of the minute
+    and the sizes of the queues of the pipeline when it was emitted) and a snapshot of the traced memory
+    (memory.snapshot, which can be loaded with tracemalloc.Snapshot.load()). Only the latest captures are kept.
+    Captures are written by a thread of the profiler, so emitting a minute isn't held up by them. See report() to
+    summarize them.
+    """
+    profile_file_name = "profile.json"
+    memory_file_name = "memory.snapshot"
+
+    def __init__(self, directory, every=1, max_captures=60, interval=0.01, trace_memory=True, memory_frames=10):
+        """
+        :param directory: directory of the captures
+        :param every: a capture is made every this number of minutes
+        :param max_captures: number of captures to keep; older ones are removed
+        :param interval: seconds between samples of the stacks
+        :param trace_memory: whether to trace memory allocations with tracemalloc, which slows down the program
+        :param memory_frames: number of frames of the stack that tracemalloc stores with every allocation
+        """
+        self.directory = directory
+        self.every = every
+        self.max_captures = max_captures
+        self.trace_memory = trace_memory
+        self.memory_frames = memory_frames
+        self.sampler = SamplingProfiler(interval)
+        self.requests = queue.Queue()
+        self.num_minutes = 0
+        self.thread = None
+        self.last_capture_time = None
+
+    def start(self):
+        mkdir_p(self.directory)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(self.memory_frames)
+        self.last_capture_time = time.time()
+        self.sampler.start()
+        self.thread = threading.Thread(target=self._run, name="profile-writer", daemon=True)
+        self.thread.start()
+
+    def minute_emitted(self, minute_time, queue_sizes):
+        """
+        Take note that a minute of data was emitted, and make a capture if it's time to
+        :param minute_time: time of the first line of the minute (datetime)
+        :param queue_sizes: dict of the sizes of the queues of the pipeline
+        :return: None
+        """
+        self.num_minutes += 1
+        if self.num_minutes % self.every == 0:
+            self.requests.put((minute_time, dict(queue_sizes)))
+
+    def _run(self):
+        self.sampler.ignored_threads.add(threading.get_ident())
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            try:
+                self.capture(*request)
+            except Exception as e:
+                print_error("Unable to write a profile capture to " + self.directory + ". Exception says: " + str(e))
+
+    def capture(self, minute_time, queue_sizes):
+        """
+        Write a capture of the samples since the previous capture, and of the traced memory
+        :param minute_time: time of the minute the capture is tagged with (datetime, or None)
+        :param queue_sizes: dict of the sizes of the queues, the capture is tagged with
+        :return: path of the directory of the capture
+        """
+        now = time.time()
+        counts = self.sampler.reset()
+        snapshot = None
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)])
+        # named by the time of the capture first, so that sorting the names sorts the captures
+        name = "capture_" + dt.datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f") + "_minute_" + \
+               (minute_time.strftime("%Y%m%d_%H%M%S") if minute_time is not None else "none")
+        # the capture is written to a temporary directory, which is renamed when it's complete
+        temp_path = os.path.join(self.directory, "." + name + ".tmp")
+        mkdir_p(temp_path)
+        profile = {"minute": str(minute_time), "captured": str(dt.datetime.utcnow()),
+                   "seconds": now - self.last_capture_time, "interval": self.sampler.interval,
+                   "queue_sizes": queue_sizes, "traced_memory_bytes": tracemalloc.get_traced_memory()[0]}
+        profile.update(counts)
+        self.last_capture_time = now
+        with open(os.path.join(temp_path, Profiler.profile_file_name), "w") as f:
+            json.dump(profile, f)
+        if snapshot is not None:
+            snapshot.dump(os.path.join(temp_path, Profiler.memory_file_name))
+        path = os.path.join(self.directory, name)
+        os.replace(temp_path, path)
+        self._rotate()
+        return path
+
+    def _rotate(self):
+        captures = list_captures(self.directory)
+        for name in captures[:max(0, len(captures) - self.max_captures)]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def stop(self):
+        """
+        Stop profiling, after writing the captures that were requested
+        :return: None
+        """
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+        self.sampler.stop()
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def list_captures(directory):
+    """
+    :param directory: directory of the captures of a Profiler
+    :return: names of the captures in the directory, oldest first
+    """
+    return sorted(name for name in os.listdir(directory) if name.startswith("capture_"))
+
+
+def _short_location(file_name, line, function_name=None):
+    location = os.path.join(os.path.basename(os.path.dirname(file_name)), os.path.basename(file_name)) + ":" + \
+               str(line)
+    return location + " " + function_name if function_name is not None else location
+
+
+def report(directory, top=20, cumulative=False):
+    """
+    Print a summary of the captures of a Profiler: the tags of the captures, the functions with the most samples in
+    every thread across all the captures, and the allocation sites with the most memory in the latest capture, and that
+    grew the most since the first one
+    :param directory: directory of the captures
+    :param top: number of functions (per thread) and allocation sites to print
+    :param cumulative: whether to sort functions by total samples (with the functions they call) instead of their own
+    :return: None
+    """
+    captures = list_captures(directory)
+    if len(captures) == 0:
+        print("No captures in " + directory)
+        return
+
+    functions = {}
+    threads = {}
+    print("%-28s %-28s %8s %10s  %s" % ("captured", "minute", "samples", "memory MB", "queue sizes"))
+    for name in captures:
+        with open(os.path.join(directory, name, Profiler.profile_file_name)) as f:
+            profile = json.load(f)
+        for thread_name, samples in profile["threads"].items():
+            threads[thread_name] = threads.get(thread_name, 0) + samples
+        for thread_name, file_name, line, function_name, self_samples, total_samples in profile["functions"]:
+            counts = functions.setdefault(thread_name, {}).setdefault((file_name, line, function_name), [0, 0])
+            counts[0] += self_samples
+            counts[1] += total_samples
+        print("%-28s %-28s %8d %10.1f  %s" % (profile["captured"], profile["minute"], profile["num_samples"],
+                                               profile["traced_memory_bytes"]/1e6, profile["queue_sizes"]))
+
+    print("")
+    print("Top functions of every thread over " + str(len(captures)) + " captures (percentages of the samples of the "
+          "thread):")
+    for thread_name, num_samples in sorted(threads.items(), key=lambda item: -item[1]):
+        print("")
+        print("Thread " + thread_name + " (" + str(num_samples) + " samples)")
+        print("%8s %8s  %s" % ("self %", "total %", "function"))
+        ordered = sorted(functions.get(thread_name, {}).items(), key=lambda item: -item[1][1 if cumulative else 0])
+        for (file_name, line, function_name), (self_samples, total_samples) in ordered[:top]:
+            print("%8.2f %8.2f  %s" % (100*self_samples/num_samples, 100*total_samples/num_samples,
+                                       _short_location(file_name, line, function_name)))
+
+    snapshots = [os.path.join(directory, name, Profiler.memory_file_name) for name in captures]
+    snapshots = [path for path in snapshots if os.path.exists(path)]
+    if len(snapshots) == 0:
+        return
+    latest = tracemalloc.Snapshot.load(snapshots[-1])
+    print("")
+    print("Top allocation sites in the latest capture:")
+    for stat in latest.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        print("%10.1f KB %8d blocks  %s" % (stat.size/1e3, stat.count, _short_location(frame.filename, frame.lineno)))
+    if len(snapshots) > 1:
+        first = tracemalloc.Snapshot.load(snapshots[0])
+        print("")
+        print("Top growing allocation sites since the first capture:")
+        for stat in latest.compare_to(first, "lineno")[:top]:
+            frame = stat.traceback[0]
+            print("%+10.1f KB %+8d blocks  %s" % (stat.size_diff/1e3, stat.count_diff,
+                                                  _short_location(frame.filename, frame.lineno)))
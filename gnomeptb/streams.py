@@ -0,0 +1,96 @@
+import json
+import os
+
+
+class StreamDefinition:
+    """
+    A data stream of a station: the lines of the data files in a sub-directory of the working directory (e.g. the
+    cavities or the comb counter), how they're parsed, and how they're written to the HDF5 files.
+    The streams of a station are aligned in time on the sync points of one of them, the sync reference: every second
+    between two of its sync points is matched with the lines of the other streams in the same time window, and the
+    minutes are named after the time of its first line.
+    """
+
+    def __init__(self, name, regex, columns, sample_rate, subdir=None, dataset_name=None, units="Hz",
+                 sync_reference=False):
+        """
+        :param name: name of the stream, which prefixes its keys in the dicts of the data source and of the minutes
+                     (e.g. "cavi" for "cavi_queue" and "cavi_data")
+        :param regex: regular expression of its lines (see LineData)
+        :param columns: numbers of the data columns that are written to the HDF5 files
+        :param sample_rate: number of lines per second (Hz)
+        :param subdir: sub-directory of the working directory with its data files (default: the name)
+        :param dataset_name: name of its dataset in the HDF5 files (default: the name)
+        :param units: units of its data, written with the dataset
+        :param sync_reference: whether the other streams are aligned on its sync points
+        """
+        self.name = name
+        self.regex = regex
+        self.columns = list(columns)
+        self.sample_rate = sample_rate
+        self.subdir = subdir if subdir is not None else name
+        self.dataset_name = dataset_name if dataset_name is not None else name
+        self.units = units
+        self.sync_reference = sync_reference
+
+    def __repr__(self):
+        return "StreamDefinition(" + self.name + (", sync reference" if self.sync_reference else "") + ")"
+
+    @staticmethod
+    def from_dict(definition):
+        """
+        :param definition: dict with the arguments of the constructor, e.g. as read from a JSON file
+        :return: StreamDefinition
+        """
+        return StreamDefinition(**definition)
+
+
+def reference_stream(streams):
+    """
+    Check the streams of a station, and find their sync reference
+    :param streams: list of StreamDefinition
+    :return: the StreamDefinition that is the sync reference
+    """
+    names = [stream.name for stream in streams]
+    if len(set(names)) != len(names):
+        raise ValueError("The names of the streams of a station must be unique, got: " + ", ".join(names))
+    references = [stream for stream in streams if stream.sync_reference]
+    if len(references) != 1:
+        raise ValueError("Exactly one of the streams of a station must be the sync reference, got " +
+                         str(len(references)) + " among: " + ", ".join(names))
+    return references[0]
+
+
+def load_stations(path):
+    """
+    Read the configuration of the stations that a single program serves, from a JSON file with a list of stations,
+    e.g.
+    [{"station_name": "ptb01", "workdir": "D:/ClockData", "output_dir": "output",
+      "journal": "D:/ClockData/gnomeptb_journal.json", "archive_dir": null,
+      "streams": [{"name": "cavi", "regex": "...", "columns": [0, 1, 2], "sample_rate": 1000, "subdir": "Cavities",
+                   "dataset_name": "CavitiesData", "sync_reference": true}, ...]}]
+    "output_dir" is "output" if not given. "journal" is the path of the journal of the station (by default
+    gnomeptb_journal.json in its working directory), and "archive_dir" the directory of its daily files, if its
+    minutes are appended to daily files (see DailyArchive); both are optional
+    :param path: path of the file
+    :return: list of dicts with "station_name", "workdir", "output_dir", "journal", "archive_dir" and "streams" (list
+             of StreamDefinition)
+    """
+    with open(path) as f:
+        stations = json.load(f)
+    result = []
+    for station in stations:
+        streams = [StreamDefinition.from_dict(definition) for definition in station["streams"]]
+        reference_stream(streams)
+        journal = station.get("journal") or os.path.join(station["workdir"], "gnomeptb_journal.json")
+        result.append({"station_name": station["station_name"], "workdir": station["workdir"],
+                       "output_dir": station.get("output_dir", "output"), "journal": journal,
+                       "archive_dir": station.get("archive_dir"), "streams": streams})
+    names = [station["station_name"] for station in result]
+    if len(set(names)) != len(names):
+        raise ValueError("The names of the stations in " + path + " must be unique")
+    journals = [os.path.abspath(station["journal"]) for station in result]
+    if len(set(journals)) != len(journals):
+        raise ValueError("The stations in " + path + " must have journals of their own (stations that share a working "
+                         "directory need their \"journal\" set)")
+    return result
@@ -0,0 +1,510 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import mmap
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import numpy as np
+
+# inotify constants, from <sys/inotify.h>
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+# ioprio_set() constants, from <linux/ioprio.h>, and its system call numbers (there's no wrapper in the C library)
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+_SYS_IOPRIO_SET = {"x86_64": 251, "amd64": 251, "aarch64": 30, "arm64": 30, "i386": 289, "i686": 289,
+                   "armv7l": 314, "ppc64le": 273}
+
+_libc = None
+
+
+def _get_libc():
+    """
+    Load the C library with the inotify functions, only on Linux
+    :return: ctypes library object, or None if inotify is not available
+    """
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                libc.inotify_init1.argtypes = [ctypes.c_int]
+                libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                _libc = libc
+            except (OSError, AttributeError):
+                pass
+    return _libc or None
+
+
+def lower_io_priority():
+    """
+    Give the calling thread the idle I/O priority on Linux, so that its reads and writes are done only when no other
+    program uses the disk. Elsewhere, or when it fails, nothing is changed
+    :return: True if the priority was changed
+    """
+    libc = _get_libc()
+    syscall_number = _SYS_IOPRIO_SET.get(os.uname().machine if hasattr(os, "uname") else "")
+    if libc is None or syscall_number is None:
+        return False
+    # with IOPRIO_WHO_PROCESS, the id of a thread sets the priority of that thread only
+    return libc.syscall(syscall_number, _IOPRIO_WHO_PROCESS, threading.get_native_id(),
+                        _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT) == 0
+
+
+class FileWatcher:
+    """
+    Waits until any of a set of files changes (e.g. a line is written to it)
+    Uses inotify on Linux, so that waiting doesn't use CPU and wakes up immediately. Elsewhere, or when inotify fails,
+    it polls the size and modification time of the files every poll_interval seconds.
+    """
+    poll_interval = 0.05  # seconds
+
+    def __init__(self, paths, use_inotify=True):
+        """
+        :param paths: list of paths of the files to watch
+        :param use_inotify: whether to try inotify; if False, polling is used
+        """
+        self.paths = list(paths)
+        self.fd = None
+        self.states = self._stat_all()
+        if use_inotify:
+            self._start_inotify()
+
+    def _start_inotify(self):
+        libc = _get_libc()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            return
+        mask = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_DELETE_SELF | _IN_MOVE_SELF
+        for path in self.paths:
+            if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+                os.close(fd)
+                return
+        self.fd = fd
+
+    def uses_inotify(self):
+        return self.fd is not None
+
+    def _stat_all(self):
+        states = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                states.append((st.st_size, st.st_mtime_ns))
+            except OSError:
+                states.append(None)
+        return states
+
+    def wait(self, timeout):
+        """
+        Block until one of the files changes, or until timeout passes. Changes that happened since the previous
+        call returned count too, so nothing is missed between calls.
+        :param timeout: maximum time to wait in seconds
+        :return: True if a file changed, False on timeout
+        """
+        if self.fd is not None:
+            changed = self._wait_inotify(timeout)
+        else:
+            changed = self._wait_polling(timeout)
+        states = self._stat_all()
+        # files on network shares may change without inotify events
+        changed = changed or states != self.states
+        self.states = states
+        return changed
+
+    def _wait_inotify(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return False
+        # the events themselves don't matter, only that there were some
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def _wait_polling(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._stat_all() != self.states:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(FileWatcher.poll_interval, remaining))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DirectoryWatcher:
+    """
+    Keeps track of the files in a set of directories, and reports the files that are added to them and removed from
+    them, without listing the directories again
+    Uses inotify on Linux, whose events have the names of the files. Elsewhere, when inotify fails, or when a directory
+    changes without events (e.g. on network shares), the directories whose modification times changed are listed again,
+    and compared with what was in them.
+    """
+    poll_interval = 1  # seconds
+
+    def __init__(self, paths, pattern="*", use_inotify=True):
+        """
+        :param paths: list of paths of the directories to watch
+        :param pattern: shell-style pattern of the names of the files to report (hidden files are never reported)
+        :param use_inotify: whether to try inotify; if False, polling is used
+        """
+        self.paths = list(paths)
+        self.pattern = pattern
+        self.fd = None
+        self.watches = {}  # inotify watch descriptor -> directory
+        if use_inotify:
+            self._start_inotify()
+        # the watches are added before listing, so that nothing that happens in between is missed
+        self.mtimes = self._stat_all()
+        self.files = {path: self._list(path) for path in self.paths}
+
+    def _start_inotify(self):
+        libc = _get_libc()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            return
+        mask = _IN_CREATE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO
+        for path in self.paths:
+            wd = libc.inotify_add_watch(fd, os.fsencode(path), mask)
+            if wd < 0:
+                os.close(fd)
+                self.watches = {}
+                return
+            self.watches[wd] = path
+        self.fd = fd
+
+    def uses_inotify(self):
+        return self.fd is not None
+
+    def _matches(self, name):
+        return not name.startswith(".") and fnmatch.fnmatch(name, self.pattern)
+
+    def _list(self, path):
+        try:
+            return {name for name in os.listdir(path) if self._matches(name)}
+        except OSError:
+            return set()
+
+    def _stat_all(self):
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def wait(self, timeout):
+        """
+        Block until files are added to or removed from the directories, or until timeout passes. Changes that happened
+        since the previous call returned count too, so nothing is missed between calls.
+        :param timeout: maximum time to wait in seconds (0 only collects the changes that happened already)
+        :return: list of tuples (directory, name of the file, whether it was added (True) or removed (False))
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            changes = self._read_inotify(max(0, deadline - time.monotonic())) if self.fd is not None else []
+            mtimes = self._stat_all()
+            for path, old_mtime, new_mtime in zip(self.paths, self.mtimes, mtimes):
+                # directories that changed with no events are listed again
+                if old_mtime != new_mtime and not any(change[0] == path for change in changes):
+                    changes.extend(self._rescan(path))
+            self.mtimes = mtimes
+            remaining = deadline - time.monotonic()
+            if len(changes) > 0 or remaining <= 0:
+                return changes
+            if self.fd is None:
+                time.sleep(min(DirectoryWatcher.poll_interval, remaining))
+
+    def _rescan(self, path):
+        """
+        List a directory again, and find what changed in it
+        :return: list of changes, like wait()
+        """
+        old_files = self.files[path]
+        new_files = self._list(path)
+        self.files[path] = new_files
+        return [(path, name, True) for name in sorted(new_files - old_files)] + \
+               [(path, name, False) for name in sorted(old_files - new_files)]
+
+    def _read_inotify(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+        data = b""
+        try:
+            while True:
+                block = os.read(self.fd, 65536)
+                if not block:
+                    break
+                data += block
+        except BlockingIOError:
+            pass
+
+        changes = []
+        pos = 0
+        while pos + 16 <= len(data):
+            # struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+            wd, mask, _, name_length = struct.unpack_from("iIII", data, pos)
+            name = os.fsdecode(data[pos + 16:pos + 16 + name_length].rstrip(b"\0"))
+            pos += 16 + name_length
+            if mask & _IN_Q_OVERFLOW:
+                # events were lost, so everything is listed again
+                return [change for path in self.paths for change in self._rescan(path)]
+            path = self.watches.get(wd)
+            if path is None or mask & _IN_ISDIR or not self._matches(name):
+                continue
+            added = bool(mask & (_IN_CREATE | _IN_MOVED_TO))
+            if added != (name in self.files[path]):
+                if added:
+                    self.files[path].add(name)
+                else:
+                    self.files[path].discard(name)
+                changes.append((path, name, added))
+        return changes
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BlockLineReader:
+    """
+    Reads the complete lines of a file that is being written, in large binary blocks
+    Blocks are searched for newlines all at once, and the incomplete line at the end of a block is kept until the rest
+    of it is read. Lines are returned in a single buffer (see MappedLines), with no decoding or per-line copies.
+    """
+    block_size = 1 << 20  # bytes
+
+    def __init__(self, path, offset=0):
+        """
+        :param path: path of the file
+        :param offset: byte position in the file to start reading from (must be the beginning of a line)
+        """
+        self.path = path
+        self.file = open(path, "rb")
+        self.file.seek(offset)
+        self.offset = offset  # position past the last line that was returned
+        self.data = b""  # bytes that were read, but not returned yet (starting at offset)
+
+    def read_buffer(self, max_lines):
+        """
+        Read the complete lines that were added to the file since the last call, without waiting
+        :param max_lines: maximum number of lines to return (empty lines count too)
+        :return: MappedLines over a bytes object, with the path of the file and the positions of the lines in it
+        """
+        blocks = [self.data]
+        num_newlines = self.data.count(b"\n")
+        while num_newlines < max_lines:
+            block = self.file.read(self.block_size)
+            if not block:
+                break
+            blocks.append(block)
+            num_newlines += block.count(b"\n")
+        data = b"".join(blocks)
+
+        starts, ends, end = find_lines(data, 0, max_lines)
+        lines = MappedLines(data, starts, ends, base=self.offset, path=self.path, end_offset=self.offset + end)
+        self.data = data[end:]
+        self.offset += end
+        return lines
+
+    def read_lines(self, max_lines):
+        """
+        Like read_buffer(), but the lines are returned as a list
+        :param max_lines: maximum number of lines to return
+        :return: list of non-empty lines (bytes), without the line ending (\n or \r\n)
+        """
+        lines = self.read_buffer(max_lines)
+        return [lines.line(i) for i in range(len(lines))]
+
+    def close(self):
+        self.file.close()
+
+
+def find_lines(buffer, offset=0, max_lines=None):
+    """
+    Find the complete (\n terminated) non-empty lines in a buffer after offset
+    Newlines are looked for with numpy, a piece at a time, so the buffer is never copied
+    :param buffer: bytes-like object (e.g. a memory-mapped file)
+    :param offset: position in the buffer to start from (must be the beginning of a line)
+    :param max_lines: maximum number of lines to find, empty lines included (default: all of them)
+    :return: tuple (int64 array of the positions of the first bytes of the lines, int64 array of the positions past
+             their last bytes without the line endings, position past the last newline)
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    newlines = [np.zeros(0, dtype=np.int64)]
+    num_newlines = 0
+    for pos in range(offset, len(data), MappedFile.scan_size):
+        newlines.append(np.flatnonzero(data[pos:pos + MappedFile.scan_size] == ord("\n")) + pos)
+        num_newlines += len(newlines[-1])
+        if max_lines is not None and num_newlines >= max_lines:
+            break
+    newlines = np.concatenate(newlines).astype(np.int64)[:max_lines]
+    if len(newlines) == 0:
+        return newlines, newlines, offset
+
+    starts = np.empty(len(newlines), dtype=np.int64)
+    starts[0] = offset
+    starts[1:] = newlines[:-1] + 1
+    ends = newlines.copy()
+    carriage_returns = ends > starts
+    carriage_returns[carriage_returns] = data[ends[carriage_returns] - 1] == ord("\r")
+    ends[carriage_returns] -= 1
+    del data  # a mapped buffer can't be closed as long as numpy arrays use it
+
+    not_empty = ends > starts
+    return starts[not_empty], ends[not_empty], int(newlines[-1]) + 1
+
+
+class MappedLines:
+    """
+    Lines that are inside a buffer (e.g. a memory-mapped file), given by the positions of their first byte and of the
+    byte past their last one (line endings excluded). Nothing is copied out of the buffer.
+    When the buffer holds a part of a file, the lines know where they are in the file, so that reading can be resumed
+    from any of them (see OffsetJournal).
+    """
+
+    def __init__(self, buffer, starts, ends, base=0, path=None, end_offset=None):
+        """
+        :param buffer: bytes-like object with the lines
+        :param starts: int64 array of the positions of the first bytes of the lines
+        :param ends: int64 array of the positions past the last bytes of the lines
+        :param base: position in the file of the first byte of the buffer
+        :param path: path of the file the lines are from, if any
+        :param end_offset: position in the file past the newline of the last line, if known
+        """
+        self.buffer = buffer
+        self.starts = starts
+        self.ends = ends
+        self.base = base
+        self.path = path
+        self.end_offset = end_offset
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        return MappedLines(self.buffer, self.starts[index], self.ends[index], self.base, self.path)
+
+    def file_offsets(self):
+        """
+        :return: int64 array of the positions of the lines in the file
+        """
+        return self.starts + self.base
+
+    def detach(self):
+        """
+        Copy the part of the buffer with the lines, so that they stay valid after the buffer (e.g. the mapping of the
+        file) is closed. The copy is a single block, with no per-line objects. Lines in a bytes object are valid
+        anyway, and are not copied
+        :return: MappedLines over a bytes object
+        """
+        if isinstance(self.buffer, bytes):
+            return self
+        if len(self.starts) == 0:
+            return MappedLines(b"", self.starts, self.ends, self.base, self.path, self.end_offset)
+        first = int(self.starts[0])
+        last = int(self.ends[-1])
+        return MappedLines(bytes(self.buffer[first:last]), self.starts - first, self.ends - first, self.base + first,
+                           self.path, self.end_offset)
+
+    def __getstate__(self):
+        # mapped files can't be pickled (e.g. to be parsed in another process), so only the lines are
+        return dict(self.detach().__dict__)
+
+    def line(self, i):
+        """
+        :param i: number of the line
+        :return: copy of the line as bytes
+        """
+        return bytes(self.buffer[self.starts[i]:self.ends[i]])
+
+
+class MappedFile:
+    """
+    A data file that is no longer being written, memory-mapped, with the positions of all its complete lines
+    The lines are found by looking for newlines in the mapped buffer with numpy (see find_lines()), so the file is never
+    copied to Python strings (or to a numpy array).
+    """
+    scan_size = 1 << 24  # bytes to scan for newlines at once
+
+    def __init__(self, path, offset=0):
+        """
+        :param path: path of the file
+        :param offset: byte position in the file to start from (must be the beginning of a line)
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b""
+        self.starts, self.ends, self.end_offset = find_lines(self.buffer, offset)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def chunks(self, max_lines):
+        """
+        A generator of the lines in the file, in chunks
+        :param max_lines: maximum number of lines in a chunk
+        :return: yields tuples (MappedLines, position in the file past the chunk)
+        """
+        for i in range(0, len(self.starts), max_lines):
+            j = min(i + max_lines, len(self.starts))
+            end_offset = self.end_offset if j == len(self.starts) else int(self.starts[j])
+            yield MappedLines(self.buffer, self.starts[i:j], self.ends[i:j], path=self.path, end_offset=end_offset), \
+                end_offset
+
+    def close(self):
+        """
+        Release the mapping. If parts of it are still in use, it's released when they're all gone
+        :return: None
+        """
+        try:
+            if isinstance(self.buffer, mmap.mmap):
+                self.buffer.close()
+        except BufferError:
+            pass
@@ -0,0 +1,129 @@
+import numpy as np
+
+# timestamps are kept in microseconds, the resolution of Python's datetime and of the times in the daily files, so that
+# they convert to both exactly. Digits of the fractions of seconds past the microseconds are dropped
+unit = "us"
+fraction_digits = 6
+
+_zero = ord("0")
+
+
+def _characters(fields, width=None):
+    """
+    :param fields: list of str (ASCII only) or bytes fields
+    :param width: number of characters of the fields to keep (default: the length of the longest one)
+    :return: uint8 matrix of the characters of the fields, a row per field, padded with zeros on the right
+    """
+    array = np.array(fields, dtype="S" if width is None else "S" + str(width))
+    return array.view(np.uint8).reshape(len(array), array.dtype.itemsize)
+
+
+def _number(characters, start, width):
+    """
+    :return: int64 array of the numbers written with the digits at a fixed position in the rows of a character matrix
+    """
+    number = np.zeros(len(characters), dtype=np.int64)
+    for k in range(start, start + width):
+        number = number*10 + characters[:, k] - _zero
+    return number
+
+
+def _fraction(characters, start):
+    """
+    :return: int64 array of the microseconds of the fractions of seconds that start at a fixed position in the rows of
+             a character matrix, whatever their number of digits
+    """
+    digits = characters[:, start:start + fraction_digits].astype(np.int64) - _zero
+    # shorter fractions are padded with zeros, which count like trailing "0" digits
+    digits[digits < 0] = 0
+    scale = 10**np.arange(fraction_digits - 1, fraction_digits - 1 - digits.shape[1], -1, dtype=np.int64)
+    return digits @ scale
+
+
+def fraction_to_microseconds(fractions):
+    """
+    Convert fractions of seconds (the digits after the decimal point, any number of them) to microseconds, e.g. "5" to
+    500000, "002" to 2000 and "1234567" to 123456
+    :param fractions: list of str or bytes
+    :return: int64 array
+    """
+    try:
+        characters = _characters(fractions)
+    except UnicodeEncodeError:
+        # str fields can have digits that aren't ASCII, which int() understands
+        return np.array([int((f + "0"*fraction_digits)[:fraction_digits]) for f in fractions], dtype=np.int64)
+    return _fraction(characters, 0)
+
+
+def compose(year, month, day, hour, minute, second, microsecond):
+    """
+    Build timestamps from int64 arrays of their components (2-digit years after 2000). The time of the day is added to
+    the day as an offset, so the timestamps are exact whatever the day, month or year
+    :return: tuple (datetime64[us] array, boolean array that is False where the components are not a valid time)
+    """
+    months = (year + 2000 - 1970).astype("datetime64[Y]").astype("datetime64[M]") + \
+        (month - 1).astype("timedelta64[M]")
+    days = months.astype("datetime64[D]") + (day - 1).astype("timedelta64[D]")
+    valid = (month >= 1) & (month <= 12) & (day >= 1) & (days.astype("datetime64[M]") == months) & \
+        (hour >= 0) & (hour < 24) & (minute >= 0) & (minute < 60) & (second >= 0) & (second < 60) & \
+        (microsecond >= 0) & (microsecond < 1000000)
+    microseconds = ((hour*60 + minute)*60 + second)*1000000 + microsecond
+    return days.astype("datetime64[us]") + microseconds.astype("timedelta64[us]"), valid
+
+
+def from_fields(year, month, day, hour, minute, second, fraction):
+    """
+    Decode timestamps from separate fields of their components, of any width (e.g. the groups of a regex)
+    :param year, month, day, hour, minute, second: lists of str or bytes integers
+    :param fraction: list of the fractions of the seconds (see fraction_to_microseconds())
+    :return: tuple (datetime64[us] array, boolean array of the valid ones), see compose()
+    """
+    numbers = np.array([year, month, day, hour, minute, second], dtype=np.int64).reshape(6, len(fraction))
+    return compose(*numbers, fraction_to_microseconds(fraction))
+
+
+def decode(dates, times):
+    """
+    Decode timestamps from digits at fixed positions, without converting the fields one by one: dates are YYMMDD and
+    times HHMMSS.F, where F is the fraction of the second with any number of digits (the character before it isn't
+    looked at). The fields must be ASCII and have digits where digits are expected (e.g. checked by a regex)
+    :param dates: list of str or bytes
+    :param times: list of str or bytes
+    :return: tuple (datetime64[us] array, boolean array of the valid ones), see compose()
+    """
+    if len(dates) == 0:
+        return np.zeros(0, dtype="datetime64[us]"), np.zeros(0, dtype=bool)
+    date_characters = _characters(dates, 6)
+    time_characters = _characters(times)
+    return compose(_number(date_characters, 0, 2), _number(date_characters, 2, 2), _number(date_characters, 4, 2),
+                   _number(time_characters, 0, 2), _number(time_characters, 2, 2), _number(time_characters, 4, 2),
+                   _fraction(time_characters, 7))
+
+
+def end_time(t0, num_samples, sample_rate):
+    """
+    :param t0: time of the first sample (datetime64 or datetime)
+    :param num_samples: number of samples
+    :param sample_rate: sampling rate (Hz)
+    :return: time past the last sample (datetime64[us])
+    """
+    return np.datetime64(t0, unit) + np.timedelta64(round(num_samples*1000000/sample_rate), unit)
+
+
+def seconds_since_epoch(t):
+    """
+    :param t: datetime64 (UTC) or array of them
+    :return: float seconds since 1970-01-01
+    """
+    return (np.asarray(t, dtype="datetime64[us]") - np.datetime64(0, unit)) / np.timedelta64(1, "s")
+
+
+def format_times(times):
+    """
+    Format timestamps the way the attributes of the datasets have them
+    :param times: datetime64 array
+    :return: tuple of str arrays (dates as YYYY/MM/DD, times of the day as HH:MM:SS.ffffff)
+    """
+    text = np.datetime_as_string(np.asarray(times, dtype="datetime64[us]"), unit=unit)
+    parts = np.char.partition(text, "T")
+    return np.char.replace(parts[..., 0], "-", "/"), parts[..., 2]
@@ -0,0 +1,185 @@
+import re
+
+import numpy as np
+
+# the pieces of the line regexes that describe a fixed layout of fields (see FieldLayout.from_regex()). The regex has
+# to be made of exactly these, in this order: date, sync, time, optionally a separator and the flags, and a separator
+# and a number for every data column f1, f2, ...
+_date_piece = r"(?P<year>\d{2})(?P<month>\d{2})(?P<day>\d{2})"
+_sync_piece = r"(?P<sync>(\*|\s+))"
+_time_piece = r"(?P<hour>\d{2})(?P<min>\d{2})(?P<sec>\d{2})(?:.)(?P<msec>\d+)"
+_flags_piece = r"(?P<flags>[A-Z]{8})"
+# separators of any amount of whitespace, and of a single character ([(?:\s+)] is a class of one character, which
+# matches a single whitespace character between fields that are split on whitespace)
+_separators = {r"(?:\s+)": False, r"\s+": False, r"[(?:\s+)]": True, r"\s": True}
+_ends = (r"(?:\s*)$", r"\s*$")
+_number_piece = re.compile(r"(?P<open>\(?)\(\?P<f(?P<column>\d+)>\(\\-\\d\+\|\\d\+\)\\\.\{0,1\}\\d\*\)(?P<close>\)?)")
+
+# what the fields match in the regex, to check whole columns of fields at once. The regex matches numbers with
+# (\-\d+|\d+)\.{0,1}\d*, but an integer can be split between its \d+ and \d* in many ways, which makes a column of them
+# backtrack exponentially when a field is wrong; the fraction is optional as a whole instead, which accepts the same numbers
+_field_patterns = {
+    "star_date_time": r"\d{6}\*\d{6}.\d+",
+    "date": r"\d{6}",
+    "time": r"\d{6}.\d+",
+    "flags": r"[A-Z]{8}",
+    "number": r"-?\d+(?:\.\d*)?",
+}
+
+
+class FieldLayout:
+    """
+    The layout of the lines that a regex describes, when it's a fixed layout of fields separated by whitespace:
+    the date, the sync mark ("*" or whitespace) and the time, optionally 8 status flags, and a number for every data
+    column (like the default regexes). Lines are then split on whitespace instead of being matched with the regex, and
+    the fields are checked column by column, against what the regex accepts. Lines that don't pass (or that aren't
+    ASCII) aren't tokenized, and are left to the regex.
+    Tokenizing gives the same fields as the groups of the regex, for every line it accepts.
+    """
+
+    def __init__(self, has_flags, num_columns, single_gaps):
+        """
+        :param has_flags: whether the lines have flags after the time
+        :param num_columns: number of data columns
+        :param single_gaps: set of numbers of the gaps after the time (0 is the one right after it) that have to be a
+                            single whitespace character
+        """
+        self.has_flags = has_flags
+        self.num_columns = num_columns
+        self.single_gaps = frozenset(single_gaps)
+        # number of fields after the time
+        self.num_fields = num_columns + (1 if has_flags else 0)
+        self._column_regexes = {}
+
+    @staticmethod
+    def from_regex(regex_str):
+        """
+        Recognize a regex that describes a fixed layout of fields
+        :param regex_str: the line regex
+        :return: FieldLayout, or None if the regex is anything else
+        """
+        s = regex_str[1:] if regex_str.startswith("^") else regex_str
+        for piece in (_date_piece, _sync_piece, _time_piece):
+            if not s.startswith(piece):
+                return None
+            s = s[len(piece):]
+
+        has_flags = False
+        single_gaps = set()
+        num_columns = 0
+        gap = 0
+        while True:
+            if s in _ends:
+                break
+            separator = next((sep for sep in _separators if s.startswith(sep)), None)
+            if separator is None:
+                return None
+            if _separators[separator]:
+                single_gaps.add(gap)
+            s = s[len(separator):]
+            gap += 1
+            if gap == 1 and s.startswith(_flags_piece):
+                has_flags = True
+                s = s[len(_flags_piece):]
+                continue
+            match = _number_piece.match(s)
+            if match is None or int(match.group("column")) != num_columns + 1 or \
+                    len(match.group("open")) != len(match.group("close")):
+                return None
+            num_columns += 1
+            s = s[match.end():]
+        if num_columns == 0:
+            return None
+        return FieldLayout(has_flags, num_columns, single_gaps)
+
+    def _column_regex(self, name, as_bytes):
+        """
+        :return: compiled regex that matches a column of fields of one kind, joined with newlines
+        """
+        key = (name, as_bytes)
+        if key not in self._column_regexes:
+            pattern = _field_patterns[name]
+            pattern = "(?:" + pattern + "\n)*" + pattern + r"\Z"
+            self._column_regexes[key] = re.compile(pattern.encode() if as_bytes else pattern, re.ASCII)
+        return self._column_regexes[key]
+
+    def _check_column(self, name, column, as_bytes):
+        """
+        :return: boolean array, False for the fields of the column that aren't what the regex accepts
+        """
+        regex = self._column_regex(name, as_bytes)
+        newline = b"\n" if as_bytes else "\n"
+        if regex.match(newline.join(column)) is not None:
+            return np.ones(len(column), dtype=bool)
+        # some fields are wrong: find them
+        return np.array([regex.match(field) is not None for field in column], dtype=bool)
+
+    def _gaps_ok(self, line, first_token):
+        """
+        Check the gaps after the time that have to be a single whitespace character
+        :param line: the line
+        :param first_token: number of the token of the time (0 or 1)
+        :return: bool
+        """
+        spans = [m.span() for m in re.finditer(rb"\S+" if isinstance(line, bytes) else r"\S+", line)]
+        return all(spans[first_token + gap + 1][0] - spans[first_token + gap][1] == 1 for gap in self.single_gaps)
+
+    def tokenize(self, lines):
+        """
+        Split lines in their fields
+        :param lines: list of str or bytes lines (all of the same type), without line endings
+        :return: tuple (columns, indices): columns is a list of the fields of the lines that were tokenized, in the order
+                 date (YYMMDD), time (HHMMSS.F, see timestamps.decode()), sync, (flags,) f1, f2, ...; and indices is an
+                 int array of the numbers of these lines in lines (lines with a "*" come first, so they aren't in order)
+        """
+        num_columns = 3 + self.num_fields
+        if len(lines) == 0:
+            return [[] for _ in range(num_columns)], np.zeros(0, dtype=np.int64)
+        as_bytes = isinstance(lines[0], bytes)
+        rows = [line.split() for line in lines]
+        lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+        # the regex has to match from the start of the line, so the first character can't be whitespace
+        rejected = np.array([line[:1].isspace() or not line.isascii() for line in lines], dtype=bool)
+
+        columns = [[] for _ in range(num_columns)]
+        indices = []
+        # lines with a "*" between the date and the time have them in the same token; the others in two tokens
+        for star, num_tokens in ((True, self.num_fields + 1), (False, self.num_fields + 2)):
+            group = np.flatnonzero((lengths == num_tokens) & ~rejected)
+            if len(group) == 0:
+                continue
+            fields = list(zip(*[rows[i] for i in group]))
+            ok = np.ones(len(group), dtype=bool)
+            if star:
+                date_time = fields[0]
+                ok &= self._check_column("star_date_time", date_time, as_bytes)
+                dates = times = date_time
+                sync = [b"*" if as_bytes else "*"]*len(group)
+            else:
+                dates, times = fields[0], fields[1]
+                ok &= self._check_column("date", dates, as_bytes) & self._check_column("time", times, as_bytes)
+                sync = [b" " if as_bytes else " "]*len(group)
+            rest = fields[1:] if star else fields[2:]
+            if self.has_flags:
+                ok &= self._check_column("flags", rest[0], as_bytes)
+            for j in range(self.has_flags, len(rest)):
+                ok &= self._check_column("number", rest[j], as_bytes)
+            if len(self.single_gaps) > 0:
+                first_token = 0 if star else 1
+                ok &= np.array([self._gaps_ok(lines[i], first_token) for i in group], dtype=bool)
+
+            selected = np.flatnonzero(ok)
+            if len(selected) < len(group):
+                def select(column):
+                    return [column[k] for k in selected]
+                dates, times, sync = select(dates), select(times), select(sync)
+                rest = [select(column) for column in rest]
+            if star:
+                dates, times = [d[:6] for d in dates], [t[7:] for t in times]
+            group_columns = [dates, times, sync] + list(rest)
+            for column, group_column in zip(columns, group_columns):
+                column.extend(group_column)
+            indices.append(group[selected])
+
+        indices = np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=np.int64)
+        return columns, indices
@@ -0,0 +1,169 @@
+import concurrent.futures
+import threading
+import time
+
+from gnomeptb import analysis, timestamps
+from gnomeptb.analysis import print_error, SingleFileData, LineData
+from gnomeptb.processes import process_pool
+
+
+def writer_settings():
+    """
+    :return: tuple of the global settings of the writer in this process, to be given to _init_worker()
+    """
+    return (SingleFileData.MainEquation, SingleFileData.StorageProfile, SingleFileData.CompressionWorkers,
+            SingleFileData.DerivedDatasets, analysis.cavi_columns_to_include, analysis.comb_columns_to_include,
+            LineData.decimal_precision())
+
+
+def _init_worker(main_equation, storage_profile, compression_workers, derived_datasets, cavi_columns, comb_columns,
+                 decimal_precision):
+    """
+    Set the global settings of the writer in a worker process, the same way main.py sets them
+    """
+    SingleFileData.SetMainEquations(main_equation)
+    SingleFileData.SetDerivedDatasets(derived_datasets)
+    SingleFileData.SetStorageProfile(storage_profile)
+    SingleFileData.SetCompressionWorkers(compression_workers)
+    analysis.cavi_columns_to_include = cavi_columns
+    analysis.comb_columns_to_include = comb_columns
+    LineData.set_decimal_precision(decimal_precision)
+
+
+def _write_minute(minute):
+    """
+    Write a minute of data (a SingleFileData object), in a worker thread or process
+    :return: path of the written file, or None if it couldn't be written
+    """
+    return minute.write_to_file()
+
+
+def _timed_write(write_function, minute):
+    """
+    Write a minute with write_function, and time it
+    :return: tuple (result of write_function, seconds it took, time at which it finished as a UNIX timestamp)
+    """
+    start = time.perf_counter()
+    result = write_function(minute)
+    return result, time.perf_counter() - start, time.time()
+
+
+class WriterPool:
+    """
+    Writes minutes of data (SingleFileData objects) to HDF5 files in the background, on a pool of threads or processes,
+    so that slow writes don't hold up the processing of the data.
+    The number of minutes being written at once is limited: submit() waits when the limit is reached, so minutes can't
+    pile up in memory when writing falls behind.
+    With threads, the writers share the settings of the writer (main equation, storage profile, columns to include) with
+    the rest of the program. With processes, the settings at the time the pool is created are copied to the processes.
+    With a journal (see OffsetJournal), every minute is recorded in it once it's written.
+    With a MetricsRegistry, the time it takes to write every minute, and the lag from the time of its last line to its
+    file being closed, are recorded in it.
+    """
+    # buckets of the histograms of the write durations and of the lag, in seconds
+    duration_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    lag_buckets = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self, num_workers=1, max_in_flight=None, use_processes=False, write_function=None, journal=None,
+                 metrics=None):
+        """
+        :param num_workers: number of threads or processes that write
+        :param max_in_flight: maximum number of minutes submitted and not written yet (default: 2*num_workers)
+        :param use_processes: whether to write in processes instead of threads
+        :param write_function: function that writes a minute and returns the path it was written to, or None if it
+                               couldn't be written (default: SingleFileData.write_to_file()). Only with threads
+        :param journal: OffsetJournal to record the written minutes in, if any
+        :param metrics: MetricsRegistry to record the writes in, if any
+        """
+        if use_processes and write_function is not None:
+            raise ValueError("A custom write function can only be used with threads")
+        self.write_function = write_function or _write_minute
+        self.max_in_flight = max_in_flight if max_in_flight is not None else 2*num_workers
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.pending = {}  # future -> (sequence number of the minute in the journal, time of its last line)
+        self.num_written = 0
+        self.num_failed = 0
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.counter("minutes_written_total", "Minutes written to files", lambda: self.num_written)
+            metrics.counter("minutes_failed_total", "Minutes that couldn't be written", lambda: self.num_failed)
+            metrics.gauge("minutes_in_flight", "Minutes submitted to the writer and not written yet", self.in_flight)
+            self.write_duration = metrics.histogram("write_duration_seconds", "Time it took to write a minute",
+                                                    WriterPool.duration_buckets)
+            self.lag = metrics.histogram("line_to_file_lag_seconds",
+                                         "Time from the last line of a minute (its own UTC time) to its file being "
+                                         "closed", WriterPool.lag_buckets)
+        if use_processes:
+            self.executor = process_pool(num_workers, initializer=_init_worker, initargs=writer_settings())
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(num_workers, thread_name_prefix="hdf5-writer")
+
+    def submit(self, minute):
+        """
+        Queue a minute to be written. Waits while max_in_flight minutes are being written
+        :param minute: SingleFileData object with a complete minute of data
+        :return: None
+        """
+        self.slots.acquire()
+        try:
+            end_time = minute.end_time()
+            future = self.executor.submit(_timed_write, self.write_function, minute)
+        except BaseException:
+            self.slots.release()
+            raise
+        sequence = self.journal.add_minute(minute) if self.journal is not None else None
+        with self.lock:
+            self.pending[future] = (sequence, end_time)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self.lock:
+            sequence, end_time = self.pending.pop(future, (None, None))
+            try:
+                result, duration, finished = future.result()
+                if result is None:
+                    self.num_failed += 1
+                else:
+                    self.num_written += 1
+                    if self.metrics is not None:
+                        self.write_duration.observe(duration)
+                        if end_time is not None:
+                            self.lag.observe(finished - timestamps.seconds_since_epoch(end_time))
+            except BaseException as e:
+                self.num_failed += 1
+                print_error("Writing a minute failed. Exception says: " + str(e))
+        if self.journal is not None:
+            self.journal.finish_minute(sequence)
+        self.slots.release()
+
+    def in_flight(self):
+        """
+        :return: number of minutes submitted and not written yet
+        """
+        with self.lock:
+            return len(self.pending)
+
+    def flush(self):
+        """
+        Wait until all the submitted minutes are written
+        :return: None
+        """
+        with self.lock:
+            pending = list(self.pending)
+        concurrent.futures.wait(pending)
+
+    def close(self):
+        """
+        Write all the submitted minutes, and stop the pool
+        :return: None
+        """
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,50 +1,127 @@
 #!/bin/bash
 
 import sys
+import os
 import argparse
 import gnomeptb as ptb
-import time
 import ast
 
 def main_function():
-    default_comb_regex = "^(?P<year>\d{2})(?P<month>\d{2})(?P<day>\d{2})(?P<sync>(\*|\s+))(?P<hour>\d{2})(?P<min>\d{2})(?P<sec>\d{2})(?:.)(?P<msec>\d+)[(?:\s+)](?P<flags>[A-Z]{8})(?:\s+)(?P<f1>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)((?P<f2>(\-\d+|\d+)\.{0,1}\d*))(?:\s+)(?P<f3>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f4>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f5>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f6>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f7>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f8>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f9>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f10>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f11>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f12>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f13>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f14>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f15>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f16>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f17>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f18>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f19>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f20>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)(?P<f21>(\-\d+|\d+)\.{0,1}\d*)(?:\s*)$"
-    default_cavity_regex = "^(?P<year>\d{2})(?P<month>\d{2})(?P<day>\d{2})(?P<sync>(\*|\s+))(?P<hour>\d{2})(?P<min>\d{2})(?P<sec>\d{2})(?:.)(?P<msec>\d+)(?:\s+)(?P<f1>(\-\d+|\d+)\.{0,1}\d*)(?:\s+)((?P<f2>(\-\d+|\d+)\.{0,1}\d*))(?:\s+)(?P<f3>(\-\d+|\d+)\.{0,1}\d*)(?:\s*)$"
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("-ra", "--cavityregex", dest="cavityregex", default=default_cavity_regex, help="The regular expression of the cavity data")
-    parser.add_argument("-ro", "--combregex", dest="combregex", default=default_comb_regex, help="The regular expression of the comb data")
+    parser.add_argument("-ra", "--cavityregex", dest="cavityregex", default=ptb.default_cavity_regex, help="The regular expression of the cavity data")
+    parser.add_argument("-ro", "--combregex", dest="combregex", default=ptb.default_comb_regex, help="The regular expression of the comb data")
     parser.add_argument("-dw", "--workdir", dest="workdir", default="D:/ClockData", help="Working directory, where data exists")
     parser.add_argument("-da", "--cavisubdir", dest="cavitysubdir", default="Cavities", help="Sub-directory of cavities data")
     parser.add_argument("-dm", "--combsubdir", dest="combsubdir", default="Comb", help="Sub-directory of comb data")
     parser.add_argument("-df", "--finishedsubdir", dest="finishedsubdir", default="finished", help="")
+    parser.add_argument("-zf", "--compressfinished", dest="compressfinished", action="store_true", help="Compress the data files with gzip in the background, once they are moved to the finished sub-directory")
     parser.add_argument("-do", "--outputdir", dest="outputdir", default="output", help="Output directory of files to be uploaded (HDF5 files)")
+    parser.add_argument("-oa", "--archivedir", dest="archivedir", default=None, help="If given, minutes are appended to daily HDF5 files in this directory, instead of being written to a file each in the output directory (export.py writes the minute files from the daily files)")
     parser.add_argument("-sn", "--stationname", dest="stationname", default="ptb01", help="Station name")
     parser.add_argument("-ca", "--cavicolumns", dest="cavicolumns", default="[0, 1, 2]", help="Cavities data columns to include in the output data file")
     parser.add_argument("-cm", "--combcolumns", dest="combcolumns", default="[1, 2, 3, 4, 5, 6]", help="Comb data columns to include in the output data file")
+    parser.add_argument("-cw", "--compressionworkers", dest="compressionworkers", type=int, default=0, help="Number of processes that compress the chunks of the HDF5 datasets in parallel (0 lets HDF5 compress them)")
+    parser.add_argument("-ed", "--deriveddatasets", dest="deriveddatasets", action="store_true", help="Evaluate the channels of the main equation over every minute, and write them to datasets of their own in the HDF5 files")
+    parser.add_argument("-sf", "--stationsfile", dest="stationsfile", default=None, help="If given, the stations in this JSON file (a list of stations, with their working directory, output directory, journal, archive directory and data streams, see gnomeptb.streams.load_stations) are all served by this program, sharing the parsing processes; the options of a single station (regexes, working and data sub-directories, output directory, station name and columns) are not used then, and --journal and --archivedir can't be given (they're set per station in the file)")
     parser.add_argument("-eq", "--equations", dest="equations", default='CombData[[1]]+CombData[[0]]/2["First Var",Hz]::CavitiesData[[2]]/3+CavitiesData[[0]]["Second Var",Hz]', help="Main Equation to embed in the HDF5 file")
 
+    parser.add_argument("-sp", "--storageprofile", dest="storageprofile", default=ptb.SingleFileData.StorageProfile, choices=sorted(ptb.SingleFileData.storage_profiles), help="Compression and chunking of the datasets in the HDF5 files")
+    parser.add_argument("-np", "--parsers", dest="parsers", type=int, default=1, help="Number of processes that parse the data lines (1 parses them in a thread of the main process)")
+    parser.add_argument("-nw", "--writers", dest="writers", type=int, default=1, help="Number of processes that write the HDF5 files (1 writes them in a thread of the main process)")
+    parser.add_argument("-qs", "--queuesize", dest="queuesize", type=int, default=4, help="Maximum number of chunks of data waiting between two stages of processing")
+    parser.add_argument("-jf", "--journal", dest="journal", default=None, help="Journal file that records how far the data files are processed, to resume from there after a restart (default: gnomeptb_journal.json in the working directory)")
+    parser.add_argument("-nj", "--nojournal", dest="nojournal", action="store_true", help="Don't use a journal; files are read from the beginning after a restart")
+    parser.add_argument("-mf", "--metricsfile", dest="metricsfile", default=None, help="If given, the metrics of the processing (lines read and parsed, queue sizes, write durations, lag) are written to this file periodically; in the Prometheus text format if its name ends with .prom, as JSON otherwise")
+    parser.add_argument("-mi", "--metricsinterval", dest="metricsinterval", type=float, default=10, help="Seconds between writes of the metrics file")
+    parser.add_argument("-pf", "--profile", dest="profile", default=None, help="If given, the program is profiled (sampled stacks of the threads, and allocated memory with tracemalloc) and captures are written to this directory (see profile_report.py)")
+    parser.add_argument("-pe", "--profileevery", dest="profileevery", type=int, default=1, help="Number of minutes of data between profile captures")
+    parser.add_argument("-pk", "--profilekeep", dest="profilekeep", type=int, default=60, help="Number of profile captures to keep; older ones are removed")
+    parser.add_argument("-pi", "--profileinterval", dest="profileinterval", type=float, default=0.01, help="Seconds between samples of the stacks of the threads")
+    parser.add_argument("-pn", "--nomemoryprofile", dest="nomemoryprofile", action="store_true", help="Don't trace the allocated memory in profile captures (tracing it slows down the program)")
+
     args = parser.parse_args()
+    if args.stationsfile is not None and (args.journal is not None or args.archivedir is not None):
+        parser.error("--journal and --archivedir can't be used with --stationsfile; set \"journal\" and \"archive_dir\" "
+                     "of the stations in the stations file instead")
 
     # args.outputdir = "D:/gnomeclock/"
 
     ptb.SingleFileData.SetMainEquations(args.equations)
+    ptb.SingleFileData.SetDerivedDatasets(args.deriveddatasets)
+    ptb.SingleFileData.SetStorageProfile(args.storageprofile)
+    ptb.SingleFileData.SetCompressionWorkers(args.compressionworkers)
     # columns to include in the output file
-    ptb.cavi_columns_to_include = ast.literal_eval(args.cavicolumns)
-    ptb.comb_columns_to_include = ast.literal_eval(args.combcolumns)
+    ptb.analysis.cavi_columns_to_include = ast.literal_eval(args.cavicolumns)
+    ptb.analysis.comb_columns_to_include = ast.literal_eval(args.combcolumns)
 
     ptb.LineData.set_decimal_precision(30)
-    col = ptb.DataCollection(args.cavityregex, args.combregex, args.outputdir, args.stationname)
-    for data_queues in ptb.get_data(args.workdir, args.cavitysubdir, args.combsubdir, args.finishedsubdir):
-        if not data_queues["empty"]:
-            # print(data_queues)
-            col.append_cavi_data(data_queues["cavi_queue"])
-            col.append_comb_data(data_queues["comb_queue"])
-            col.process_data()
-
+    profiler = None
+    if args.profile is not None:
+        profiler = ptb.Profiler(args.profile, every=args.profileevery, max_captures=args.profilekeep,
+                                interval=args.profileinterval, trace_memory=not args.nomemoryprofile)
+        profiler.start()
+    try:
+        if args.stationsfile is not None:
+            run_stations(args, profiler)
         else:
-            print("No new data found...")
-            time.sleep(1)
+            run_station(args, profiler)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+def run_station(args, profiler):
+    journal = None
+    if not args.nojournal:
+        journal = ptb.OffsetJournal(args.journal or os.path.join(args.workdir, "gnomeptb_journal.json"))
+    pipeline = ptb.Pipeline(args.cavityregex, args.combregex, args.outputdir, args.stationname,
+                            queue_size=args.queuesize, num_parsers=args.parsers, num_writers=args.writers,
+                            archive_dir=args.archivedir, journal=journal, profiler=profiler)
+    exporter = None
+    if args.metricsfile is not None:
+        exporter = ptb.MetricsExporter(pipeline.metrics, args.metricsfile, args.metricsinterval)
+        exporter.start()
+    try:
+        pipeline.run(ptb.get_data(args.workdir, args.cavitysubdir, args.combsubdir, args.finishedsubdir,
+                                  journal=journal, compress_finished=args.compressfinished))
+    finally:
+        if exporter is not None:
+            exporter.stop()
+
+def run_stations(args, profiler):
+    stations = ptb.load_stations(args.stationsfile)
+    # the lines of all the streams of all the stations are parsed by the same processes
+    parsers = ptb.parser_pool(args.parsers) if args.parsers > 1 else None
+    pipelines = []
+    data_sources = []
+    exporters = []
+    for station in stations:
+        journal = None
+        if not args.nojournal:
+            journal = ptb.OffsetJournal(station["journal"])
+        pipeline = ptb.Pipeline(None, None, station["output_dir"], station["station_name"],
+                                queue_size=args.queuesize, num_writers=args.writers,
+                                archive_dir=station["archive_dir"], journal=journal, profiler=profiler,
+                                streams=station["streams"], shared_parsers=parsers)
+        pipelines.append(pipeline)
+        subdirs = {stream.name: stream.subdir for stream in station["streams"]}
+        data_sources.append(ptb.get_stream_data(station["workdir"], subdirs, args.finishedsubdir, journal=journal,
+                                                compress_finished=args.compressfinished))
+        if args.metricsfile is not None:
+            # a metrics file per station, with the name of the station before the extension
+            base, extension = os.path.splitext(args.metricsfile)
+            exporters.append(ptb.MetricsExporter(pipeline.metrics, base + "_" + station["station_name"] + extension,
+                                                 args.metricsinterval))
+    for exporter in exporters:
+        exporter.start()
+    try:
+        ptb.run_pipelines(pipelines, data_sources)
+    finally:
+        for exporter in exporters:
+            exporter.stop()
+        if parsers is not None:
+            parsers.shutdown()
 
 if __name__ == '__main__':
     main_function()
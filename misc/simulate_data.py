@@ -0,0 +1,275 @@
+# Simulator of the K&K counter files of the cavities and of the frequency comb, for testing and load testing
+# Unlike write_dummy_cavities.py and write_dummy_comb.py, which write one line at a time in real time, it formats the
+# lines in blocks with numpy, so it generates hours of data in seconds. The lines are fixed-width rows of a byte array:
+# the values are generated as fixed-point integers, and their digits are written with integer arithmetic, with no
+# string formatting per line or per value.
+#
+# Both files are written at the same time, like the counters do: the cavities file (default: 3 columns at 1 kHz) and
+# the comb file (default: status flags and 21 columns at 1 Hz, 297 ms after the cavities lines of the same second).
+# The first line of every second is a sync point ("*"), and the files are switched at midnight (UTC).
+#
+# Generate a day of data as fast as possible:
+#   python misc/simulate_data.py -dw /tmp/ClockData -st "2016-11-01 00:00:00" -du 86400
+# Stream data at 10 times the real sample rate (the data starts now, and its time runs 10 times faster):
+#   python misc/simulate_data.py -dw /tmp/ClockData -sm -sx 10
+#
+#   Uni-Mainz, 2016
+
+import argparse
+import datetime as dt
+import os
+import sys
+import time
+
+import numpy as np
+
+cavi_sample = [30089915.15010000020, 8587663.48739999905, 0.0]
+comb_sample = [32365919.99990969900, 19999999.98439349980, 23359875.19833400100, 23572738.83385109900,
+               51320112.94533299650, 54701611.62395049630, 62468051.41144129630, 34201269.49379400160,
+               34999999.99953600020, 20000000.00156589970, 10000000.00132700060, 59725627.47657729680,
+               19999999.98443600160, 23359875.19851360100, 23572738.83431870120, 51320112.96735619750,
+               61425204.12941499800, 62468049.96998640150, 46581938.69217439740, 46581938.69214440140, 1.4414549]
+
+us_per_second = 1000000
+us_per_day = 86400*us_per_second
+
+
+def put_digits(chars, column, values, width):
+    """
+    Write integers as zero-padded decimal digits in the columns of rows of characters
+    :param chars: uint8 array of shape (lines, line length)
+    :param column: first column to write to
+    :param values: non-negative int64 array, one value per line
+    :param width: number of digits
+    :return: None
+    """
+    for k in range(width - 1, -1, -1):
+        chars[:, column + k] = ord("0") + values % 10
+        values = values // 10
+
+
+def put_fixed_point(chars, column, values, width, decimals):
+    """
+    Write fixed-point numbers right-aligned in a field, like "%{width}.{decimals}f" does
+    :param chars: uint8 array of shape (lines, line length), with spaces in the field
+    :param column: first column of the field
+    :param values: int64 array of the numbers in units of 10^-decimals
+    :param width: width of the field
+    :param decimals: number of digits after the point
+    :return: None
+    """
+    negative = values < 0
+    magnitude = np.abs(values)
+    integer_part = magnitude // 10**decimals
+    point = column + width - decimals - 1
+    put_digits(chars, point + 1, magnitude % 10**decimals, decimals)
+    chars[:, point] = ord(".")
+    # digits of the integer part, from the point to the left, only as many as every number needs
+    num_digits = np.maximum(1, np.floor(np.log10(np.maximum(integer_part, 1))).astype(np.int64) + 1)
+    lines = np.arange(len(values))
+    remaining = integer_part
+    for k in range(1, int(num_digits.max(initial=1)) + 1):
+        in_number = num_digits >= k
+        chars[lines[in_number], point - k] = ord("0") + remaining[in_number] % 10
+        remaining = remaining // 10
+    chars[lines[negative], (point - num_digits - 1)[negative]] = ord("-")
+
+
+class StreamSimulator:
+    """
+    Generates the lines of one data stream (e.g. the cavities data), block after block
+    The values of every column drift slowly around a mean value (a random walk), with white noise on top.
+    """
+
+    def __init__(self, sample_rate, means, with_flags, seed, decimals=11, width=21, delay_us=0, noise=1e-2,
+                 drift=1e-3):
+        """
+        :param sample_rate: lines per second
+        :param means: list of the mean values of the columns
+        :param with_flags: whether the lines have status flags after the time
+        :param seed: seed of the random numbers
+        :param decimals: number of digits after the point of the values
+        :param width: width of the fields of the values
+        :param delay_us: time of the lines after the whole second, in microseconds
+        :param noise: standard deviation of the white noise
+        :param drift: standard deviation of the steps of the random walk
+        """
+        self.sample_rate = sample_rate
+        self.means = np.round(np.array(means, dtype=np.float64)*10**decimals).astype(np.int64)
+        self.with_flags = with_flags
+        self.rng = np.random.default_rng(seed)
+        self.decimals = decimals
+        self.width = width
+        self.delay_us = delay_us
+        self.noise = noise*10**decimals
+        self.drift = drift*10**decimals
+        self.walk = np.zeros(len(means))
+        self.time_column = 6 + 1 + 10  # yymmdd, sync mark, HHMMSS.fff
+        self.values_column = self.time_column + (9 if with_flags else 0)
+        self.line_length = self.values_column + len(means)*(1 + width) + 1
+
+    def samples(self, begin_us, end_us):
+        """
+        :return: int64 array of the numbers of the samples (since the epoch) in the time range [begin_us, end_us)
+        """
+        first = -(-(begin_us - self.delay_us)*self.sample_rate // us_per_second)
+        last = -(-(end_us - self.delay_us)*self.sample_rate // us_per_second)
+        return np.arange(first, last, dtype=np.int64)
+
+    def sample_times(self, samples):
+        """
+        :return: int64 array of the times of samples, in microseconds since the epoch
+        """
+        return samples*us_per_second//self.sample_rate + self.delay_us
+
+    def lines(self, samples):
+        """
+        Generate the lines of samples
+        :param samples: int64 array of the numbers of the samples (see samples())
+        :return: bytes with the lines, each ending with a newline
+        """
+        n = len(samples)
+        times = self.sample_times(samples)
+        chars = np.full((n, self.line_length), ord(" "), dtype=np.uint8)
+        days = times // us_per_day
+        dates = days.astype("datetime64[D]")
+        months = dates.astype("datetime64[M]")
+        years = dates.astype("datetime64[Y]")
+        put_digits(chars, 0, (years.astype(np.int64) + 1970) % 100, 2)
+        put_digits(chars, 2, months.astype(np.int64) % 12 + 1, 2)
+        put_digits(chars, 4, (dates - months).astype(np.int64) + 1, 2)
+
+        # the first line of every second is a sync point
+        chars[samples % self.sample_rate == 0, 6] = ord("*")
+
+        time_of_day = times - days*us_per_day
+        put_digits(chars, 7, time_of_day // 3600000000, 2)
+        put_digits(chars, 9, time_of_day // 60000000 % 60, 2)
+        put_digits(chars, 11, time_of_day // us_per_second % 60, 2)
+        chars[:, 13] = ord(".")
+        put_digits(chars, 14, time_of_day // 1000 % 1000, 3)
+        if self.with_flags:
+            chars[:, self.time_column + 1:self.time_column + 9] = ord("F")
+
+        steps = self.rng.normal(0, self.drift, (n, len(self.means)))
+        walk = self.walk + np.cumsum(steps, axis=0)
+        if n > 0:
+            self.walk = walk[-1]
+        values = self.means + np.round(walk + self.rng.normal(0, self.noise, walk.shape)).astype(np.int64)
+        for j in range(len(self.means)):
+            put_fixed_point(chars, self.values_column + j*(1 + self.width) + 1, values[:, j], self.width,
+                            self.decimals)
+        chars[:, -1] = ord("\n")
+        return chars.tobytes()
+
+
+class FileSimulator:
+    """
+    Writes the lines of a stream to files of a day each, named like the ones of the K&K counters (yymmdd_1_Frequ.txt)
+    """
+
+    def __init__(self, stream, directory):
+        self.stream = stream
+        self.directory = directory
+        self.file = None
+        self.file_day = None
+
+    def file_path(self, day):
+        date = np.datetime64(int(day), "D").item()
+        return os.path.join(self.directory, format(date, "%y%m%d") + "_1_Frequ.txt")
+
+    def write(self, begin_us, end_us):
+        """
+        Write the lines of the times in [begin_us, end_us), switching files at midnight
+        :return: number of lines written
+        """
+        samples = self.stream.samples(begin_us, end_us)
+        days = self.stream.sample_times(samples) // us_per_day
+        for day in np.unique(days):
+            if day != self.file_day:
+                self.close()
+                self.file = open(self.file_path(day), "ab")
+                self.file_day = day
+            self.file.write(self.stream.lines(samples[days == day]))
+        if self.file is not None:
+            self.file.flush()
+        return len(samples)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.file_day = None
+
+
+def parse_time(text):
+    """
+    :param text: "now", or a time like "2016-11-01 23:00:00"
+    :return: microseconds since the epoch (UTC)
+    """
+    if text == "now":
+        return int(time.time()*us_per_second)
+    return int(np.datetime64(dt.datetime.fromisoformat(text), "us").astype(np.int64))
+
+
+def main_function():
+    parser = argparse.ArgumentParser(description="Generate cavities and comb data files like the ones of the K&K counters")
+    parser.add_argument("-dw", "--workdir", dest="workdir", default="D:/ClockData", help="Working directory, where data is written")
+    parser.add_argument("-da", "--cavisubdir", dest="cavitysubdir", default="Cavities", help="Sub-directory of cavities data")
+    parser.add_argument("-dm", "--combsubdir", dest="combsubdir", default="Comb", help="Sub-directory of comb data")
+    parser.add_argument("-st", "--start", dest="start", default="now", help="Time of the first line (UTC), e.g. \"2016-11-01 23:00:00\", or \"now\"")
+    parser.add_argument("-du", "--duration", dest="duration", type=float, default=None, help="Seconds of data to generate (default: 1 hour, or no end when streaming)")
+    parser.add_argument("-ra", "--cavirate", dest="cavirate", type=int, default=1000, help="Lines per second of the cavities data")
+    parser.add_argument("-ro", "--combrate", dest="combrate", type=int, default=1, help="Lines per second of the comb data")
+    parser.add_argument("-ca", "--cavicolumns", dest="cavicolumns", type=int, default=len(cavi_sample), help="Number of data columns of the cavities data")
+    parser.add_argument("-cm", "--combcolumns", dest="combcolumns", type=int, default=len(comb_sample), help="Number of data columns of the comb data")
+    parser.add_argument("-cd", "--combdelay", dest="combdelay", type=float, default=0.297, help="Time of the comb lines after the cavities lines of the same second, in seconds")
+    parser.add_argument("-dd", "--decimals", dest="decimals", type=int, default=11, help="Digits after the point of the values")
+    parser.add_argument("-se", "--seed", dest="seed", type=int, default=1, help="Seed of the random numbers (the same seed gives the same data)")
+    parser.add_argument("-sm", "--stream", dest="stream", action="store_true", help="Write the data as it would be written in real time (or faster, see --speed), instead of as fast as possible")
+    parser.add_argument("-sx", "--speed", dest="speed", type=float, default=1, help="When streaming, how many times faster than real time the data is written")
+    parser.add_argument("-bs", "--blockseconds", dest="blockseconds", type=float, default=None, help="Seconds of data generated at once (default: 60, or 0.1 when streaming)")
+    args = parser.parse_args()
+
+    # columns beyond the sample values repeat them
+    cavi_means = [cavi_sample[j % len(cavi_sample)] for j in range(args.cavicolumns)]
+    comb_means = [comb_sample[j % len(comb_sample)] for j in range(args.combcolumns)]
+    simulators = []
+    for subdir, rate, means, with_flags, seed, delay in (
+            (args.cavitysubdir, args.cavirate, cavi_means, False, args.seed, 2000),
+            (args.combsubdir, args.combrate, comb_means, True, args.seed + 1, int(args.combdelay*us_per_second))):
+        directory = os.path.join(args.workdir, subdir)
+        os.makedirs(directory, exist_ok=True)
+        stream = StreamSimulator(rate, means, with_flags, seed, args.decimals, delay_us=delay)
+        simulators.append(FileSimulator(stream, directory))
+
+    start_us = parse_time(args.start)
+    duration = args.duration if args.duration is not None or args.stream else 3600
+    end_us = None if duration is None else start_us + int(duration*us_per_second)
+    block_us = int((args.blockseconds or (0.1 if args.stream else 60))*us_per_second)
+    real_start = time.monotonic()
+    num_lines = 0
+    begin_us = start_us
+    try:
+        while end_us is None or begin_us < end_us:
+            block_end_us = begin_us + block_us if end_us is None else min(begin_us + block_us, end_us)
+            if args.stream:
+                # a line is written when its time comes, at the chosen speed
+                wait = (block_end_us - start_us)/us_per_second/args.speed - (time.monotonic() - real_start)
+                if wait > 0:
+                    time.sleep(wait)
+            num_lines += sum(simulator.write(begin_us, block_end_us) for simulator in simulators)
+            begin_us = block_end_us
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for simulator in simulators:
+            simulator.close()
+    elapsed = time.monotonic() - real_start
+    print("Wrote " + str(num_lines) + " lines (" + str((begin_us - start_us)/us_per_second) + " seconds of data) in " +
+          str(round(elapsed, 2)) + " seconds")
+
+
+if __name__ == '__main__':
+    main_function()
+    sys.exit(0)
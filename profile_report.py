@@ -0,0 +1,19 @@
+#!/bin/bash
+
+import sys
+import argparse
+import gnomeptb as ptb
+
+def report_function():
+    parser = argparse.ArgumentParser(description="Summarize the profile captures written with --profile: the functions that ran the most, and the allocation sites with the most memory")
+    parser.add_argument("directory", help="Directory of the profile captures")
+    parser.add_argument("-n", "--top", dest="top", type=int, default=20, help="Number of functions and allocation sites to show")
+    parser.add_argument("-c", "--cumulative", dest="cumulative", action="store_true", help="Sort the functions by their total time, with the functions they call, instead of their own time")
+
+    args = parser.parse_args()
+
+    ptb.profiling.report(args.directory, args.top, args.cumulative)
+
+if __name__ == '__main__':
+    report_function()
+    sys.exit(0)
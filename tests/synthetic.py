@@ -0,0 +1,62 @@
+import datetime as dt
+import os
+
+import numpy as np
+
+
+def data_lines(num_seconds, start, sample_rate, num_columns, with_flags, seed=0):
+    """
+    Lines of a counter data file, in the format of the default regexes
+    :param num_seconds: number of seconds of data
+    :param start: datetime of the first line
+    :param sample_rate: lines per second
+    :param num_columns: number of data columns
+    :param with_flags: whether the lines have status flags (like the comb lines)
+    :param seed: seed of the random values
+    :return: list of str lines, with line endings
+    """
+    rng = np.random.default_rng(seed)
+    means = rng.uniform(1e6, 9e7, num_columns)
+    step = dt.timedelta(microseconds=1000000//sample_rate)
+    lines = []
+    t = start
+    for i in range(num_seconds*sample_rate):
+        line = t.strftime("%y%m%d") + ("*" if i % sample_rate == 0 else " ") + t.strftime("%H%M%S.%f")[:10]
+        if with_flags:
+            line += " FFFFFFFF"
+        line += "".join(" %21.11f" % v for v in means + rng.normal(0, 1, num_columns))
+        lines.append(line + "\n")
+        t += step
+    return lines
+
+
+def cavi_lines(num_seconds, start, seed=1):
+    return data_lines(num_seconds, start, 1000, 3, False, seed)
+
+
+def comb_lines(num_seconds, start, seed=2):
+    # the comb counter is read a little after the cavities one
+    return data_lines(num_seconds, start + dt.timedelta(milliseconds=297), 1, 21, True, seed)
+
+
+def write_workdir(workdir, num_seconds, start, age=None):
+    """
+    Write cavities and comb files to the Cavities and Comb sub-directories of a working directory, a file per day
+    :param age: if given, the files are made this many seconds old (so that they're taken as complete)
+    :return: list of the paths of the files
+    """
+    paths = []
+    for subdir, lines in (("Cavities", cavi_lines(num_seconds, start)), ("Comb", comb_lines(num_seconds, start))):
+        os.makedirs(os.path.join(workdir, subdir), exist_ok=True)
+        days = {}
+        for line in lines:
+            days.setdefault(line[:6], []).append(line)
+        for day, day_lines in sorted(days.items()):
+            path = os.path.join(workdir, subdir, day + "_1_Frequ.txt")
+            with open(path, "w") as f:
+                f.writelines(day_lines)
+            if age is not None:
+                t = dt.datetime.now().timestamp() - age
+                os.utime(path, (t, t))
+            paths.append(path)
+    return paths
@@ -0,0 +1,82 @@
+import datetime as dt
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from gnomeptb.analysis import DataCollection, SingleFileData, default_cavity_regex, default_comb_regex
+from gnomeptb.daily import DailyArchive, export_day
+from synthetic import cavi_lines, comb_lines
+
+
+@pytest.fixture
+def minutes(monkeypatch):
+    """
+    Two minutes of data, on two days, as SingleFileData objects
+    """
+    monkeypatch.setattr(SingleFileData, "MainEquation", "CavitiesData[[0]][\"Var\",Hz]")
+    start = dt.datetime(2016, 11, 1, 23, 59, 0, 2000)
+    collected = []
+    collection = DataCollection(default_cavity_regex, default_comb_regex, None, "test01")
+    collection.file_writer.minute_writer = collected.append
+    collection.append_cavi_data(cavi_lines(125, start))
+    collection.append_comb_data(comb_lines(125, start))
+    collection.process_data()
+    assert len(collected) == 2
+    return collected
+
+
+def h5_files(directory):
+    return sorted(os.path.relpath(os.path.join(root, name), directory)
+                  for root, _, names in os.walk(directory) for name in names if name.endswith(".h5"))
+
+
+def assert_same_attrs(a, b, skip=()):
+    assert sorted(k for k in a.attrs if k not in skip) == sorted(k for k in b.attrs if k not in skip)
+    for key in a.attrs:
+        if key not in skip:
+            assert np.array_equal(a.attrs[key], b.attrs[key]), key
+
+
+def test_export_day_matches_minute_files(minutes, tmp_path):
+    with DailyArchive(str(tmp_path / "archive"), "test01") as archive:
+        for minute in minutes:
+            SingleFileData.write_minute_file(str(tmp_path / "direct"), "test01", minute.normalize())
+            archive.append(minute)
+    for daily_file in h5_files(str(tmp_path / "archive")):
+        export_day(os.path.join(str(tmp_path / "archive"), daily_file), str(tmp_path / "exported"))
+
+    files = h5_files(str(tmp_path / "direct"))
+    assert len(files) == 2
+    assert h5_files(str(tmp_path / "exported")) == files
+    for name in files:
+        with h5py.File(str(tmp_path / "direct" / name), "r") as direct, \
+                h5py.File(str(tmp_path / "exported" / name), "r") as exported:
+            assert_same_attrs(direct, exported, skip=("LocalFileCreationTime",))
+            assert sorted(direct) == sorted(exported)
+            for dataset_name in direct:
+                assert np.array_equal(direct[dataset_name][()].view(np.int64),
+                                      exported[dataset_name][()].view(np.int64))
+                assert_same_attrs(direct[dataset_name], exported[dataset_name])
+
+
+def test_append_is_idempotent(minutes, tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    with DailyArchive(archive_dir, "test01") as archive:
+        for minute in minutes:
+            archive.append(minute)
+    sizes = {}
+    for daily_file in h5_files(archive_dir):
+        with h5py.File(os.path.join(archive_dir, daily_file), "r") as f:
+            sizes[daily_file] = (len(f[DailyArchive.minutes_table_name]), len(f[SingleFileData.cavi_dataset_name]))
+
+    # appended again, e.g. after a restart without a journal, in a new archive object
+    with DailyArchive(archive_dir, "test01") as archive:
+        for minute in minutes:
+            archive.append(minute)
+    for daily_file in h5_files(archive_dir):
+        with h5py.File(os.path.join(archive_dir, daily_file), "r") as f:
+            assert (len(f[DailyArchive.minutes_table_name]), len(f[SingleFileData.cavi_dataset_name])) == \
+                sizes[daily_file]
+    assert sorted(n for n, _ in sizes.values()) == [1, 1]
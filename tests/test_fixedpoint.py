@@ -0,0 +1,75 @@
+import decimal
+
+import numpy as np
+import pytest
+
+from gnomeptb.analysis import LineBatch, SingleFileData
+from gnomeptb.fixedpoint import FixedPointArray
+
+
+def make_batch(columns):
+    """
+    :param columns: list of columns, each a list of numbers as str
+    :return: LineBatch with the columns as its data columns
+    """
+    num_lines = len(columns[0])
+    return LineBatch(np.zeros(num_lines, dtype="datetime64[us]"), np.zeros(num_lines, dtype=bool),
+                     np.ones(num_lines, dtype=bool), np.full(num_lines, ""),
+                     [FixedPointArray.from_strings(column) for column in columns])
+
+
+def assert_bit_identical(actual, expected):
+    assert actual.dtype == expected.dtype
+    assert actual.shape == expected.shape
+    assert np.array_equal(actual.view(np.int64), expected.view(np.int64))
+
+
+def assert_same_as_decimal(columns, prec=4):
+    batch = make_batch(columns)
+    to_include = list(range(len(columns)))
+    fast = SingleFileData.create_normalized_list(batch, to_include, prec)
+    reference = SingleFileData.create_normalized_list_decimal(batch, to_include, prec)
+    assert_bit_identical(fast["array"], reference["array"])
+    assert_bit_identical(fast["offsets"], reference["offsets"])
+
+
+def random_column(rng, num_lines, magnitude, max_digits):
+    values = rng.normal(0, 1, num_lines)*magnitude + magnitude
+    digits = rng.integers(0, max_digits + 1, num_lines)
+    return ["%.*f" % (int(d), v) for d, v in zip(digits, values)]
+
+
+def test_mixed_decimal_widths():
+    rng = np.random.default_rng(1)
+    assert_same_as_decimal([["1.5", "-2.125", "3", "0.0001", "-7.30"]*200,
+                            random_column(rng, 1000, 1e7, 11),
+                            random_column(rng, 1000, 0.5, 15)])
+
+
+def test_negative_values():
+    rng = np.random.default_rng(2)
+    assert_same_as_decimal([[str(-abs(float(v))) for v in random_column(rng, 500, 3e4, 8)],
+                            ["-1.25", "-0.5", "2", "-1000000.000001"]*125])
+
+
+@pytest.mark.parametrize("column", [["-0.000", "0.0", "-0", "0"],
+                                    ["-0.000", "0.0", "12.5", "-12.5"],
+                                    ["-0.00", "1.5", "-0", "3.25"]])
+def test_negative_zeros(column):
+    assert_same_as_decimal([column])
+
+
+def test_mantissas_too_large_for_int64():
+    column = ["123456789012.123456789012", "-98765432109.87654321", "1.000000000000000001", "42"]
+    assert FixedPointArray.from_strings(column).mantissa.dtype == object
+    assert_same_as_decimal([column])
+
+
+def test_rounding_fallback_to_decimal():
+    # sums with more digits than the precision of the Decimal context are rounded by Decimal, which the integer
+    # arithmetic can't reproduce, so these columns are normalized with Decimal
+    column = ["1234567890123456789012345.678901", "-1234567890123456789012344.000002", "0.000001",
+              "9876543210987654321098765.4321"]
+    assert decimal.getcontext().prec < 32
+    assert FixedPointArray.from_strings(column).subtract_rounded_mean(4) is None
+    assert_same_as_decimal([column, ["1.5", "2.5", "-3", "4.125"]])
@@ -0,0 +1,173 @@
+import datetime as dt
+import glob
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from gnomeptb.analysis import DataCollection, SingleFileData, default_cavity_regex, default_comb_regex
+from gnomeptb.journal import OffsetJournal
+from synthetic import cavi_lines, comb_lines, write_workdir
+
+main_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+
+class Minute:
+    """
+    What OffsetJournal needs of a minute (see SingleFileData)
+    """
+    def __init__(self, resume_state, start_time):
+        self.resume_state = resume_state
+        self._start_time = start_time
+
+    def start_time(self):
+        return self._start_time
+
+
+def state(cavi_file, cavi_offset, comb_file, comb_offset):
+    return {"cavi_file": cavi_file, "cavi_offset": cavi_offset, "comb_file": comb_file, "comb_offset": comb_offset}
+
+
+@pytest.fixture
+def data_files(tmp_path):
+    paths = []
+    for name in ("cavi.txt", "comb.txt"):
+        path = str(tmp_path / name)
+        with open(path, "wb") as f:
+            f.write(b"x"*1000)
+        paths.append(path)
+    return paths
+
+
+def test_save_and_resume(tmp_path, data_files):
+    cavi_file, comb_file = data_files
+    path = str(tmp_path / "journal.json")
+    journal = OffsetJournal(path)
+    assert journal.resume_offsets(cavi_file, comb_file) == (0, 0)
+    sequence = journal.add_minute(Minute(state(cavi_file, 600, comb_file, 40), np.datetime64("2016-11-01T12:00")))
+    assert not os.path.exists(path)
+    journal.finish_minute(sequence)
+
+    resumed = OffsetJournal(path)
+    assert resumed.resume_offsets(cavi_file, comb_file) == (600, 40)
+    assert resumed.resume_stream_offsets({"cavi": cavi_file, "comb": comb_file}) == {"cavi": 600, "comb": 40}
+    # other files are read from the beginning
+    assert resumed.resume_offsets(cavi_file + ".other", comb_file) == (0, 40)
+
+
+def test_minutes_are_committed_in_order(tmp_path, data_files):
+    cavi_file, comb_file = data_files
+    path = str(tmp_path / "journal.json")
+    journal = OffsetJournal(path)
+    sequences = [journal.add_minute(Minute(state(cavi_file, 100*(k + 1), comb_file, k + 1),
+                                           np.datetime64("2016-11-01T12:00") + np.timedelta64(k, "m")))
+                 for k in range(3)]
+    # the later minutes are written first: nothing can be recorded until the first one is
+    journal.finish_minute(sequences[2])
+    journal.finish_minute(sequences[1])
+    assert not os.path.exists(path)
+    journal.finish_minute(sequences[0])
+    assert OffsetJournal(path).resume_offsets(cavi_file, comb_file) == (300, 3)
+
+    # a minute without a resume state doesn't move the journal
+    sequence = journal.add_minute(Minute(None, np.datetime64("2016-11-01T12:03")))
+    journal.finish_minute(sequence)
+    assert OffsetJournal(path).resume_offsets(cavi_file, comb_file) == (300, 3)
+
+
+def test_journal_past_the_end_of_the_file(tmp_path, data_files):
+    cavi_file, comb_file = data_files
+    path = str(tmp_path / "journal.json")
+    with open(path, "w") as f:
+        json.dump(dict(state(cavi_file, 5000, comb_file, 1000), version=OffsetJournal.version,
+                       last_minute="2016-11-01T12:00:00"), f)
+    # the cavities file is shorter than the position, so it's read from the beginning
+    assert OffsetJournal(path).resume_offsets(cavi_file, comb_file) == (0, 1000)
+
+
+@pytest.mark.parametrize("content", ["", "{not json", "[1, 2]", json.dumps({"version": 999})])
+def test_invalid_journal(tmp_path, data_files, content):
+    path = str(tmp_path / "journal.json")
+    with open(path, "w") as f:
+        f.write(content)
+    journal = OffsetJournal(path)
+    assert journal.state is None
+    assert journal.resume_offsets(*data_files) == (0, 0)
+    assert not journal.is_past({"cavi": data_files[0]}, {"cavi": 0})
+
+
+def test_is_past(tmp_path, data_files):
+    cavi_file, comb_file = data_files
+    journal = OffsetJournal(str(tmp_path / "journal.json"))
+    journal.finish_minute(journal.add_minute(Minute(state(cavi_file, 600, comb_file, 1000),
+                                                    np.datetime64("2016-11-01T12:00"))))
+    assert journal.is_past({"cavi": cavi_file, "comb": comb_file}, {"cavi": 600, "comb": 1000})
+    assert not journal.is_past({"cavi": cavi_file, "comb": comb_file}, {"cavi": 1000, "comb": 1000})
+    # files before the ones of the journal
+    assert journal.is_past({"cavi": cavi_file + ".old", "comb": comb_file + ".old"}, {"cavi": 1000, "comb": 1000})
+
+
+def minute_files(directory):
+    return sorted(os.path.relpath(path, directory) for path in glob.glob(os.path.join(directory, "**", "*.h5"),
+                                                                        recursive=True))
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def test_kill_and_resume(tmp_path, monkeypatch):
+    """
+    A run that is killed before its minutes are written loses none of them: the files are moved to the "finished"
+    sub-directory only once the journal has their minutes, and the next run resumes from the journal
+    """
+    start = dt.datetime(2016, 11, 1, 23, 58, 0, 2000)
+    num_seconds = 3*60 + 5
+    workdir = str(tmp_path / "work")
+    out_dir = str(tmp_path / "out")
+    first_day_files = [path for path in write_workdir(workdir, num_seconds, start, age=3600) if "161101" in path]
+    command = [sys.executable, main_path, "-dw", workdir, "-do", out_dir]
+
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        assert wait_for(lambda: len(minute_files(out_dir)) >= 1, 60)
+    finally:
+        process.send_signal(signal.SIGKILL)
+        process.wait()
+    assert len(minute_files(out_dir)) < 3
+    assert all(os.path.exists(path) for path in first_day_files)
+
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # the files of the first day are moved once the journal is past them, in the files of the next day
+        assert wait_for(lambda: len(minute_files(out_dir)) == 3 and
+                        not any(os.path.exists(path) for path in first_day_files), 60)
+    finally:
+        process.send_signal(signal.SIGKILL)
+        process.wait()
+
+    # the minutes are the ones of an uninterrupted run
+    monkeypatch.setattr(SingleFileData, "MainEquation", "x")
+    collection = DataCollection(default_cavity_regex, default_comb_regex, str(tmp_path / "reference"), "ptb01")
+    collection.append_cavi_data(cavi_lines(num_seconds, start))
+    collection.append_comb_data(comb_lines(num_seconds, start))
+    collection.process_data()
+    files = minute_files(str(tmp_path / "reference"))
+    assert minute_files(out_dir) == files
+    for name in files:
+        with h5py.File(os.path.join(out_dir, name), "r") as resumed, \
+                h5py.File(str(tmp_path / "reference" / name), "r") as reference:
+            for dataset_name in (SingleFileData.cavi_dataset_name, SingleFileData.comb_dataset_name):
+                assert np.array_equal(resumed[dataset_name][()], reference[dataset_name][()])
+                assert resumed[dataset_name].attrs["t0"] == reference[dataset_name].attrs["t0"]
@@ -0,0 +1,92 @@
+import json
+import os
+
+import numpy as np
+
+from gnomeptb.analysis import FileRetirement
+from gnomeptb.journal import OffsetJournal
+
+
+def make_files(workdir, names):
+    paths = {}
+    for stream, name in names.items():
+        os.makedirs(os.path.join(workdir, name), exist_ok=True)
+        path = os.path.join(workdir, name, "161101_1_Frequ.txt")
+        with open(path, "wb") as f:
+            f.write(b"x"*100)
+        paths[stream] = path
+    return paths
+
+
+class Minute:
+    def __init__(self, resume_state):
+        self.resume_state = resume_state
+
+    def start_time(self):
+        return np.datetime64("2016-11-01T12:00")
+
+
+def commit(journal, paths, offsets):
+    state = {}
+    for stream, path in paths.items():
+        state[stream + "_file"] = path
+        state[stream + "_offset"] = offsets[stream]
+    journal.finish_minute(journal.add_minute(Minute(state)))
+
+
+def test_files_are_moved_once_the_journal_has_them(tmp_path):
+    workdir = str(tmp_path)
+    paths = make_files(workdir, {"cavi": "Cavities", "comb": "Comb"})
+    journal = OffsetJournal(os.path.join(workdir, "journal.json"))
+    retirement = FileRetirement(workdir, "finished", journal=journal)
+
+    retirement.retire_when_processed(paths, {"cavi": 100, "comb": 100})
+    assert all(os.path.exists(path) for path in paths.values())
+    commit(journal, paths, {"cavi": 80, "comb": 100})
+    retirement.retire_processed()
+    assert all(os.path.exists(path) for path in paths.values())
+    # the files still wait in the record, for a restart
+    with open(retirement.record_path) as f:
+        assert json.load(f)["processed"][0]["files"] == paths
+
+    commit(journal, paths, {"cavi": 100, "comb": 100})
+    retirement.retire_processed()
+    assert not any(os.path.exists(path) for path in paths.values())
+    assert all(os.path.exists(retirement.finished_path(path)) for path in paths.values())
+    assert not os.path.exists(retirement.record_path)
+
+
+def test_restart_moves_the_files_the_journal_has(tmp_path):
+    workdir = str(tmp_path)
+    paths = make_files(workdir, {"cavi": "Cavities", "comb": "Comb"})
+    journal_path = os.path.join(workdir, "journal.json")
+    journal = OffsetJournal(journal_path)
+    FileRetirement(workdir, "finished", journal=journal).retire_when_processed(paths, {"cavi": 100, "comb": 100})
+    # the program stops before the files are moved, after the journal has them
+    commit(journal, paths, {"cavi": 100, "comb": 100})
+
+    retirement = FileRetirement(workdir, "finished", journal=OffsetJournal(journal_path))
+    retirement.resume()
+    assert not any(os.path.exists(path) for path in paths.values())
+    assert not os.path.exists(retirement.record_path)
+
+
+def test_records_of_stations_in_the_same_working_directory(tmp_path):
+    workdir = str(tmp_path)
+    first = make_files(workdir, {"cavi": "Cavities1", "comb": "Comb1"})
+    second = make_files(workdir, {"cavi": "Cavities2", "comb": "Comb2"})
+    journals = [OffsetJournal(os.path.join(workdir, name)) for name in ("journal1.json", "journal2.json")]
+    retirements = [FileRetirement(workdir, "finished", journal=journal,
+                                  record_name=FileRetirement.record_name_for(subdirs))
+                   for journal, subdirs in zip(journals, ({"cavi": "Cavities1", "comb": "Comb1"},
+                                                          {"cavi": "Cavities2", "comb": "Comb2"}))]
+    assert retirements[0].record_path != retirements[1].record_path
+
+    retirements[0].retire_when_processed(first, {"cavi": 100, "comb": 100})
+    retirements[1].retire_when_processed(second, {"cavi": 100, "comb": 100})
+    commit(journals[1], second, {"cavi": 100, "comb": 100})
+    retirements[1].retire_processed()
+    # the record of the first station still has its files
+    with open(retirements[0].record_path) as f:
+        assert json.load(f)["processed"][0]["files"] == first
+    assert all(os.path.exists(path) for path in first.values())
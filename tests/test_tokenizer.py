@@ -0,0 +1,131 @@
+import datetime as dt
+import time
+
+import numpy as np
+import pytest
+
+from gnomeptb.analysis import LineData, default_cavity_regex, default_comb_regex
+from gnomeptb.tailing import MappedLines
+from synthetic import cavi_lines, comb_lines
+
+start = dt.datetime(2016, 11, 1, 23, 59, 58, 2000)
+
+# lines the regex rejects
+malformed_cavi = [
+    "161101 235958.100 1.5 2x.5 3.5",
+    "161101 235958.101 1.5 2.5",
+    "161101 235958.102 1.5 2.5 3.5 4.5",
+    "161101 235958.103 1.5 2.5 3.5.5",
+    "161101 235958.104 1.5 -2.5 --3.5",
+    "161101 235958.105 1.5 2.5 .5",
+    "16110 235958.106 1.5 2.5 3.5",
+    "161101* 235958.107 1.5 2.5 3.5",
+    "161101 *235958.108 1.5 2.5 3.5",
+    " 161101 235958.109 1.5 2.5 3.5",
+    "161101 235958.110 1.5 2.5 3é",
+    "161101 235958. 1.5 2.5 3.5",
+]
+# lines the regex matches only in part of their fields, or in other fields than they look like (e.g. the separator
+# of the milliseconds can be any character, numbers may end with the decimal point, and str regexes take non-ASCII
+# digits and whitespace that bytes regexes don't)
+partial_cavi = [
+    "161101 235958.111 1.5 ٢.5 3.5",
+    "161101 235958 112 1.5 2.5 3.5",
+    "161101 235958x113 1.5 2.5 3.5",
+    "161101*235958.114 1. -2. 3",
+    "161101 \t 235958.115\t1.5  2.5\x0b3.5 \t",
+    "161101 235958.116 -0 -0.000 0012.50",
+    "161101 235958.117 1.5 2.5 3.5\x1c",
+    "161101 235958.118 1.5\x1c2.5 3.5",
+    "161101 235958.1190000000 12345678901234567890123 1.5 2.5",
+]
+malformed_comb = [
+    "161101 235958.297  FFFFFFFF 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20 21",
+    "161101 235958.297 FFFFFFF 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20 21",
+    "161101 235958.297 FFFFFFFf 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20 21",
+    "161101 235958.297 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20 21",
+]
+partial_comb = [
+    "161101*235958.297\tFFFFFFFF\t1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20 21",
+    "161101   235958.297 ABCDEFGH -1. 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20 21  ",
+]
+
+
+def parse(regex, lines, fast, monkeypatch, in_buffer=False):
+    """
+    Parse lines with, or without, the tokenizer of the layout of the regex
+    :param in_buffer: whether to parse the lines in place in a buffer (they have to be bytes)
+    :return: LineBatch
+    """
+    monkeypatch.setattr(LineData, "use_fast_tokenizer", fast)
+    parser = LineData(regex)
+    if not in_buffer:
+        return parser.parse_many(lines)
+    lengths = np.array([len(line) + 1 for line in lines], dtype=np.int64)
+    ends = np.cumsum(lengths) - 1
+    return parser.parse_buffer(MappedLines(b"\n".join(lines) + b"\n", ends - lengths + 1, ends))
+
+
+def assert_same_batches(fast, regex):
+    assert np.array_equal(fast.success, regex.success)
+    ok = regex.success
+    assert np.array_equal(fast.time[ok], regex.time[ok])
+    assert np.array_equal(fast.sync[ok], regex.sync[ok])
+    assert list(fast.flags[ok]) == list(regex.flags[ok])
+    assert len(fast.values) == len(regex.values)
+    for fast_column, regex_column in zip(fast.values, regex.values):
+        fast_values = fast_column[ok].to_decimals()
+        regex_values = regex_column[ok].to_decimals()
+        # same values, with the same sign of zero and the same number of decimals
+        assert list(map(str, fast_values)) == list(map(str, regex_values))
+
+
+def lines_of(lines):
+    return [line.rstrip("\n") for line in lines]
+
+
+# regex, lines it accepts, and other lines (which it rejects, in the "malformed" cases)
+cases = {
+    "cavi_malformed": (default_cavity_regex, lines_of(cavi_lines(2, start)), malformed_cavi),
+    "cavi_partial": (default_cavity_regex, lines_of(cavi_lines(1, start)), partial_cavi),
+    "comb_malformed": (default_comb_regex, lines_of(comb_lines(20, start)), malformed_comb),
+    "comb_partial": (default_comb_regex, lines_of(comb_lines(3, start)), partial_comb),
+}
+
+
+@pytest.mark.parametrize("case", sorted(cases))
+@pytest.mark.parametrize("kind", ["str", "bytes", "buffer"])
+def test_tokenizer_matches_regex(case, kind, monkeypatch):
+    regex, valid, other = cases[case]
+    lines = valid + other
+    if kind != "str":
+        lines = [line.encode() for line in lines]
+    in_buffer = kind == "buffer"
+    # only valid lines, which all go through the tokenizer
+    fast = parse(regex, lines[:len(valid)], True, monkeypatch, in_buffer)
+    assert fast.num_fast_lines == len(valid)
+    assert_same_batches(fast, parse(regex, lines[:len(valid)], False, monkeypatch, in_buffer))
+    # with the other lines, which the tokenizer has to reject, or split the way the regex does
+    fast = parse(regex, lines, True, monkeypatch, in_buffer)
+    reference = parse(regex, lines, False, monkeypatch, in_buffer)
+    assert_same_batches(fast, reference)
+    assert fast.num_fast_lines >= len(valid)
+    assert reference.success[:len(valid)].all()
+    if case.endswith("malformed"):
+        assert not reference.success[len(valid):].any()
+
+
+def integer_lines(num_lines):
+    return ["161101 %06d.%03d %d %d %d" % (i//1000, i % 1000, 1000 + i, 2000 + i, 3000 + i) for i in range(num_lines)]
+
+
+def test_malformed_integer_field_falls_back_quickly():
+    # a column of integers with a wrong field used to backtrack exponentially when it was checked as a whole
+    lines = integer_lines(2000)
+    lines[-1] = lines[-1].replace(" 2", " 2x", 1)
+    parser = LineData(default_cavity_regex)
+    start_time = time.perf_counter()
+    batch = parser.parse_many(lines)
+    assert time.perf_counter() - start_time < 5
+    assert batch.num_fast_lines == len(lines) - 1
+    assert np.array_equal(np.flatnonzero(~batch.success), [len(lines) - 1])